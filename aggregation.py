@@ -0,0 +1,87 @@
+"""
+Streaming aggregation of reward curves.
+
+A CurveAggregator keeps the per-step count, mean and sum of squared deviations of
+the curves added so far (Welford's algorithm), so the memory it needs does not grow
+with the number of test domains. Aggregates built in separate processes combine
+exactly with merge (the parallel update of Chan et al.), and the current mean,
+standard deviation and standard error can be read at any time.
+"""
+import csv
+import os
+import numpy as np
+
+class CurveAggregator(object):
+    def __init__(self, steps):
+        self.count = 0
+        self.mean = np.zeros(steps)
+        self.m2 = np.zeros(steps)
+
+    def add(self, curve):
+        """
+        Adds one curve (e.g. the rewards per step of one test domain).
+        """
+        curve = np.asarray(curve, dtype=float)
+        self.count += 1
+        delta = curve - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (curve - self.mean)
+
+    def merge(self, other):
+        """
+        Adds all the curves of another aggregator, as if they had been added here.
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = np.copy(other.mean)
+            self.m2 = np.copy(other.m2)
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / float(count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / float(count)
+        self.count = count
+
+    def variance(self, ddof=0):
+        if self.count - ddof <= 0:
+            return np.zeros(len(self.mean))
+        return self.m2 / float(self.count - ddof)
+
+    def stdev(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+    def stderr(self):
+        if self.count == 0:
+            return np.zeros(len(self.mean))
+        return self.stdev() / np.sqrt(self.count)
+
+    def band(self, z=1.96):
+        """
+        Returns the lower and upper confidence bands of the mean, z standard errors away.
+        """
+        half_width = z * self.stderr()
+        return (self.mean - half_width, self.mean + half_width)
+
+    def rows(self):
+        """
+        Returns one [step, avg, stdev, stderr] row per step.
+        """
+        stdev = self.stdev()
+        stderr = self.stderr()
+        return [[i, self.mean[i], stdev[i], stderr[i]] for i in range(len(self.mean))]
+
+    def write_csv(self, path, header):
+        """
+        Writes the rows to a CSV file. The file is replaced atomically, so it can be
+        read while a run is still adding curves.
+        """
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(header + ['Count'])
+        for row in self.rows():
+            writer.writerow(row + [self.count])
+        f.close()
+        os.rename(tmp, path)
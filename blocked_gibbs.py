@@ -0,0 +1,143 @@
+"""
+A blocked Gibbs sampler for the Dirichlet process mixture of MDP classes from
+Wilson et al. (ICML'07), using a truncated stick-breaking representation of the DP.
+
+With at most K classes, every block of the posterior can be drawn in one batched
+array operation per iteration:
+    assignments      from an (MDP x K) log-probability matrix with the Gumbel-max trick
+    stick weights    from K Beta distributions
+    MDP weights      from J conjugate Gaussian posteriors (stacked Cholesky solves)
+    class parameters from K NIW posteriors (stacked Bartlett draws)
+so the cost of an iteration scales with the array sizes, not interpreter overhead.
+"""
+import math
+import numpy as np
+from scipy.special import multigammaln
+from multitask import MdpClass, sample_niw_batch, categorical_sample
+
+class BlockedGibbsSampler(object):
+    """
+    Produces the same (classes, assignments, counts, weights) summary as the explicit
+    sampler in MultiTaskBayesianAgent.update_beliefs.
+    """
+    def __init__(self, prior, alpha, reward_stdev, truncation=20, iterations=300, burn_in=100, thin=1):
+        assert(iterations > burn_in)
+        self.prior = prior
+        self.alpha = alpha
+        self.reward_stdev = reward_stdev
+        self.truncation = truncation
+        self.iterations = iterations
+        self.burn_in = burn_in
+        self.thin = thin
+
+    def fit(self, statistics):
+        """
+        Runs the sampler over the reward statistics of every MDP and returns the MAP
+        sample as (classes, assignments, assignment_counts, weights).
+        """
+        if len(statistics) == 0:
+            # No MDPs yet (e.g. an agent without training MDPs): only the prior is known
+            return ([], [], [], [])
+        K = self.truncation
+        d = self.prior.mu.shape[0]
+        noise = self.reward_stdev ** 2
+        self.data_xtx = np.array([s.xtx for s in statistics]) / noise
+        self.data_xty = np.array([s.xty for s in statistics]) / noise
+        self.data_yty = np.array([s.yty for s in statistics]) / noise
+        J = len(statistics)
+        # Initialise the classes and sticks from the prior and all MDPs in one class
+        (means, covs, precisions, cholesky) = self.sample_classes(np.zeros((J, K)), np.zeros((J, d)))
+        sticks = np.random.beta(1., self.alpha, size=K)
+        assignments = np.zeros(J, dtype=int)
+        max_likelihood = None
+        for iteration in range(self.iterations):
+            weights = self.sample_weights(assignments, means, precisions)
+            log_pi = self.log_mixture_weights(sticks)
+            log_probs = log_pi[None,:] + self.log_normal(weights, means, cholesky)
+            assignments = categorical_sample(log_probs)
+            one_hot = np.zeros((J, K))
+            one_hot[np.arange(J), assignments] = 1.
+            counts = one_hot.sum(axis=0)
+            tail_counts = np.cumsum(counts[::-1])[::-1] - counts
+            sticks = np.random.beta(1. + counts, self.alpha + tail_counts)
+            (means, covs, precisions, cholesky) = self.sample_classes(one_hot, weights)
+            if iteration >= self.burn_in and (iteration - self.burn_in) % self.thin == 0:
+                log_likelihood = self.log_likelihood(weights, assignments, counts, self.log_mixture_weights(sticks), means, cholesky)
+                if max_likelihood is None or log_likelihood > max_likelihood:
+                    max_likelihood = log_likelihood
+                    map_sample = (assignments, weights, means, covs)
+        (assignments, weights, means, covs) = map_sample
+        (occupied, assignments) = np.unique(assignments, return_inverse=True)
+        classes = [MdpClass(i, means[k], covs[k]) for i,k in enumerate(occupied)]
+        counts = np.bincount(assignments).tolist()
+        print 'Blocked MAP Distribution: {0} (log-likelihood: {1})'.format(counts, max_likelihood)
+        return (classes, assignments.tolist(), counts, [w for w in weights])
+
+    def log_mixture_weights(self, sticks):
+        """
+        Returns log pi_k = log v_k + sum_{l<k} log(1 - v_l), with v_K = 1 for truncation.
+        """
+        sticks = np.append(sticks[:-1], 1.)
+        log_rest = np.append(0., np.cumsum(np.log(np.maximum(1. - sticks[:-1], 1e-300))))
+        return np.log(np.maximum(sticks, 1e-300)) + log_rest
+
+    def log_normal(self, weights, means, cholesky):
+        """
+        Returns the (MDP x K) matrix of log N(w_j | mu_k, Sigma_k), given the lower
+        Cholesky factors of the class precisions.
+        """
+        d = means.shape[1]
+        diff = weights[:,None,:] - means[None,:,:]
+        projected = np.einsum('kba,jkb->jka', cholesky, diff)
+        log_det = np.sum(np.log(np.diagonal(cholesky, axis1=1, axis2=2)), axis=1)
+        return -0.5 * d * math.log(2. * math.pi) + log_det[None,:] - 0.5 * np.sum(projected ** 2, axis=2)
+
+    def sample_weights(self, assignments, means, precisions):
+        """
+        Draws every MDP's weights from its conjugate Gaussian posterior in one batch.
+        """
+        (J, d) = self.data_xty.shape
+        precision = precisions[assignments] + self.data_xtx
+        linear = np.einsum('jab,jb->ja', precisions[assignments], means[assignments]) + self.data_xty
+        cholesky = np.linalg.cholesky(precision)
+        mean = np.linalg.solve(precision, linear[:,:,None])[:,:,0]
+        # If P = L L' then inv(L') z has covariance inv(P)
+        noise = np.linalg.solve(np.transpose(cholesky, (0, 2, 1)), np.random.normal(0, 1, size=(J, d, 1)))[:,:,0]
+        return mean + noise
+
+    def sample_classes(self, one_hot, weights):
+        """
+        Draws every class's mean and covariance from its NIW posterior in one batch.
+        Empty classes are drawn from the prior.
+        """
+        p = self.prior
+        counts = one_hot.sum(axis=0)
+        totals = np.dot(one_hot.T, weights)
+        outer = np.einsum('jk,ja,jb->kab', one_hot, weights, weights)
+        lmbda_n = p.lmbda + counts
+        nu_n = p.nu + counts
+        mu_n = (p.lmbda * p.mu[None,:] + totals) / lmbda_n[:,None]
+        psi_n = p.psi[None,:,:] + outer + p.lmbda * np.outer(p.mu, p.mu)[None,:,:] - lmbda_n[:,None,None] * np.einsum('ka,kb->kab', mu_n, mu_n)
+        return sample_niw_batch(mu_n, lmbda_n, nu_n, psi_n)
+
+    def log_likelihood(self, weights, assignments, counts, log_pi, means, cholesky):
+        """
+        Returns the joint log-probability of the assignments, weights, rewards and the
+        parameters of the occupied classes, ignoring constants.
+        """
+        p = self.prior
+        d = means.shape[1]
+        log_likelihood = np.sum(log_pi[assignments])
+        log_likelihood += np.sum(self.log_normal(weights, means, cholesky)[np.arange(len(assignments)), assignments])
+        log_likelihood += np.sum(-0.5 * (self.data_yty - 2. * np.einsum('ja,ja->j', weights, self.data_xty)
+                                         + np.einsum('ja,jab,jb->j', weights, self.data_xtx, weights)))
+        # NIW prior density of the occupied classes
+        occupied = counts > 0
+        log_det_precision = 2. * np.sum(np.log(np.diagonal(cholesky, axis1=1, axis2=2)), axis=1)
+        projected = np.einsum('kba,kb->ka', cholesky, means - p.mu[None,:])
+        log_normal = 0.5 * d * math.log(p.lmbda) + 0.5 * log_det_precision - 0.5 * p.lmbda * np.sum(projected ** 2, axis=1)
+        precisions = np.einsum('kab,kcb->kac', cholesky, cholesky)
+        log_inv_wishart = 0.5 * p.nu * np.linalg.slogdet(p.psi)[1] - 0.5 * p.nu * d * math.log(2.) - multigammaln(0.5 * p.nu, d) \
+                + 0.5 * (p.nu + d + 1) * log_det_precision - 0.5 * np.einsum('ab,kba->k', p.psi, precisions)
+        log_likelihood += np.sum((log_normal + log_inv_wishart)[occupied])
+        return log_likelihood
@@ -0,0 +1,82 @@
+"""
+The hbayes-rl command line:
+
+    hbayes-rl run training-window multibayes --trainsize 4 --output results/
+    hbayes-rl run goal-locations qlearning --output results/
+    hbayes-rl plot results/ [--output results/test.pdf]
+    hbayes-rl sweep spec.json [--processes 8] [--dry-run]
+    hbayes-rl coordinator --bind 0.0.0.0:6000 -- multibayes --trainsize 4 --output results/
+    hbayes-rl worker coordinator-host:6000
+    hbayes-rl replay results/trajectory_agent_1.bin [--target agent]
+
+Each subcommand only imports the modules it needs: 'run' never imports matplotlib,
+and 'plot' never imports the agents or the experiment code. This keeps start-up cheap
+for the many short-lived worker processes of a sweep and means runs need no display.
+"""
+import argparse
+import importlib
+import sys
+
+# The experiment modules, imported on demand by 'run'
+EXPERIMENTS = {
+    'training-window': 'test_training_window',
+    'goal-locations': 'test_goal_locations'
+}
+
+def run(argv):
+    parser = argparse.ArgumentParser(prog='hbayes-rl run', description='Runs an experiment and stores its results.')
+    parser.add_argument('experiment', choices=sorted(EXPERIMENTS.keys()))
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='The arguments of the experiment.')
+    args = parser.parse_args(argv)
+    experiment = importlib.import_module(EXPERIMENTS[args.experiment])
+    experiment_parser = experiment.build_parser(argparse.ArgumentParser(prog='hbayes-rl run ' + args.experiment))
+    manifest = experiment.run(experiment_parser.parse_args(args.args))
+    print 'Results written to {0}'.format(manifest)
+
+def plot(argv):
+    parser = argparse.ArgumentParser(prog='hbayes-rl plot', description='Plots the stored results of an experiment.')
+    parser.add_argument('results', help='The results manifest, or the directory that holds it.')
+    parser.add_argument('--output', default=None, help='The PDF to write. Defaults to the standard name next to the results.')
+    args = parser.parse_args(argv)
+    from results import load_results
+    from plotting import plot_results
+    filename = plot_results(load_results(args.results), args.output)
+    print 'Plot written to {0}'.format(filename)
+
+def sweep(argv):
+    from sweep import build_parser, load_spec, run_sweep
+    args = build_parser(argparse.ArgumentParser(prog='hbayes-rl sweep', description='Runs a sweep of experiments across a local process pool.')).parse_args(argv)
+    run_sweep(load_spec(args.spec), processes=args.processes, dry_run=args.dry_run)
+
+def coordinator(argv):
+    from distributed import run_coordinator
+    run_coordinator(argv)
+
+def worker(argv):
+    from distributed import run_worker
+    run_worker(argv)
+
+def replay(argv):
+    import trajectory
+    trajectory.replay(trajectory.build_parser(argparse.ArgumentParser(prog='hbayes-rl replay', description='Replays a recorded trajectory without the simulator.')).parse_args(argv))
+
+COMMANDS = {
+    'run': run,
+    'plot': plot,
+    'sweep': sweep,
+    'coordinator': coordinator,
+    'worker': worker,
+    'replay': replay
+}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='hbayes-rl', description='Hierarchical Bayesian multi-task RL experiments.')
+    parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    COMMANDS[args.command](args.args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+A collapsed Gibbs sampler for the Dirichlet process mixture of MDP classes from
+Wilson et al. (ICML'07).
+
+The class means and covariances are integrated out under their Normal-Inverse-Wishart
+prior, so the sampler only tracks the class assignments and the weights of each MDP.
+Assignments are drawn from the NIW posterior predictive (a multivariate Student-t),
+which only depends on per-cluster sufficient statistics of the weights.
+
+The weights of an MDP are drawn exactly by data augmentation: a class mean and
+covariance are drawn from the NIW posterior of its cluster (including the MDP's
+current weights), then the weights from their Gaussian posterior given that class
+and the MDP's rewards, and the class draw is discarded.
+"""
+import math
+import numpy as np
+from scipy.special import gammaln, multigammaln
+from multitask import MdpClass, categorical_sample, sample_niw_batch
+
+class ClusterStatistics(object):
+    """
+    Sufficient statistics (count, sum and sum of outer products) of the weights
+    assigned to one cluster. Adding or removing an MDP is O(d^2); the factorisation
+    of the predictive distribution is only recomputed when it is next needed.
+    """
+    def __init__(self, prior):
+        self.prior = prior
+        d = prior.mu.shape[0]
+        self.count = 0
+        self.total = np.zeros(d)
+        self.outer = np.zeros((d, d))
+        self.params = None
+        self.predictive = None
+
+    def add(self, weights):
+        self.count += 1
+        self.total += weights
+        self.outer += np.outer(weights, weights)
+        self.params = None
+        self.predictive = None
+
+    def remove(self, weights):
+        self.count -= 1
+        self.total -= weights
+        self.outer -= np.outer(weights, weights)
+        self.params = None
+        self.predictive = None
+
+    def posterior_params(self):
+        """
+        Returns the (mu, lambda, nu, psi) parameters of the NIW posterior.
+        """
+        if self.params is None:
+            p = self.prior
+            lmbda_n = p.lmbda + self.count
+            nu_n = p.nu + self.count
+            mu_n = (p.lmbda * p.mu + self.total) / lmbda_n
+            psi_n = p.psi + self.outer + p.lmbda * np.outer(p.mu, p.mu) - lmbda_n * np.outer(mu_n, mu_n)
+            self.params = (mu_n, lmbda_n, nu_n, psi_n)
+        return self.params
+
+    def predictive_params(self):
+        """
+        Returns the (dof, location, cholesky of scale, log-det of scale) parameters of
+        the multivariate Student-t posterior predictive.
+        """
+        if self.predictive is None:
+            (mu_n, lmbda_n, nu_n, psi_n) = self.posterior_params()
+            d = mu_n.shape[0]
+            dof = nu_n - d + 1
+            scale = psi_n * (lmbda_n + 1) / (lmbda_n * dof)
+            chol = np.linalg.cholesky(scale)
+            log_det = 2. * np.sum(np.log(np.diag(chol)))
+            self.predictive = (dof, mu_n, chol, log_det)
+        return self.predictive
+
+    def log_predictive(self, weights):
+        (dof, mu, chol, log_det) = self.predictive_params()
+        d = mu.shape[0]
+        z = np.linalg.solve(chol, weights - mu)
+        return gammaln(0.5 * (dof + d)) - gammaln(0.5 * dof) - 0.5 * d * math.log(dof * math.pi) \
+                - 0.5 * log_det - 0.5 * (dof + d) * math.log(1. + np.dot(z, z) / dof)
+
+    def sample_class(self):
+        """
+        Returns the (mean, precision) of a class drawn from the NIW posterior.
+        """
+        (mu_n, lmbda_n, nu_n, psi_n) = self.posterior_params()
+        (means, covs, precisions, cholesky) = sample_niw_batch(mu_n[None,:], np.array([lmbda_n]), np.array([nu_n]), psi_n[None,:,:])
+        return (means[0], precisions[0])
+
+    def log_marginal_likelihood(self):
+        """
+        Returns the log-probability of all weights in the cluster under the NIW prior.
+        """
+        p = self.prior
+        (mu_n, lmbda_n, nu_n, psi_n) = self.posterior_params()
+        d = mu_n.shape[0]
+        return -0.5 * self.count * d * math.log(math.pi) \
+                + multigammaln(0.5 * nu_n, d) - multigammaln(0.5 * p.nu, d) \
+                + 0.5 * p.nu * np.linalg.slogdet(p.psi)[1] - 0.5 * nu_n * np.linalg.slogdet(psi_n)[1] \
+                + 0.5 * d * (math.log(p.lmbda) - math.log(lmbda_n))
+
+    def to_class(self, class_id):
+        """
+        Returns an MdpClass with the posterior mean class parameters.
+        """
+        (mu_n, lmbda_n, nu_n, psi_n) = self.posterior_params()
+        d = mu_n.shape[0]
+        return MdpClass(class_id, mu_n, psi_n / float(nu_n - d - 1))
+
+class CollapsedGibbsSampler(object):
+    """
+    Samples class assignments and MDP weights with the class parameters integrated out.
+    Produces the same (classes, assignments, counts, weights) summary as the explicit
+    sampler in MultiTaskBayesianAgent.update_beliefs.
+    """
+    def __init__(self, prior, alpha, reward_stdev, iterations=500, burn_in=100, thin=1):
+        assert(iterations > burn_in)
+        self.prior = prior
+        self.alpha = alpha
+        self.reward_stdev = reward_stdev
+        self.iterations = iterations
+        self.burn_in = burn_in
+        self.thin = thin
+
+    def fit(self, statistics):
+        """
+        Runs the sampler over the reward statistics of every MDP and returns the MAP
+        sample as (classes, assignments, assignment_counts, weights).
+        """
+        # Start with every MDP in its own cluster: merging clusters is far more likely
+        # than splitting one off under a vague prior, so this mixes much faster.
+        empty = ClusterStatistics(self.prior)
+        weights = []
+        for s in statistics:
+            (mean, precision) = empty.sample_class()
+            weights.append(s.sample_posterior(mean, precision, self.reward_stdev))
+        assignments = range(len(statistics))
+        clusters = [ClusterStatistics(self.prior) for _ in statistics]
+        for c,w in zip(clusters, weights):
+            c.add(w)
+        max_likelihood = None
+        for iteration in range(self.iterations):
+            # Sample class assignments
+            for j,w in enumerate(weights):
+                a = assignments[j]
+                clusters[a].remove(w)
+                if clusters[a].count == 0:
+                    # Drop the empty cluster and shift the IDs above it down.
+                    del clusters[a]
+                    assignments = [x - 1 if x > a else x for x in assignments]
+                log_probs = [math.log(c.count) + c.log_predictive(w) for c in clusters]
+                log_probs.append(math.log(self.alpha) + empty.log_predictive(w))
+                chosen = categorical_sample(log_probs)
+                if chosen == len(clusters):
+                    clusters.append(ClusterStatistics(self.prior))
+                assignments[j] = chosen
+                clusters[chosen].add(w)
+            # Sample weights given a class drawn from their cluster's posterior
+            for j,s in enumerate(statistics):
+                c = clusters[assignments[j]]
+                (mean, precision) = c.sample_class()
+                c.remove(weights[j])
+                weights[j] = s.sample_posterior(mean, precision, self.reward_stdev)
+                c.add(weights[j])
+            if iteration >= self.burn_in and (iteration - self.burn_in) % self.thin == 0:
+                log_likelihood = self.log_likelihood(statistics, clusters, weights)
+                if max_likelihood is None or log_likelihood > max_likelihood:
+                    max_likelihood = log_likelihood
+                    map_sample = ([c.to_class(k) for k,c in enumerate(clusters)], list(assignments),
+                                  [c.count for c in clusters], list(weights))
+        print 'Collapsed MAP Distribution: {0} (log-likelihood: {1})'.format(map_sample[2], max_likelihood)
+        return map_sample
+
+    def log_likelihood(self, statistics, clusters, weights):
+        """
+        Returns the joint log-probability of the partition, the weights and the rewards,
+        ignoring constants.
+        """
+        n = sum(c.count for c in clusters)
+        log_likelihood = len(clusters) * math.log(self.alpha) + gammaln(self.alpha) - gammaln(self.alpha + n)
+        log_likelihood += sum(gammaln(c.count) + c.log_marginal_likelihood() for c in clusters)
+        log_likelihood += sum(s.log_likelihood(w, self.reward_stdev) for s,w in zip(statistics, weights))
+        return log_likelihood
@@ -0,0 +1,369 @@
+"""
+Runs the training window experiment (test_training_window.py) across many worker
+processes, on one machine or many.
+
+The coordinator splits the experiment into work units of (agent config, test-domain
+range). Every unit carries the experiment arguments, including a seed, so a worker
+regenerates exactly the same training and test domains. The training of each agent
+config is seeded by the config alone, so every worker trains the same agent; a worker
+trains it once, keeps it, and tests a copy of it on the range of test domains of each
+unit, sending back a CurveAggregator. Unlike a single-process run, where one agent
+goes through all the test domains in turn, each copy starts from the trained agent
+and carries nothing over from the test domains of other units. The coordinator merges the aggregators of each agent as
+they arrive, keeps live CSVs up to date and writes the usual results at the end.
+
+Workers connect to the coordinator with multiprocessing.connection (TCP plus a shared
+authkey) and ask for units one at a time. A unit is leased to the worker that holds
+it: the worker sends heartbeats while it runs the unit, and the unit goes back on the
+queue if the worker disconnects, stops sending heartbeats or fails on it. A unit
+that fails max_attempts times fails the run. If a unit ends up being completed
+twice, only the first result is merged.
+
+    hbayes-rl coordinator --bind 0.0.0.0:6000 --authkey secret -- multibayes --trainsize 4 --seed 1
+    hbayes-rl worker coordinator-host:6000 --authkey secret
+
+or, with local workers only:
+
+    hbayes-rl coordinator --localworkers 4 -- multibayes --trainsize 4
+"""
+import argparse
+import collections
+import copy
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener, Client
+from aggregation import CurveAggregator
+
+HEARTBEAT_INTERVAL = 5.
+
+class Coordinator(object):
+    def __init__(self, args, address=('localhost', 0), authkey='hbayes-rl', unit_size=10, lease=60., max_attempts=3):
+        import test_training_window
+        self.args = args
+        if args.seed is None:
+            # All workers must generate the same domains
+            args.seed = random.randrange(2**31)
+        self.authkey = authkey
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.header = ['StepTimes{0}'.format(args.stepsize), 'Avg', 'Stdev', 'Stderr']
+        self.configs = test_training_window.agent_configs(args)
+        self.units = []
+        for c,(atype, mdps) in enumerate(self.configs):
+            for start in range(0, args.testsize, unit_size):
+                self.units.append({'id': len(self.units), 'config': c, 'agent': atype, 'trainsize': mdps,
+                                   'start': start, 'end': min(start + unit_size, args.testsize), 'args': args})
+        self.queue = collections.deque(u['id'] for u in self.units)
+        self.leases = {}
+        self.attempts = [0] * len(self.units)
+        self.done = set()
+        self.failed = {}
+        self.aggregates = [CurveAggregator(args.teststeps / args.stepsize) for _ in self.configs]
+        self.names = [None] * len(self.configs)
+        self.lock = threading.Condition()
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+
+    def finished(self):
+        return len(self.done) + len(self.failed) == len(self.units)
+
+    def run(self):
+        """
+        Serves work units until every unit is done (or has failed), then writes the
+        results and returns the path of the manifest.
+        """
+        start = time.time()
+        for target in [self.accept_loop, self.lease_loop]:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        print 'Coordinator listening on {0}:{1} with {2} units'.format(self.address[0], self.address[1], len(self.units))
+        with self.lock:
+            while not self.finished():
+                self.lock.wait(1.)
+        print 'All units finished in {0:.1f}s'.format(time.time() - start)
+        if len(self.failed) > 0:
+            for unit_id,error in sorted(self.failed.items()):
+                print 'Unit {0} failed:\n{1}'.format(unit_id, error)
+            raise Exception('{0} work units failed.'.format(len(self.failed)))
+        from results import save_results
+        series = [(name, self.header, a.rows()) for name,a in zip(self.names, self.aggregates)]
+        self.remove_live()
+        return save_results(self.args.output, 'training_window', self.args, series)
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                # e.g. a client with the wrong authkey
+                continue
+            t = threading.Thread(target=self.serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def lease_loop(self):
+        """
+        Puts units whose lease expired back on the queue.
+        """
+        while True:
+            time.sleep(1.)
+            with self.lock:
+                now = time.time()
+                for unit_id,(worker, deadline) in self.leases.items():
+                    if deadline < now:
+                        print 'Lease of unit {0} held by {1} expired'.format(unit_id, worker)
+                        self.release(unit_id, 'Lease expired')
+
+    def serve(self, conn):
+        """
+        Handles the messages of one worker connection.
+        """
+        worker = None
+        try:
+            while True:
+                message = conn.recv()
+                kind = message['type']
+                if kind == 'hello':
+                    worker = message['worker']
+                    print 'Worker {0} connected'.format(worker)
+                elif kind == 'request':
+                    conn.send(self.next_unit(worker))
+                elif kind == 'heartbeat':
+                    with self.lock:
+                        # A worker whose lease expired may still send heartbeats
+                        # after the unit was leased to another worker
+                        if message['unit'] in self.leases and self.leases[message['unit']][0] == worker:
+                            self.leases[message['unit']] = (worker, time.time() + self.lease)
+                elif kind == 'result':
+                    self.complete(worker, message['unit'], message['name'], message['aggregate'])
+                elif kind == 'error':
+                    print 'Worker {0} failed on unit {1}'.format(worker, message['unit'])
+                    with self.lock:
+                        if message['unit'] in self.leases and self.leases[message['unit']][0] == worker:
+                            self.release(message['unit'], message['traceback'])
+        except (EOFError, IOError, socket.error):
+            pass
+        # The worker is gone: its units go back on the queue.
+        with self.lock:
+            for unit_id,(holder, deadline) in self.leases.items():
+                if holder == worker:
+                    print 'Worker {0} disconnected while holding unit {1}'.format(worker, unit_id)
+                    self.release(unit_id, 'Worker disconnected')
+        conn.close()
+
+    def next_unit(self, worker):
+        with self.lock:
+            if self.finished():
+                return {'type': 'done'}
+            if len(self.queue) == 0:
+                # Units are still leased; ask again in case one comes back.
+                return {'type': 'wait', 'seconds': 1.}
+            unit_id = self.queue.popleft()
+            self.attempts[unit_id] += 1
+            self.leases[unit_id] = (worker, time.time() + self.lease)
+            return {'type': 'unit', 'unit': self.units[unit_id]}
+
+    def release(self, unit_id, error):
+        """
+        Ends the lease of a unit and queues it again, unless it ran out of attempts.
+        Must be called with the lock held.
+        """
+        del self.leases[unit_id]
+        if unit_id in self.done:
+            return
+        if self.attempts[unit_id] >= self.max_attempts:
+            self.failed[unit_id] = error
+            self.lock.notify_all()
+        else:
+            self.queue.append(unit_id)
+
+    def complete(self, worker, unit_id, name, aggregate):
+        with self.lock:
+            self.leases.pop(unit_id, None)
+            if unit_id in self.done or unit_id in self.failed:
+                return
+            self.done.add(unit_id)
+            self.queue = collections.deque(u for u in self.queue if u != unit_id)
+            unit = self.units[unit_id]
+            self.names[unit['config']] = name
+            self.aggregates[unit['config']].merge(aggregate)
+            self.write_live(unit['config'])
+            print '[{0}/{1}] {2} tests {3}-{4} from {5}'.format(len(self.done), len(self.units), name, unit['start'], unit['end'], worker)
+            self.lock.notify_all()
+
+    def live_path(self, config):
+        return os.path.join(self.args.output, 'live_agent_{0}.csv'.format(config+1))
+
+    def write_live(self, config):
+        if not os.path.exists(self.args.output):
+            os.makedirs(self.args.output)
+        self.aggregates[config].write_csv(self.live_path(config), self.header)
+
+    def remove_live(self):
+        for c in range(len(self.configs)):
+            if os.path.exists(self.live_path(c)):
+                os.remove(self.live_path(c))
+
+class Heartbeat(threading.Thread):
+    """
+    Tells the coordinator that a unit is still being worked on.
+    """
+    def __init__(self, conn, send_lock, unit_id):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.conn = conn
+        self.send_lock = send_lock
+        self.unit_id = unit_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            with self.send_lock:
+                self.conn.send({'type': 'heartbeat', 'unit': self.unit_id})
+
+    def stop(self):
+        self.stopped.set()
+
+# The domains of the last experiment a worker ran, which most units share
+_domains = {}
+# The trained agents of this worker, by agent config
+_agents = {}
+
+def run_unit(unit):
+    """
+    Tests a copy of the trained agent of the unit's config on the unit's test domains,
+    training it first if this worker has not yet. Returns the agent name and a
+    CurveAggregator of the test curves.
+    """
+    import numpy as np
+    import test_training_window as experiment
+    args = unit['args']
+    key = repr(sorted(vars(args).items()))
+    if key not in _domains:
+        # Free the shared buffers of the previous experiment's domains
+        for (chosen_train, train_domains, test_domains, store) in _domains.values():
+            if store is not None:
+                store.release()
+        _domains.clear()
+        _agents.clear()
+        _domains[key] = experiment.build_domains(args)
+    (chosen_train, train_domains, test_domains, store) = _domains[key]
+    if unit['config'] not in _agents:
+        # Every config trains on its own, reproducible random stream
+        random.seed(args.seed * 104729 + unit['config'])
+        np.random.seed((args.seed * 104729 + unit['config']) % 2**32)
+        unit_args = copy.copy(args)
+        unit_args.agents = [unit['agent']]
+        unit_args.trainsize = [unit['trainsize']]
+        (agent, training) = experiment.get_agents(unit_args)[0]
+        experiment.train_agent(agent, training, train_domains, args)
+        # Copies must not share the background worker of an --async agent
+        agent.close()
+        _agents[unit['config']] = (agent, training)
+    (trained, training) = _agents[unit['config']]
+    agent = copy.deepcopy(trained)
+    # Every unit tests on its own, reproducible random stream
+    random.seed(args.seed * 7919 + unit['id'])
+    np.random.seed((args.seed * 7919 + unit['id']) % 2**32)
+    aggregate = CurveAggregator(args.teststeps / args.stepsize)
+    for domain in test_domains[unit['start']:unit['end']]:
+        aggregate.add(experiment.test_agent(agent, training, domain, args))
+    agent.close()
+    return (agent.name, aggregate)
+
+def worker(address, authkey='hbayes-rl', name=None, quiet=True):
+    """
+    Runs work units from the coordinator at address until there are none left.
+    """
+    if name is None:
+        name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    conn = Client(address, authkey=authkey)
+    send_lock = threading.Lock()
+    def send(message):
+        with send_lock:
+            conn.send(message)
+    send({'type': 'hello', 'worker': name})
+    stdout = sys.stdout
+    while True:
+        try:
+            send({'type': 'request'})
+            message = conn.recv()
+        except (EOFError, IOError, socket.error):
+            # The coordinator is gone, so there is nothing left to do
+            break
+        if message['type'] == 'done':
+            break
+        if message['type'] == 'wait':
+            time.sleep(message['seconds'])
+            continue
+        unit = message['unit']
+        heartbeat = Heartbeat(conn, send_lock, unit['id'])
+        heartbeat.start()
+        if quiet:
+            # The agents print a lot; keep the worker's output readable
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            (agent_name, aggregate) = run_unit(unit)
+            reply = {'type': 'result', 'unit': unit['id'], 'name': agent_name, 'aggregate': aggregate}
+        except Exception:
+            reply = {'type': 'error', 'unit': unit['id'], 'traceback': traceback.format_exc()}
+        finally:
+            if quiet:
+                sys.stdout.close()
+                sys.stdout = stdout
+            heartbeat.stop()
+            heartbeat.join()
+        try:
+            send(reply)
+        except (EOFError, IOError, socket.error):
+            break
+    conn.close()
+
+def parse_address(text):
+    (host, port) = text.rsplit(':', 1)
+    return (host, int(port))
+
+def run_coordinator(argv):
+    import test_training_window
+    parser = argparse.ArgumentParser(prog='hbayes-rl coordinator', description='Serves the work units of a training window experiment to workers.')
+    parser.add_argument('--bind', default='localhost:0', help='The host:port to listen on. Port 0 picks a free port.')
+    parser.add_argument('--authkey', default='hbayes-rl', help='The key workers must present.')
+    parser.add_argument('--unitsize', type=int, default=10, help='The number of test domains per work unit. Each unit tests a copy of the trained agent, so the agent does not carry over what it learns between units.')
+    parser.add_argument('--lease', type=float, default=60., help='The seconds without a heartbeat after which a unit is handed out again.')
+    parser.add_argument('--attempts', type=int, default=3, help='The number of times a unit is tried before the run fails.')
+    parser.add_argument('--localworkers', type=int, default=0, help='The number of workers to start on this machine.')
+    parser.add_argument('experiment', nargs=argparse.REMAINDER, help='The arguments of the training window experiment, after --.')
+    args = parser.parse_args(argv)
+    experiment_argv = args.experiment[1:] if args.experiment[:1] == ['--'] else args.experiment
+    experiment_args = test_training_window.build_parser(argparse.ArgumentParser(prog='hbayes-rl coordinator --')).parse_args(experiment_argv)
+    coordinator = Coordinator(experiment_args, address=parse_address(args.bind), authkey=args.authkey, unit_size=args.unitsize,
+                              lease=args.lease, max_attempts=args.attempts)
+    workers = [multiprocessing.Process(target=worker, args=(coordinator.address, args.authkey)) for _ in range(args.localworkers)]
+    for w in workers:
+        w.start()
+    manifest = coordinator.run()
+    for w in workers:
+        w.join()
+    print 'Results written to {0}'.format(manifest)
+    return manifest
+
+def run_worker(argv):
+    parser = argparse.ArgumentParser(prog='hbayes-rl worker', description='Runs work units from a coordinator.')
+    parser.add_argument('address', help='The host:port of the coordinator.')
+    parser.add_argument('--authkey', default='hbayes-rl', help='The key of the coordinator.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the agents.')
+    args = parser.parse_args(argv)
+    worker(parse_address(args.address), authkey=args.authkey, quiet=not args.verbose)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        run_worker(sys.argv[2:])
+    else:
+        run_coordinator(sys.argv[1:])
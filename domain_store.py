@@ -0,0 +1,115 @@
+"""
+A store that keeps the arrays of many grid worlds in shared memory, so worker
+processes can use the domains without each getting its own copy.
+
+The colour grids, feature tensors, cell means, weights and goals of all domains are
+stacked into one RawArray each (compact domains have no feature tensor). Worlds handed out by the store are views over slices
+of those buffers. A view pickles as (store, index) plus its small episode state, so
+sending a domain to a worker process (e.g. the snapshots of an asynchronous agent,
+or the tasks of a pool) costs a few bytes instead of the whole feature tensor.
+
+RawArrays are only shared through inheritance: a worker can only resolve a view if it
+was forked after the store was created, so create worker pools after the store.
+"""
+import ctypes
+import itertools
+import os
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+from gridworld import GridWorld
+
+# Stores by ID. Forked workers inherit this registry along with the buffers.
+_stores = {}
+_store_ids = itertools.count()
+
+def shared_array(shape, dtype):
+    """
+    Returns a numpy array of zeros with the given shape, backed by shared memory.
+    """
+    ctype = {np.dtype(np.float64): ctypes.c_double, np.dtype(np.int32): ctypes.c_int32, np.dtype(np.int8): ctypes.c_int8}[np.dtype(dtype)]
+    raw = RawArray(ctype, int(np.prod(shape)))
+    return np.ctypeslib.as_array(raw).reshape(shape)
+
+class DomainStore(object):
+    """
+    Holds the arrays of a list of GridWorlds (all of the same size and number of
+    colors) in shared memory. The original worlds can be dropped once the store
+    is built; store.domain(i) returns a view of domain i.
+    """
+    def __init__(self, domains):
+        assert(len(domains) > 0)
+        first = domains[0]
+        n = len(domains)
+        (width, height) = first.cell_colors.shape
+        size = len(first.color_location_weights)
+        self.compact = first.compact
+        for d in domains:
+            assert(d.cell_colors.shape == (width, height) and len(d.color_location_weights) == size)
+            assert(d.compact == self.compact)
+        self.store_id = (os.getpid(), next(_store_ids))
+        self.weights = shared_array((n, size), np.float64)
+        self.cell_colors = shared_array((n, width, height), np.int8 if self.compact else np.int32)
+        self.cell_states = None if self.compact else shared_array((n, width, height, size), np.float64)
+        self.cell_means = shared_array((n, width, height), np.float64)
+        self.goals = shared_array((n, 2), np.int32)
+        self.starts = shared_array((n, 2), np.int32)
+        for i,d in enumerate(domains):
+            self.weights[i] = d.color_location_weights
+            self.cell_colors[i] = d.cell_colors
+            if not self.compact:
+                self.cell_states[i] = d.cell_states
+            self.cell_means[i] = d.cell_means
+            self.goals[i] = d.goal
+            self.starts[i] = d.start_location
+        # Small per-domain settings stay in ordinary lists
+        self.task_ids = [d.task_id for d in domains]
+        self.reward_stdevs = [d.reward_stdev for d in domains]
+        self.max_moves = [d.max_moves for d in domains]
+        self.slips = [d.slip for d in domains]
+        for a in [self.weights, self.cell_colors, self.cell_states, self.cell_means, self.goals, self.starts]:
+            if a is not None:
+                a.flags.writeable = False
+        _stores[self.store_id] = self
+
+    def __len__(self):
+        return len(self.task_ids)
+
+    def domain(self, i, agent=None):
+        """
+        Returns a GridWorld view of domain i. The view has its own episode state but
+        shares the (read-only) cell arrays with every other view of the domain.
+        """
+        cell_states = None if self.compact else self.cell_states[i]
+        view = DomainView.from_arrays(self.task_ids[i], self.weights[i], self.cell_colors[i], cell_states, self.cell_means[i],
+                                      reward_stdev=self.reward_stdevs[i], agent=agent, max_moves=self.max_moves[i],
+                                      start=tuple(int(x) for x in self.starts[i]), goal=tuple(int(x) for x in self.goals[i]), slip=self.slips[i])
+        view.store_id = self.store_id
+        view.index = i
+        return view
+
+    def domains(self):
+        return [self.domain(i) for i in range(len(self))]
+
+    def release(self):
+        """
+        Removes the store from the registry. Existing views keep the buffers alive.
+        """
+        _stores.pop(self.store_id, None)
+
+    def __getstate__(self):
+        raise Exception('A DomainStore is shared by forking, not pickling. Create worker pools after the store.')
+
+def load_view(store_id, index):
+    if store_id not in _stores:
+        raise Exception('Unknown domain store {0}: the process was not forked after the store was created.'.format(store_id))
+    return _stores[store_id].domain(index)
+
+class DomainView(GridWorld):
+    """
+    A GridWorld over the buffers of a DomainStore.
+    """
+    ARRAYS = ['color_location_weights', 'cell_colors', 'cell_states', 'cell_means']
+
+    def __reduce__(self):
+        state = dict((k, v) for k,v in self.__dict__.items() if k not in DomainView.ARRAYS and k not in ['store_id', 'index'])
+        return (load_view, (self.store_id, self.index), state)
@@ -0,0 +1,84 @@
+"""
+Exact evaluation of policies on grid worlds with known cell means.
+
+The default grid world transitions are deterministic, so a stationary policy induces
+a single path from the start location: it either reaches the goal or falls into a
+cycle within width x height steps. The expected return of an episode is then the
+sum of the true cell means along that path, with no reward noise and no sampling.
+Agents without a policy yet act uniformly at random, and worlds with a slip
+probability move at random; their expected return is computed by propagating the
+state distribution of the induced Markov chain (see sparse_solver.py).
+"""
+import numpy as np
+
+def policy_snapshot(agent, idx):
+    """
+    Returns the (width x height) array of actions the agent currently follows in
+    domain idx, or None if it acts at random. The Bayesian agents keep their policy;
+    Q-Learning is evaluated on its greedy policy.
+    """
+    if hasattr(agent, 'policy'):
+        return agent.policy
+    if hasattr(agent, 'get_policy'):
+        return agent.get_policy(idx)[0]
+    return None
+
+def deterministic_return(world, policy, max_moves, cell_means=None):
+    """
+    Returns the return of an episode that follows the policy from the start location
+    for up to max_moves moves, ending at the goal. Walks the path only until it
+    reaches the goal or repeats a cell; the rest of a cycle is summed in closed form.
+    """
+    if cell_means is None:
+        cell_means = world.cell_means
+    means = np.asarray(cell_means).ravel()
+    successors = world.successors(policy)
+    goal = world.goal[0] * world.height + world.goal[1]
+    cell = world.start_location[0] * world.height + world.start_location[1]
+    visited = {}
+    path = []
+    while len(path) < max_moves:
+        cell = successors[cell]
+        if cell in visited:
+            # The path cycles forever: add the remaining full cycles and the leftover part
+            cycle = np.array(path[visited[cell]:])
+            prefix = means[np.array(path)].sum()
+            (repeats, leftover) = divmod(max_moves - len(path), len(cycle))
+            return prefix + repeats * means[cycle].sum() + means[cycle[:leftover]].sum()
+        visited[cell] = len(path)
+        path.append(cell)
+        if cell == goal:
+            break
+    return means[np.array(path)].sum() if len(path) > 0 else 0.
+
+def chain_return(world, policy, max_moves, cell_means=None, tolerance=1e-12):
+    """
+    Returns the expected return of an episode of up to max_moves moves under the
+    policy (None for uniformly random moves) and the world's slip probability.
+    """
+    from sparse_solver import transition_matrices, policy_matrix
+    if cell_means is None:
+        cell_means = world.cell_means
+    means = np.asarray(cell_means).ravel()
+    # The goal row is empty, so episodes that reached the goal drop out of the chain
+    transitions = policy_matrix(transition_matrices(world.width, world.height, world.goal, world.slip), policy).T.tocsr()
+    dist = np.zeros(world.width * world.height)
+    dist[world.start_location[0] * world.height + world.start_location[1]] = 1.
+    total = 0.
+    for move in range(max_moves):
+        dist = transitions.dot(dist)
+        total += np.dot(dist, means)
+        if dist.sum() < tolerance:
+            break
+    return total
+
+def expected_return(world, policy, max_moves=None, cell_means=None):
+    """
+    Returns the exact expected return of one episode in the world under the policy
+    (None for uniformly random moves), by default with the world's true cell means.
+    """
+    if max_moves is None:
+        max_moves = world.max_moves
+    if policy is None or not world.deterministic:
+        return chain_return(world, policy, max_moves, cell_means)
+    return deterministic_return(world, policy, max_moves, cell_means)
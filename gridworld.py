@@ -77,6 +77,30 @@ class Agent(object):
         if len(self.recent_rewards) > 10:
             self.recent_rewards.pop(0)
 
+    def get_plan(self, idx, max_steps):
+        """
+        Returns (policy, steps) if the agent will follow a fixed (width x height) array
+        of actions for its next steps, so the world can roll the steps out in one chunk
+        (see GridWorld.advance). Returns None to be stepped one action at a time.
+        """
+        return None
+
+    def ingest_chunk(self, idx, locations, states, rewards):
+        """
+        Takes the (steps x 2) locations, (steps x features) states and rewards of a
+        chunk rolled out from the plan. The default feeds them through observe_reward
+        and set_state one step at a time; agents can override it to update in bulk.
+        """
+        for (location, state, r) in zip(locations, states, rewards):
+            self.observe_reward(idx, r)
+            self.set_state(idx, (int(location[0]), int(location[1])), state)
+
+    def close(self):
+        """
+        Releases the resources of the agent (e.g. worker processes) once it is done.
+        """
+        pass
+
     def clear_memory(self, idx):
         self.state[idx] = None
         self.total_episodes -= self.domain_episodes[idx]
@@ -84,8 +108,95 @@ class Agent(object):
         self.domains[idx] = None
         self.location[idx] = None
 
+def cell_features(cell_colors, num_colors):
+    """
+    Returns the (width, height, 5 x colors) one-hot features of every cell: the colors
+    of the cell and of its up, down, left and right neighbours. Neighbours outside
+    the grid have no color.
+    """
+    (width, height) = cell_colors.shape
+    features = np.zeros((width, height, NUM_RELATIVE_CELLS * num_colors))
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+    neighbours = [(CURRENT, xs, ys, np.ones((width, height), dtype=bool)),
+                  (UP, xs, ys - 1, ys > 0),
+                  (DOWN, xs, ys + 1, ys < height - 1),
+                  (LEFT, xs - 1, ys, xs > 0),
+                  (RIGHT, xs + 1, ys, xs < width - 1)]
+    for (relative, nx, ny, inside) in neighbours:
+        colors = cell_colors[nx[inside], ny[inside]]
+        features[xs[inside], ys[inside], relative * num_colors + colors] = 1
+    return features
+
+def neighbour_colors(cell_colors, xs, ys):
+    """
+    Returns the compact states of the cells at xs, ys: the int8 colors of each cell and
+    of its up, down, left and right neighbours (in the order of RELATIVE_CELL), with -1
+    for neighbours outside the grid. The result has shape xs.shape + (5,).
+    """
+    (width, height) = cell_colors.shape
+    xs = np.asarray(xs)
+    ys = np.asarray(ys)
+    colors = np.zeros(xs.shape + (NUM_RELATIVE_CELLS,), dtype=np.int8)
+    for (relative, nx, ny) in [(CURRENT, xs, ys), (UP, xs, ys - 1), (DOWN, xs, ys + 1), (LEFT, xs - 1, ys), (RIGHT, xs + 1, ys)]:
+        inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+        colors[..., relative] = np.where(inside, cell_colors[np.clip(nx, 0, width - 1), np.clip(ny, 0, height - 1)], -1)
+    return colors
+
+def is_compact(state):
+    """
+    Whether a state (or an array of states) is in the compact form of neighbour_colors
+    rather than a one-hot feature vector.
+    """
+    return np.asarray(state).dtype.kind == 'i'
+
+def state_indices(states, num_colors):
+    """
+    Returns the one-hot feature index of every entry of compact states, -1 outside the grid.
+    """
+    states = np.asarray(states, dtype=int)
+    return np.where(states >= 0, np.arange(NUM_RELATIVE_CELLS) * num_colors + states, -1)
+
+def dense_states(states, num_colors):
+    """
+    Returns the one-hot features of a state or an array of states, which may be compact.
+    """
+    if not is_compact(states):
+        return states
+    indices = state_indices(states, num_colors)
+    features = np.zeros(indices.shape[:-1] + (NUM_RELATIVE_CELLS * num_colors,))
+    rows = np.indices(indices.shape[:-1])
+    for i in range(NUM_RELATIVE_CELLS):
+        inside = indices[..., i] >= 0
+        features[tuple(r[inside] for r in rows) + (indices[..., i][inside],)] = 1
+    return features
+
+def project_weights(cell_colors, weights):
+    """
+    Returns w . Q of every cell straight from the color grid, without building the
+    features: a (width, height) array for a weight vector, or (width, height, K) for a
+    (d x K) matrix of weight vectors.
+    """
+    weights = np.asarray(weights)
+    num_colors = weights.shape[0] / NUM_RELATIVE_CELLS
+    weights = weights.reshape((NUM_RELATIVE_CELLS, num_colors) + weights.shape[1:])
+    xs, ys = np.meshgrid(np.arange(cell_colors.shape[0]), np.arange(cell_colors.shape[1]), indexing='ij')
+    colors = neighbour_colors(cell_colors, xs, ys)
+    values = 0.
+    for relative in range(NUM_RELATIVE_CELLS):
+        c = colors[..., relative]
+        inside = (c >= 0).reshape(c.shape + (1,) * (weights.ndim - 2))
+        values = values + np.where(inside, weights[relative][np.maximum(c, 0)], 0.)
+    return values
+
 class GridWorld(object):
-    def __init__(self, task_id, color_location_weights, reward_stdev = 2, agent = None, width = 15, height = 15, max_moves = 100, start = (0,0), goal = None):
+    """
+    A grid world domain. By default every cell's one-hot features are kept in the dense
+    (width, height, 5 x colors) cell_states tensor. A compact world (compact=True, or
+    cell_states=None in from_arrays) keeps only an int8 color grid and the cell means,
+    and its states are the compact neighbour colors of neighbour_colors, produced on
+    demand. Agents and models accept either form.
+    """
+    def __init__(self, task_id, color_location_weights, reward_stdev = 2, agent = None, width = 15, height = 15, max_moves = 100, start = (0,0), goal = None, slip = 0., compact = False):
         self.task_id = task_id
         self.color_location_weights = color_location_weights
         # We need one weight for every (loc, color) pair
@@ -96,40 +207,95 @@ class GridWorld(object):
         self.width = width
         self.height = height
         self.max_moves = max_moves
-        self.build_cells()
+        self.build_cells(compact)
         self.start_location = start
         if goal is None:
             goal = (width-1,height-1)
         self.goal = goal
+        # The probability that a move is replaced by a uniformly random one
+        self.slip = slip
         self.episode_running = False
         self.state = None
         self.location = None
+        # An optional TrajectoryRecorder (see trajectory.py) that logs every step
+        self.recorder = None
 
-    def build_cells(self):
+    @classmethod
+    def from_arrays(cls, task_id, color_location_weights, cell_colors, cell_states, cell_means, reward_stdev = 2, agent = None, max_moves = 100, start = (0,0), goal = None, slip = 0.):
+        """
+        Creates a grid world over existing cell arrays instead of generating new cells.
+        The arrays are used as given, not copied, so many worlds can share one buffer.
+        Without cell_states, the world is compact.
+        """
+        world = cls.__new__(cls)
+        world.task_id = task_id
+        world.color_location_weights = color_location_weights
+        world.num_colors = len(color_location_weights) / 5
+        world.reward_stdev = reward_stdev
+        world.agent = agent
+        (world.width, world.height) = cell_colors.shape
+        world.max_moves = max_moves
+        world.cell_colors = cell_colors
+        world.cell_states = cell_states
+        world.cell_means = cell_means
+        world.start_location = start
+        if goal is None:
+            goal = (world.width-1,world.height-1)
+        world.goal = goal
+        world.slip = slip
+        world.episode_running = False
+        world.state = None
+        world.location = None
+        world.recorder = None
+        return world
+
+    @property
+    def deterministic(self):
+        """
+        Whether transition() is deterministic. Only deterministic worlds roll out plans.
+        """
+        return self.slip == 0
+
+    @property
+    def compact(self):
+        return self.cell_states is None
+
+    def build_cells(self, compact=False):
         self.cell_colors = np.array([[random.randrange(self.num_colors) for y in range(self.height)] for x in range(self.width)])
-        self.cell_means = np.zeros((self.width, self.height))
-        self.cell_states = np.zeros((self.width, self.height, len(self.color_location_weights)))
-        for x in range(self.width):
-            for y in range(self.height):
-                #self.cell_states *= 0 # zero out the weights
-                self.cell_states[x,y,CURRENT*self.num_colors + self.cell_colors[x,y]] = 1
-                if y > 0:
-                    self.cell_states[x,y,UP*self.num_colors + self.cell_colors[x,y-1]] = 1
-                if y < (self.height - 1):
-                    self.cell_states[x,y,DOWN*self.num_colors + self.cell_colors[x,y+1]] = 1
-                if x > 0:
-                    self.cell_states[x,y,LEFT*self.num_colors + self.cell_colors[x-1,y]] = 1
-                if x < (self.width - 1):
-                    self.cell_states[x,y,RIGHT*self.num_colors + self.cell_colors[x+1,y]] = 1
-                # mu = w . Q
-                self.cell_means[x,y] = np.dot(self.color_location_weights, self.cell_states[x,y])
+        if compact:
+            assert(self.num_colors <= 127)
+            self.cell_colors = self.cell_colors.astype(np.int8)
+            self.cell_states = None
+        else:
+            self.cell_states = cell_features(self.cell_colors, self.num_colors)
+        # mu = w . Q
+        self.cell_means = self.project(self.color_location_weights)
+
+    def project(self, weights):
+        """
+        Returns w . Q of every cell for a weight vector, or for every column of a (d x K)
+        matrix of weight vectors (with the K values last).
+        """
+        if self.compact:
+            return project_weights(self.cell_colors, weights)
+        return np.dot(self.cell_states, weights)
+
+    def states_at(self, xs, ys):
+        """
+        Returns the states of the cells at xs, ys: compact in a compact world.
+        """
+        if self.compact:
+            return neighbour_colors(self.cell_colors, xs, ys)
+        return self.cell_states[xs, ys]
 
     def start(self):
         self.prev_location = None
         self.location = self.start_location
-        self.state = self.cell_states[self.location]
+        self.state = self.states_at(*self.location)
         self.total_reward = 0
         self.episode_running = True
+        if self.recorder is not None:
+            self.recorder.record_start(self, self.location)
         self.agent.episode_starting(self.task_id, self.location, self.state)
 
     def reward(self, action):
@@ -139,8 +305,11 @@ class GridWorld(object):
         """
         Transition function given an action. The default grid world uses a deterministic
         transition that simply moves the agent where it wants to go, unless it hits a wall.
+        With a slip probability, the move is sometimes replaced by a uniformly random one.
         """
         self.prev_location = self.location
+        if self.slip > 0 and random.random() < self.slip:
+            action = random.choice([UP, DOWN, LEFT, RIGHT])
         if action == UP:
             self.location = (self.location[0], max(0, self.location[1]-1))
         elif action == DOWN:
@@ -149,7 +318,7 @@ class GridWorld(object):
             self.location = (max(0, self.location[0] - 1), self.location[1])
         elif action == RIGHT:
             self.location = (min(self.width-1, self.location[0] + 1), self.location[1])
-        self.state = self.cell_states[self.location]
+        self.state = self.states_at(*self.location)
         
     def step(self):
         assert(self.episode_running)
@@ -157,18 +326,82 @@ class GridWorld(object):
         self.transition(action)
         r = self.reward(action)
         self.total_reward += r
+        if self.recorder is not None:
+            self.recorder.record_step(self, action, self.location, r, self.location == self.goal)
         self.agent.observe_reward(self.task_id, r)
         self.agent.set_state(self.task_id, self.location, self.state)
         if self.location == self.goal:
             self.agent.episode_over(self.task_id)
             self.episode_running = False
 
+    def successors(self, policy):
+        """
+        Returns the flat (x * height + y) index of the cell the agent moves to from every
+        cell when it follows the (width x height) array of actions, as transition() does.
+        """
+        policy = np.asarray(policy).astype(int)
+        xs, ys = np.meshgrid(np.arange(self.width), np.arange(self.height), indexing='ij')
+        xs = np.where(policy == LEFT, np.maximum(0, xs - 1), np.where(policy == RIGHT, np.minimum(self.width - 1, xs + 1), xs))
+        ys = np.where(policy == UP, np.maximum(0, ys - 1), np.where(policy == DOWN, np.minimum(self.height - 1, ys + 1), ys))
+        return (xs * self.height + ys).ravel()
+
+    def rollout(self, policy, steps):
+        """
+        Follows the (width x height) array of actions from the current location for up
+        to steps steps, stopping early at the goal. Returns the (n x 2) visited locations,
+        their (n x features, or n x 5 compact) states and the n rewards, drawn as in reward(). The world's
+        location and the agent are not updated; see advance().
+        """
+        assert(self.deterministic)
+        successors = self.successors(policy)
+        goal = self.goal[0] * self.height + self.goal[1]
+        path = np.zeros(steps, dtype=int)
+        cell = self.location[0] * self.height + self.location[1]
+        n = 0
+        while n < steps:
+            cell = successors[cell]
+            path[n] = cell
+            n += 1
+            if cell == goal:
+                break
+        (xs, ys) = np.divmod(path[:n], self.height)
+        rewards = np.random.normal(self.cell_means[xs, ys], self.reward_stdev)
+        return (np.column_stack((xs, ys)), self.states_at(xs, ys), rewards)
+
+    def advance(self, max_steps):
+        """
+        Takes up to max_steps steps of the running episode and returns the number taken.
+        If the agent offers a plan, the steps are rolled out in one chunk and handed to
+        the agent in one call; otherwise the world takes a single step().
+        """
+        assert(self.episode_running)
+        plan = self.agent.get_plan(self.task_id, max_steps) if self.deterministic else None
+        if plan is None:
+            self.step()
+            return 1
+        (policy, steps) = plan
+        (locations, states, rewards) = self.rollout(policy, min(steps, max_steps))
+        self.prev_location = tuple(int(x) for x in locations[-2]) if len(locations) > 1 else self.location
+        if self.recorder is not None:
+            prev = self.location
+            for (location, r) in zip(locations, rewards):
+                location = (int(location[0]), int(location[1]))
+                self.recorder.record_step(self, int(policy[prev]), location, r, location == self.goal)
+                prev = location
+        self.location = (int(locations[-1][0]), int(locations[-1][1]))
+        self.state = states[-1]
+        self.total_reward += rewards.sum()
+        self.agent.ingest_chunk(self.task_id, locations, states, rewards)
+        if self.location == self.goal:
+            self.agent.episode_over(self.task_id)
+            self.episode_running = False
+        return len(rewards)
+
     def play_episode(self):
         self.start()
-        for i in range(self.max_moves):
-            self.step()
-            if not self.episode_running:
-                break
+        moves = 0
+        while moves < self.max_moves and self.episode_running:
+            moves += self.advance(self.max_moves - moves)
         return self.total_reward
 
     def print_world(self, cell_values=None):
@@ -1,9 +1,12 @@
+import time
 import numpy as np
 from gridworld import *
 
-def value_iteration(width, height, goal, cell_rewards, discount=1.0, convergence=0.01):
+def value_iteration(width, height, goal, cell_rewards, discount=1.0, convergence=0.01, deadline=None):
 	"""
 	An implementation of value iteration to solve a gridworld MDP.
+	If a wall-clock deadline is given, sweeping stops after the first sweep that
+	ends past it and the current (possibly unconverged) values are returned.
 	"""
 	# Create an arbitrary set of starting values (optimistic initialization)
 	cell_values = np.zeros((width, height)) - 1000000
@@ -37,10 +40,13 @@ def value_iteration(width, height, goal, cell_rewards, discount=1.0, convergence
 				# Update the delta if this is bigger than the largest we've seen thus far
 				if cur_delta > delta:
 					delta = cur_delta
+		# Always finish at least one sweep so the values are usable
+		if deadline is not None and time.time() >= deadline:
+			break
 	return cell_values
 
-def value_iteration_to_policy(width, height, goal, cell_rewards, discount=1.0, convergence=0.01):
-	cell_values = value_iteration(width, height, goal, cell_rewards, discount=discount, convergence=convergence)
+def value_iteration_to_policy(width, height, goal, cell_rewards, discount=1.0, convergence=0.01, deadline=None):
+	cell_values = value_iteration(width, height, goal, cell_rewards, discount=discount, convergence=convergence, deadline=deadline)
 	policy = np.zeros((width, height))
 	for x in range(width):
 		for y in range(width):
@@ -69,6 +75,68 @@ def value_iteration_to_policy(width, height, goal, cell_rewards, discount=1.0, c
 			policy[x,y] = max_action
 	return policy
 
+def neighbour_max(scores):
+	"""
+	Returns, for every cell of a (..., width, height) array, the highest score among
+	its up, down, left and right neighbours inside the grid.
+	"""
+	best = np.zeros(scores.shape) - np.inf
+	best[..., 1:, :] = np.maximum(best[..., 1:, :], scores[..., :-1, :])
+	best[..., :-1, :] = np.maximum(best[..., :-1, :], scores[..., 1:, :])
+	best[..., :, 1:] = np.maximum(best[..., :, 1:], scores[..., :, :-1])
+	best[..., :, :-1] = np.maximum(best[..., :, :-1], scores[..., :, 1:])
+	return best
+
+def neighbour_policy(scores):
+	"""
+	Returns the policy that moves every cell of a (width, height) grid to the
+	neighbour with the highest score. Ties are broken as in value_iteration_to_policy.
+	"""
+	(width, height) = scores.shape
+	# Candidate moves in tie-breaking order: the first highest score wins
+	candidates = np.zeros((4, width, height)) - np.inf
+	candidates[0, 1:, :] = scores[:-1, :]
+	candidates[1, :-1, :] = scores[1:, :]
+	candidates[2, :, 1:] = scores[:, :-1]
+	candidates[3, :, :-1] = scores[:, 1:]
+	actions = np.array([LEFT, RIGHT, UP, DOWN], dtype=float)
+	return actions[np.argmax(candidates, axis=0)]
+
+def batch_value_iteration(width, height, goals, cell_rewards, discount=1.0, convergence=0.01, deadline=None):
+	"""
+	Value iteration for many candidate goals at once. Returns a (goals, width, height)
+	tensor holding the values of every cell if the episode ends at each goal.
+	cell_rewards is a (width, height) array shared by all goals, or one per goal.
+	Each sweep updates every goal and cell with array operations; the updates are
+	synchronous, so it takes more sweeps than value_iteration but far less time.
+	"""
+	goals = np.array(goals, dtype=int).reshape(-1, 2)
+	goal_index = np.arange(len(goals))
+	cell_rewards = np.asarray(cell_rewards, dtype=float)
+	# The same optimistic initialization as value_iteration
+	cell_values = np.zeros((len(goals), width, height)) - 1000000
+	cell_values[goal_index, goals[:,0], goals[:,1]] = 0
+	delta = 10000
+	while delta > convergence:
+		new_values = np.maximum(cell_values, neighbour_max(cell_rewards + discount * cell_values))
+		new_values[goal_index, goals[:,0], goals[:,1]] = 0
+		delta = np.abs(new_values - cell_values).max()
+		cell_values = new_values
+		if deadline is not None and time.time() >= deadline:
+			break
+	return cell_values
+
+def mixture_policy(width, height, goals, goal_weights, cell_rewards, discount=1.0, convergence=0.01, deadline=None):
+	"""
+	Returns the policy for a belief over the goal location: every cell moves to the
+	neighbour with the highest reward plus value, averaged over the candidate goals
+	with their belief weights. All goals are solved in one batch_value_iteration.
+	"""
+	cell_rewards = np.asarray(cell_rewards, dtype=float)
+	cell_values = batch_value_iteration(width, height, goals, cell_rewards, discount=discount, convergence=convergence, deadline=deadline)
+	scores = np.tensordot(np.asarray(goal_weights, dtype=float), cell_rewards + discount * cell_values, axes=1)
+	return neighbour_policy(scores)
+
 if __name__ == "__main__":
     agent = Agent(None)
     color_means = (-4,-5,-2,-3)
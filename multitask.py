@@ -3,16 +3,26 @@ from gridworld import *
 from mdp_solver import *
 import math
 import random
-import scipy
-from scipy.stats import chi2
-from mdp_solver import value_iteration_to_policy
+import copy
+import time
+import multiprocessing
+import itertools
+import os
+from mdp_solver import value_iteration_to_policy, mixture_policy, batch_value_iteration, neighbour_policy
+
+# Every MdpClass gets a unique version, so cached posteriors can never be confused
+# between classes; the process ID keeps classes built in worker processes distinct.
+_class_versions = itertools.count()
 
 class MdpClass(object):
-    def __init__(self, class_id, weights_mean, weights_cov):
+    def __init__(self, class_id, weights_mean, weights_cov, inv_weights_cov=None):
         self.class_id = class_id
+        self.version = (os.getpid(), next(_class_versions))
         self.weights_mean = weights_mean
         self.weights_cov = weights_cov
-        self.inv_weights_cov = np.linalg.inv(weights_cov)
+        if inv_weights_cov is None:
+            inv_weights_cov = np.linalg.inv(weights_cov)
+        self.inv_weights_cov = inv_weights_cov
 
     def likelihood(self, weights):
         # Note: we ignore the 1./math.sqrt((2.*math.pi)**self.weights_cov.shape[0]) constant
@@ -25,6 +35,11 @@ class MdpClass(object):
             raise Exception('Multiplier or Exponent < 0 in multivariate normal likelihood function.')
         return multiplier * math.exp(exponent)
 
+    def log_likelihood(self, weights):
+        # Note: we ignore the -0.5*log((2.*math.pi)**self.weights_cov.shape[0]) constant, as in likelihood
+        deviation = weights - self.weights_mean
+        return -0.5 * np.linalg.slogdet(self.weights_cov)[1] - 0.5 * np.dot(np.dot(deviation, self.inv_weights_cov), deviation)
+
     def sample(self):
         return np.random.multivariate_normal(self.weights_mean, self.weights_cov)
 
@@ -34,8 +49,8 @@ class MdpClass(object):
         """
         y = self.inv_weights_cov + np.dot(np.transpose(states), states)
         post_cov = np.linalg.inv(y)
-        post_mean = np.dot(np.linalg.inv(y), np.dot(self.inv_weights_cov, self.weights_mean) + np.dot(np.transpose(states), rewards))
-        return MdpClass(self.class_id, post_mean, post_cov)
+        post_mean = np.dot(post_cov, np.dot(self.inv_weights_cov, self.weights_mean) + np.dot(np.transpose(states), rewards))
+        return MdpClass(self.class_id, post_mean, post_cov, inv_weights_cov=y)
 
     def sample_posterior(self, states, rewards):
         return self.posterior(states, rewards).sample()
@@ -59,13 +74,15 @@ class NormalInverseWishartDistribution(object):
         provides an implementation already.
         """
         if self.norm is None:
+            # scipy is only imported when needed, so short-lived worker processes start quickly
+            from scipy.special import gamma
             d = self.psi.shape[0]
             self.norm  = math.pow(2.0,-0.5*self.nu*d)
             self.norm *= math.pow(np.linalg.det(self.psi),-0.5*self.nu)
             # Self-made multivariate gamma: http://en.wikipedia.org/wiki/Multivariate_gamma_function
             self.norm *= math.pow(math.pi,-0.25*d*(d-1))
             for i in xrange(d):
-                self.norm /= scipy.special.gamma((self.nu + 1 - i) * 0.5)
+                self.norm /= gamma((self.nu + 1 - i) * 0.5)
         return self.norm
 
     def get_log_norm(self):
@@ -73,13 +90,14 @@ class NormalInverseWishartDistribution(object):
         Returns the log of the normalising constant of the distribution.
         """
         if self.log_norm is None:
+            from scipy.special import gamma
             d = self.psi.shape[0]
             self.log_norm  = math.log(2.0) * (-0.5*self.nu*d)
             self.log_norm += math.log(np.linalg.det(self.psi)) * (-0.5*self.nu)
             # Self-made multivariate gamma: http://en.wikipedia.org/wiki/Multivariate_gamma_function
             self.log_norm += math.log(math.pi) * (-0.25*d*(d-1))
             for i in xrange(d):
-                self.log_norm -= math.log(scipy.special.gamma((self.nu + 1 - i) * 0.5))
+                self.log_norm -= math.log(gamma((self.nu + 1 - i) * 0.5))
         return self.log_norm
 
 
@@ -127,6 +145,7 @@ class NormalInverseWishartDistribution(object):
         return (np.random.multivariate_normal(self.mu, sigma / float(self.lmbda)), sigma)
 
     def wishartrand(self):
+        from scipy.stats import chi2
         dim = self.inv_psi.shape[0]
         foo = np.zeros((dim,dim))
 
@@ -154,20 +173,239 @@ class NormalInverseWishartDistribution(object):
     def sample_posterior(self, data):
         return self.posterior(data).sample()
 
-def proportional_selection(proportions, partition=None):
-    if partition is None:
-        partition = sum(proportions)
-    if partition <= 0.:
-        #print 'WARNING: Partition == 0. Using default equal proportion.'.format(proportions)
-        proportions = [1. / len(proportions) for x in proportions]
-    else:
-        proportions = [x / partition for x in proportions]
-    u = random.random()
-    cur = 0.
-    for i,prob in enumerate(proportions):
-        cur += prob
-        if u <= cur:
-            return i
+    def sample_batch(self, m):
+        """
+        Draws m (mean, covariance) pairs at once, reusing the cached Cholesky factor of
+        the inverse scale matrix. See sample_niw_batch.
+        """
+        return sample_niw_batch(np.tile(self.mu, (m, 1)), np.ones(m) * self.lmbda, np.ones(m) * self.nu, None, scale_cholesky=self.cholesky)
+
+def sample_niw_batch(mu, lmbda, nu, psi, scale_cholesky=None):
+    """
+    Draws one (mean, covariance) pair from each of a stack of NIW distributions with
+    parameters mu (K,d), lmbda (K,), nu (K,) and psi (K,d,d), using the Bartlett
+    decomposition for all K Wishart draws at once. The sampled precision and its
+    lower Cholesky factor come straight out of the decomposition. If the lower
+    Cholesky factor of the inverse of psi is already known, it can be given instead
+    of psi as scale_cholesky, either (K,d,d) or one (d,d) factor shared by all K.
+    Returns (means, covs, precisions, precision_cholesky).
+    """
+    (K, d) = mu.shape
+    if scale_cholesky is None:
+        scale_cholesky = np.linalg.cholesky(np.linalg.inv(psi))
+    elif scale_cholesky.ndim == 2:
+        scale_cholesky = np.tile(scale_cholesky, (K, 1, 1))
+    bartlett = np.zeros((K, d, d))
+    rows, cols = np.tril_indices(d, -1)
+    bartlett[:, rows, cols] = np.random.normal(0, 1, size=(K, len(rows)))
+    diag = np.arange(d)
+    bartlett[:, diag, diag] = np.sqrt(np.random.chisquare(nu[:,None] - diag[None,:]))
+    precision_cholesky = np.einsum('kab,kbc->kac', scale_cholesky, bartlett)
+    precisions = np.einsum('kab,kcb->kac', precision_cholesky, precision_cholesky)
+    inv_cholesky = np.linalg.inv(precision_cholesky)
+    covs = np.einsum('kba,kbc->kac', inv_cholesky, inv_cholesky)
+    # mean ~ N(mu, cov / lmbda), and cov = inv(L)' inv(L)
+    noise = np.einsum('kba,kb->ka', inv_cholesky, np.random.normal(0, 1, size=(K, d)))
+    means = mu + noise / np.sqrt(lmbda)[:,None]
+    return (means, covs, precisions, precision_cholesky)
+
+class RewardStatistics(object):
+    """
+    Running sufficient statistics of the (state, reward) observations of one MDP
+    under the linear Gaussian reward model r ~ N(w . Q, reward_stdev^2). Adding an
+    observation is O(d^2) and the statistics never grow with the history length.
+    """
+    def __init__(self, size):
+        self.count = 0
+        self.xtx = np.zeros((size, size))
+        self.xty = np.zeros(size)
+        self.yty = 0.
+
+    def add(self, state, reward):
+        if is_compact(state):
+            self.add_batch(np.asarray(state)[None,:], np.array([reward]))
+            return
+        self.count += 1
+        self.xtx += np.outer(state, state)
+        self.xty += reward * state
+        self.yty += reward * reward
+
+    def add_batch(self, states, rewards):
+        """
+        Adds the rows of a (n x d) state array and their n rewards at once. Compact
+        (n x 5) states only touch the entries of the features they set.
+        """
+        self.count += len(rewards)
+        self.yty += np.dot(rewards, rewards)
+        if is_compact(states):
+            indices = state_indices(states, len(self.xty) / NUM_RELATIVE_CELLS)
+            inside = indices >= 0
+            np.add.at(self.xty, indices[inside], np.repeat(rewards, NUM_RELATIVE_CELLS).reshape(indices.shape)[inside])
+            pairs = inside[:,:,None] & inside[:,None,:]
+            rows = np.repeat(indices[:,:,None], NUM_RELATIVE_CELLS, axis=2)
+            np.add.at(self.xtx, (rows[pairs], np.swapaxes(rows, 1, 2)[pairs]), 1.)
+            return
+        self.xtx += np.dot(states.T, states)
+        self.xty += np.dot(rewards, states)
+
+    def log_likelihood(self, weights, reward_stdev):
+        """
+        Returns the log-likelihood of all observed rewards given the weights, ignoring
+        the normalising constant. Costs O(d^2) regardless of the number of observations.
+        """
+        sum_squares = self.yty - 2. * np.dot(weights, self.xty) + np.dot(weights, np.dot(self.xtx, weights))
+        return -0.5 * sum_squares / reward_stdev ** 2
+
+    def posterior(self, mean, precision, reward_stdev):
+        """
+        Returns the mean and covariance of the Gaussian posterior over the weights,
+        given a N(mean, inv(precision)) prior.
+        """
+        post_precision = precision + self.xtx / reward_stdev ** 2
+        post_cov = np.linalg.inv(post_precision)
+        post_mean = np.dot(post_cov, np.dot(precision, mean) + self.xty / reward_stdev ** 2)
+        return (post_mean, post_cov)
+
+    def sample_posterior(self, mean, precision, reward_stdev):
+        (post_mean, post_cov) = self.posterior(mean, precision, reward_stdev)
+        return np.random.multivariate_normal(post_mean, post_cov)
+
+class AuxillaryPool(object):
+    """
+    The m auxillary classes of one sampling iteration, drawn in a single batch from a
+    base NIW distribution. The precision of every auxillary comes from the sampler,
+    so no covariance is inverted, and MdpClass objects are only built for the
+    auxillaries that get selected.
+    """
+    def __init__(self, base, m, first_id):
+        self.first_id = first_id
+        (self.means, self.covs, self.precisions, self.cholesky) = base.sample_batch(m)
+        self.selected = [None] * m
+
+    def __len__(self):
+        return len(self.selected)
+
+    def available(self, i):
+        return self.selected[i] is None
+
+    def posterior_log_likelihood(self, i, states, rewards, weights):
+        """
+        Returns the log-likelihood of the weights under the posterior of auxillary i given
+        the observations, as MdpClass.posterior(states, rewards).log_likelihood(weights).
+        """
+        y = self.precisions[i] + np.dot(np.transpose(states), states)
+        post_cov = np.linalg.inv(y)
+        post_mean = np.dot(post_cov, np.dot(self.precisions[i], self.means[i]) + np.dot(np.transpose(states), rewards))
+        return MdpClass(self.first_id + i, post_mean, post_cov, inv_weights_cov=y).log_likelihood(weights)
+
+    def get(self, i, class_id=None):
+        """
+        Returns auxillary i as an MdpClass, building it on first use.
+        """
+        if self.selected[i] is None:
+            if class_id is None:
+                class_id = self.first_id + i
+            self.selected[i] = MdpClass(class_id, self.means[i], self.covs[i], inv_weights_cov=self.precisions[i])
+        return self.selected[i]
+
+def categorical_sample(log_weights, size=None):
+    """
+    Samples from the categorical distribution proportional to exp(log_weights).
+    A vector of log-weights gives one index (or an array of `size` indices) via a
+    cumulative sum and searchsorted; a matrix gives one index per row via the
+    Gumbel-max trick. Working in log space, the weights can never underflow to a
+    zero partition. Raises an exception if any log-weight is NaN, or if every
+    log-weight (of a row) is -inf, as there is nothing to sample from.
+    """
+    log_weights = np.asarray(log_weights, dtype=float)
+    if np.isnan(log_weights).any() or not np.isfinite(log_weights.max(axis=-1)).all():
+        raise Exception('Unsupported log-weights: they must not be NaN and at least one must be finite, got {0}'.format(log_weights))
+    if log_weights.ndim == 2:
+        gumbel = -np.log(-np.log(np.random.random(log_weights.shape)))
+        return np.argmax(log_weights + gumbel, axis=1)
+    cumulative = np.cumsum(np.exp(log_weights - log_weights.max()))
+    samples = np.searchsorted(cumulative, np.random.random(size) * cumulative[-1], side='right')
+    if size is None:
+        return int(samples)
+    return samples
+
+def log_sum_exp(log_weights):
+    log_weights = np.asarray(log_weights, dtype=float)
+    m = log_weights.max()
+    return m + math.log(np.sum(np.exp(log_weights - m)))
+
+def log_count(n):
+    """
+    The log of a (CRP) count or proportion, with empty classes at -inf.
+    """
+    if n <= 0:
+        return -np.inf
+    return math.log(n)
+
+class PosteriorCache(object):
+    """
+    Memoizes MdpClass.posterior(states, rewards) for (class, MDP data) pairs. Entries
+    are keyed by the class version and by a data key plus the number of observations
+    behind it, so a posterior is only recomputed when the class parameters or the
+    observations change. Entries are dropped explicitly with invalidate_class and
+    invalidate_data, which keeps the cache from growing with stale classes. The keys
+    are also indexed by class version and by data key, so an invalidation only
+    touches the entries it drops.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.by_class = {}
+        self.by_data = {}
+        self.hits = 0
+        self.misses = 0
+
+    def posterior(self, mdp_class, data_key, states, rewards):
+        key = (mdp_class.version, data_key, len(rewards))
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            result = mdp_class.posterior(states, rewards)
+            self.entries[key] = result
+            self.by_class.setdefault(key[0], set()).add(key)
+            self.by_data.setdefault(key[1], set()).add(key)
+        else:
+            self.hits += 1
+        return result
+
+    def invalidate_class(self, mdp_class):
+        for key in self.by_class.pop(mdp_class.version, ()):
+            del self.entries[key]
+            self.unindex(self.by_data, key[1], key)
+
+    def invalidate_data(self, data_key):
+        for key in self.by_data.pop(data_key, ()):
+            del self.entries[key]
+            self.unindex(self.by_class, key[0], key)
+
+    def unindex(self, index, index_key, key):
+        keys = index[index_key]
+        keys.discard(key)
+        if len(keys) == 0:
+            del index[index_key]
+
+    def clear(self):
+        self.entries = {}
+        self.by_class = {}
+        self.by_data = {}
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.
+        return self.hits / float(total)
+
+    def __getstate__(self):
+        # Posteriors are cheap to rebuild and expensive to pickle; only the counters travel.
+        state = dict(self.__dict__)
+        state['entries'] = {}
+        state['by_class'] = {}
+        state['by_data'] = {}
+        return state
 
 class LinearGaussianRewardModel(object):
     """
@@ -185,47 +423,88 @@ class LinearGaussianRewardModel(object):
         self.burn_in = burn_in
         self.mcmc_samples = mcmc_samples
         self.thin = thin
+        self.budget_hits = 0
         assert(len(classes) == len(assignments))
         self.states = []
         self.rewards = []
-        self.auxillaries = [self.sample_auxillary(len(self.classes) + i) for i in range(self.m)]
-        c = proportional_selection(self.assignments + [self.alpha / self.m for _ in self.auxillaries])
-        self.map_class = (self.classes + self.auxillaries)[c]
+        # The known classes are fixed for the whole MDP, so their posteriors only change
+        # when an observation arrives.
+        self.posterior_cache = PosteriorCache()
+        self.auxillaries = AuxillaryPool(self.auxillary_distribution, self.m, len(self.classes))
+        c = categorical_sample([log_count(x) for x in self.assignments + [self.alpha / self.m for _ in range(self.m)]])
+        self.map_class = self.candidate(c)
         self.weights = self.map_class.sample()
         
 
     def add_observation(self, state, reward):
-        self.states.append(state)
+        self.states.append(dense_states(state, self.weights_size / NUM_RELATIVE_CELLS))
         self.rewards.append(reward)
+        self.posterior_cache.invalidate_data(None)
 
-    def update_beliefs(self):
+    def add_observations(self, states, rewards):
+        self.states.extend(dense_states(states, self.weights_size / NUM_RELATIVE_CELLS))
+        self.rewards.extend(rewards)
+        self.posterior_cache.invalidate_data(None)
+
+    def posterior(self, mdp_class, states, rewards):
+        return self.posterior_cache.posterior(mdp_class, None, states, rewards)
+
+    def new_auxillaries(self):
+        """
+        Replaces the auxillary pool, dropping the cached posteriors of the old auxillaries.
+        """
+        for i in range(len(self.auxillaries)):
+            if not self.auxillaries.available(i):
+                self.posterior_cache.invalidate_class(self.auxillaries.get(i))
+        self.auxillaries = AuxillaryPool(self.auxillary_distribution, self.m, len(self.classes))
+
+    def update_beliefs(self, deadline=None):
         """
         Implements the efficient approximation of Algorithm 2 from Wilson et al.
         described in section 4.4. to update the model parameters during an episode.
+        If a wall-clock deadline is given, sampling stops once it passes and the best
+        sample found so far is used. Returns True if the deadline cut sampling short.
         TODO: Should we be adding auxillary classes inside the MCMC loop?
         """
         states = np.array(self.states)
         rewards = np.array(self.rewards)
         samples = np.zeros(len(self.classes)+self.m)
-        c = proportional_selection(self.assignments + [self.alpha / self.m for _ in self.auxillaries])
-        mdp_class = (self.classes + self.auxillaries)[c]
-        w = mdp_class.sample_posterior(states, rewards)
+        c = categorical_sample([log_count(x) for x in self.assignments + [self.alpha / self.m for _ in range(self.m)]])
+        mdp_class = self.candidate(c)
+        w = self.posterior(mdp_class, states, rewards).sample()
         max_likelihood = None
+        max_burn_in_likelihood = None
+        budget_hit = False
         for i in range(self.mcmc_samples):
-            self.auxillaries = [self.sample_auxillary(len(self.classes) + j) for j in range(self.m)]
+            if deadline is not None and i > 0 and time.time() >= deadline:
+                budget_hit = True
+                break
+            self.new_auxillaries()
             mdp_class = self.sample_assignment(states, rewards, w)
-            w = mdp_class.sample_posterior(states, rewards)
+            # The posterior of the chosen class is reused for the weights and the likelihood
+            posterior = self.posterior(mdp_class, states, rewards)
+            w = posterior.sample()
             if mdp_class.class_id >= len(self.classes):
                 log_likelihood = self.alpha / float(self.m)
             else:
                 log_likelihood = self.assignments[mdp_class.class_id]
-            log_likelihood += mdp_class.posterior(states, rewards).likelihood(w)
+            log_likelihood += posterior.likelihood(w)
             if i >= self.burn_in and i % self.thin == 0:
                 samples[mdp_class.class_id] += 1
                 if max_likelihood is None or log_likelihood > max_likelihood:
                     max_likelihood = log_likelihood
                     map_c = mdp_class
                     map_w = w
+            elif max_likelihood is None and (max_burn_in_likelihood is None or log_likelihood > max_burn_in_likelihood):
+                # Keep the best burn-in sample in case the deadline passes before burn-in ends.
+                max_burn_in_likelihood = log_likelihood
+                burn_in_c = mdp_class
+                burn_in_w = w
+        if budget_hit:
+            self.budget_hits += 1
+        if max_likelihood is None:
+            map_c = burn_in_c
+            map_w = burn_in_w
         extra = ''
         if c != map_c.class_id:
             extra = '--- SWITCHED'
@@ -251,27 +530,36 @@ class LinearGaussianRewardModel(object):
         # Different MAP calculations
         self.map_class = map_c
         self.weights = map_w
+        return budget_hit
 
     def sample_assignment(self, states, rewards, weights):
         """
         Implements Algorithm 3 from the Wilson et al. paper.
         """
-        classes = [c for c in self.classes] # duplicate classes
-        # Calculate likelihood of assigning to a known class
-        assignment_probs = [self.assignments[i] * self.classes[i].posterior(states, rewards).likelihood(weights) for i in range(len(self.classes))]
-        # Calculate likelihood of assigning to a new, unknown class with the default prior
-        for i,aux in enumerate(self.auxillaries):
-            assignment_probs.append(self.alpha / float(self.m) * aux.posterior(states, rewards).likelihood(weights))
-            classes.append(aux) # add auxillary classes to the list of options
+        # Calculate log-likelihood of assigning to a known class
+        log_probs = [log_count(self.assignments[i]) + self.posterior(self.classes[i], states, rewards).log_likelihood(weights) for i in range(len(self.classes))]
+        # Calculate log-likelihood of assigning to a new, unknown class with the default prior
+        log_probs += [math.log(self.alpha / float(self.m)) + self.auxillaries.posterior_log_likelihood(i, states, rewards, weights) for i in range(self.m)]
         # Sample an assignment proportional to the likelihoods
-        return classes[proportional_selection(assignment_probs)]
+        return self.candidate(categorical_sample(log_probs))
 
-    def sample_auxillary(self, class_id):
-        (mean, cov) = self.auxillary_distribution.sample()
-        return MdpClass(class_id, mean, cov)
+    def candidate(self, c):
+        """
+        Returns candidate class c: a known class, or an auxillary past the known ones.
+        """
+        if c < len(self.classes):
+            return self.classes[c]
+        return self.auxillaries.get(c - len(self.classes))
 
     def sample_weights(self, states, rewards):
-        return self.map_class.sample_posterior(states, rewards)
+        return self.posterior(self.map_class, states, rewards).sample()
+
+    def sample_weight_batch(self, k):
+        """
+        Returns k (k x d) samples of the weights from their posterior under the MAP class.
+        """
+        posterior = self.posterior(self.map_class, np.array(self.states), np.array(self.rewards))
+        return np.random.multivariate_normal(posterior.weights_mean, posterior.weights_cov, k)
 
 
 class MultiTaskBayesianAgent(Agent):
@@ -282,7 +570,7 @@ class MultiTaskBayesianAgent(Agent):
     TODO: Currently the agent assumes all MDPs are observed sequentially. Extending the
     algorithm to handle multiple, simultaneous MDPs may require non-trivial changes.
     """
-    def __init__(self, width, height, num_colors, num_domains, reward_stdev, name=None, steps_per_policy=10, num_auxillaries=2, alpha=0.5, goal_known=True, burn_in=100, mcmc_samples=500, thin=1):
+    def __init__(self, width, height, num_colors, num_domains, reward_stdev, name=None, steps_per_policy=10, num_auxillaries=2, alpha=0.5, goal_known=True, burn_in=100, mcmc_samples=500, thin=1, async_updates=False, max_staleness=None, policy_budget=None, budget_split=0.5, inference='gibbs', reward_model='mcmc', goal_candidates=25, goal_prior=1., planning='map', planning_samples=10):
         super(MultiTaskBayesianAgent, self).__init__(width, height, num_colors, num_domains, name)
         self.reward_stdev = reward_stdev
         self.steps_per_policy = steps_per_policy
@@ -297,43 +585,143 @@ class MultiTaskBayesianAgent(Agent):
         self.classes = []
         self.assignments = []
         self.weights = []
-        self.model = LinearGaussianRewardModel(num_colors, self.reward_stdev, self.classes, self.assignments, self.auxillary_distribution, alpha=alpha, m=num_auxillaries)
+        # The in-episode reward model: 'mcmc' (LinearGaussianRewardModel) or 'smc'
+        # (ParticleFilterRewardModel, constant cost per step).
+        self.reward_model = reward_model
+        self.model = self.build_model(self.classes, self.assignments, self.auxillary_distribution)
         self.cur_mdp = 0
         self.steps_since_update = 0
         self.states = [[] for _ in range(num_domains)]
         self.rewards = [[] for _ in range(num_domains)]
         self.policy = None
+        # Asynchronous mode: belief and policy updates run in a worker process while
+        # the agent keeps acting on its current policy. max_staleness is the number of
+        # steps the agent may act on a stale policy before it blocks on the update.
+        self.async_updates = async_updates
+        self.max_staleness = max_staleness
+        self.stale_steps = 0
+        self.pool = None
+        self.pending = None
+        self.pending_steps = 0
+        # Anytime mode: each policy update gets policy_budget seconds of wall-clock time,
+        # of which budget_split is spent on MCMC and the rest on value iteration sweeps.
+        self.policy_budget = policy_budget
+        self.budget_split = budget_split
+        self.policy_updates = 0
+        self.budget_hits = 0
+        # The engine used to infer the classes between MDPs: 'gibbs' (the explicit
+        # sampler of Wilson et al.), 'collapsed' (class parameters integrated out),
+        # 'blocked' (batched truncated stick-breaking Gibbs) or 'variational'
+        # (mean-field truncated stick-breaking mixture).
+        self.inference = inference
+        self.statistics = [RewardStatistics(self.state_size) for _ in range(num_domains)]
+        # Class posteriors given each MDP's observations, shared by the assignment and
+        # weight steps of the Gibbs sampler. Keyed by domain index.
+        self.posterior_cache = PosteriorCache()
+        # Unknown goals (goal_known=False): the belief over the goal of an MDP is the
+        # count of the goals found in earlier MDPs plus goal_prior spread over all cells,
+        # excluding the cells already visited. The policy is planned for a mixture over
+        # the goal_candidates most likely goals.
+        self.goal_candidates = goal_candidates
+        self.goal_prior = goal_prior
+        self.goal_counts = np.zeros((width, height))
+        self.goals = [None] * num_domains
+        self.visited = [np.zeros((width, height), dtype=bool) for _ in range(num_domains)]
+        # Every newly visited cell rules out a goal, and the policy is replanned on the
+        # last cell rewards (without new MCMC) before the next action.
+        self.cell_rewards = None
+        self.goal_belief_changed = False
+        # The planner: 'map' plans on the MAP weights, while 'thompson' and 'mean_q'
+        # draw planning_samples weight vectors from the posterior and solve them in one
+        # batch. 'thompson' follows the policy of one sample, redrawn every episode;
+        # 'mean_q' follows the posterior mean of the Q-values.
+        self.planning = planning
+        self.planning_samples = planning_samples
+        self.sample_policies = None
 
     def episode_starting(self, idx, location, state):
         super(MultiTaskBayesianAgent, self).episode_starting(idx, location, state)
+        self.visited[idx][location] = True
         if idx is not self.cur_mdp:
-            self.update_beliefs()
-            self.cur_mdp = idx
-            self.update_policy()
+            if self.async_updates:
+                self.schedule_update(idx, beliefs=True)
+            else:
+                self.update_beliefs()
+                self.cur_mdp = idx
+                self.update_policy()
             self.steps_since_update = 0
+        elif self.sample_policies is not None and not self.async_updates:
+            self.policy = random.choice(self.sample_policies)
         self.prev_reward = None
 
     def episode_over(self, idx):
         assert(idx == self.cur_mdp)
         super(MultiTaskBayesianAgent, self).episode_over(idx)
-        # TODO: Handle unknown goal locations
+        if self.goals[idx] is None:
+            # Episodes end at the goal, so the goal is now known
+            self.goals[idx] = self.location[idx]
+            self.goal_counts[self.goals[idx]] += 1
 
     def get_action(self, idx):
         assert(idx == self.cur_mdp)
-        if self.steps_since_update >= self.steps_per_policy:
+        if self.async_updates:
+            self.poll_update()
+            if self.pending is None and self.steps_since_update >= self.steps_per_policy:
+                self.schedule_update(idx)
+                self.steps_since_update = 0
+            if self.pending is not None:
+                self.pending_steps += 1
+                self.stale_steps += 1
+        elif self.steps_since_update >= self.steps_per_policy:
             self.update_policy()
             self.steps_since_update = 0
+        elif self.goal_belief_changed and self.cell_rewards is not None:
+            self.plan()
         self.steps_since_update += 1
         if self.policy is None:
             return random.choice([UP, DOWN, LEFT, RIGHT])
         return self.policy[self.location[idx]]
 
+    def get_plan(self, idx, max_steps):
+        assert(idx == self.cur_mdp)
+        # Asynchronous agents poll for a new policy every step
+        if self.async_updates:
+            return None
+        # Without a known goal, every step can change the goal belief and the policy
+        if not self.goal_known and self.goals[idx] is None:
+            return None
+        if self.steps_since_update >= self.steps_per_policy:
+            self.update_policy()
+            self.steps_since_update = 0
+        if self.policy is None:
+            return None
+        return (self.policy, self.steps_per_policy - self.steps_since_update)
+
+    def ingest_chunk(self, idx, locations, states, rewards):
+        assert(idx == self.cur_mdp)
+        self.recent_rewards = (self.recent_rewards + list(rewards[-10:]))[-10:]
+        self.location[idx] = (int(locations[-1][0]), int(locations[-1][1]))
+        self.state[idx] = states[-1]
+        self.prev_reward = rewards[-1]
+        self.rewards[idx].extend(rewards)
+        self.states[idx].extend(dense_states(states, self.colors))
+        self.model.add_observations(states, rewards)
+        self.statistics[idx].add_batch(states, rewards)
+        self.posterior_cache.invalidate_data(idx)
+        self.steps_since_update += len(rewards)
+        self.visited[idx][locations[:,0], locations[:,1]] = True
+
     def set_state(self, idx, location, state):
         assert(idx == self.cur_mdp)
         super(MultiTaskBayesianAgent, self).set_state(idx, location, state)
+        if not self.goal_known and not self.visited[idx][location]:
+            self.goal_belief_changed = True
+        self.visited[idx][location] = True
         if self.prev_reward is not None:
             self.model.add_observation(state, self.prev_reward)
-            self.states[idx].append(state)
+            self.states[idx].append(dense_states(state, self.colors))
+            self.statistics[idx].add(state, self.prev_reward)
+            self.posterior_cache.invalidate_data(idx)
         #print 'STATE: {0} LOCATION: {1}'.format(state, location)
 
     def observe_reward(self, idx, r):
@@ -343,6 +731,42 @@ class MultiTaskBayesianAgent(Agent):
         self.rewards[idx].append(r)
 
     def update_beliefs(self):
+        """
+        Updates the beliefs over all MDPs with the configured inference engine and
+        rebuilds the reward model of the next MDP from the MAP classes.
+        """
+        if self.inference == 'gibbs':
+            self.gibbs_beliefs()
+        elif self.inference == 'collapsed':
+            from collapsed_gibbs import CollapsedGibbsSampler
+            sampler = CollapsedGibbsSampler(self.auxillary_distribution, self.alpha, self.reward_stdev,
+                                            iterations=self.mcmc_samples, burn_in=self.burn_in, thin=self.thin)
+            (self.classes, self.assignments, self.assignment_counts, self.weights) = sampler.fit(self.statistics[0:self.cur_mdp+1])
+        elif self.inference == 'blocked':
+            from blocked_gibbs import BlockedGibbsSampler
+            sampler = BlockedGibbsSampler(self.auxillary_distribution, self.alpha, self.reward_stdev,
+                                          iterations=self.mcmc_samples, burn_in=self.burn_in, thin=self.thin)
+            (self.classes, self.assignments, self.assignment_counts, self.weights) = sampler.fit(self.statistics[0:self.cur_mdp+1])
+        elif self.inference == 'variational':
+            from variational import VariationalDPMixture
+            engine = VariationalDPMixture(self.auxillary_distribution, self.alpha, self.reward_stdev)
+            (self.classes, self.assignments, self.assignment_counts, self.weights) = engine.fit(self.statistics[0:self.cur_mdp+1])
+        else:
+            raise Exception('Unsupported inference engine: ' + self.inference)
+        self.model = self.build_model(self.classes, self.assignment_counts, self.auxillary_distribution.posterior(self.weights))
+
+    def build_model(self, classes, assignment_counts, auxillary_distribution):
+        """
+        Creates the in-episode reward model for the next MDP from the inferred classes.
+        """
+        if self.reward_model == 'mcmc':
+            return LinearGaussianRewardModel(self.colors, self.reward_stdev, classes, assignment_counts, auxillary_distribution, alpha=self.alpha, m=self.num_auxillaries)
+        elif self.reward_model == 'smc':
+            from particle_filter import ParticleFilterRewardModel
+            return ParticleFilterRewardModel(self.colors, self.reward_stdev, classes, assignment_counts, auxillary_distribution, alpha=self.alpha, m=self.num_auxillaries)
+        raise Exception('Unsupported reward model: ' + self.reward_model)
+
+    def gibbs_beliefs(self):
         """
         Implements Algorithm 2 from Wilson et al. to update the beliefs
         over all MDPs.
@@ -352,43 +776,48 @@ class MultiTaskBayesianAgent(Agent):
         """
         states = np.array(self.states)
         rewards = np.array(self.rewards)
+        posterior = lambda mdp_class, j: self.posterior_cache.posterior(mdp_class, j, states[j], rewards[j])
         self.classes = [self.sample_auxillary(0)] # initial class
         self.assignments = [0 for _ in range(self.cur_mdp+1)] # initial assignments (all to initial class)
-        self.weights = [self.classes[a].posterior(states[i], rewards[i]).sample() for i,a in enumerate(self.assignments)] # initial weights
+        self.weights = [posterior(self.classes[a], i).sample() for i,a in enumerate(self.assignments)] # initial weights
         self.assignment_counts = [len(self.assignments)]
         max_likelihood = None
         samples = []
         for iteration in range(self.mcmc_samples):
             log_likelihood = 0
-            aux_boundary = len(self.classes)
-            # Add auxillary classes
-            self.classes += [self.sample_auxillary(len(self.classes) + k) for k in range(self.num_auxillaries)]
-            self.assignment_counts += [0] * self.num_auxillaries
+            # Draw the auxillary classes in one batch from the base posterior, computed once
+            auxillaries = AuxillaryPool(self.auxillary_distribution.posterior(self.weights), self.num_auxillaries, len(self.classes))
             # Sample class assignments
             for j,a in enumerate([x for x in self.assignments]):
                 # Remove the current mdp from the counts
                 self.assignment_counts[a] -= 1
-                # Calculate likelihood of assigning to each class
-                assignment_probs = [self.assignment_counts[i] * self.classes[i].posterior(states[j], rewards[j]).likelihood(self.weights[j]) for i in range(len(self.classes) - self.num_auxillaries)]
-                assignment_probs += [self.alpha / float(self.num_auxillaries) * self.classes[i].posterior(states[j], rewards[j]).likelihood(self.weights[j]) for i in range(len(self.classes) - self.num_auxillaries, len(self.classes))]
-                z = sum(assignment_probs)
+                # Calculate log-likelihood of assigning to each class
+                log_probs = [log_count(self.assignment_counts[i]) + posterior(self.classes[i], j).log_likelihood(self.weights[j])
+                                if self.assignment_counts[i] > 0 else -np.inf for i in range(len(self.classes))]
+                # Auxillaries that were already selected this iteration are known classes now
+                log_probs += [math.log(self.alpha / float(self.num_auxillaries)) + auxillaries.posterior_log_likelihood(k, states[j], rewards[j], self.weights[j])
+                                        if auxillaries.available(k) else -np.inf for k in range(self.num_auxillaries)]
                 # Sample an assignment proportional to the likelihoods
-                chosen = self.classes[proportional_selection(assignment_probs, partition=z)]
+                c = categorical_sample(log_probs)
                 # Multiply the likelihood of sampling all the parameters for MAP calculation at the end of sampling.
                 # Note: using log-likelihood to prevent underflows
-                if z <= 0. or assignment_probs[chosen.class_id] <= 0.:
-                    log_likelihood += math.log(1.0 / float(len(assignment_probs)))
-                else:
-                    log_likelihood += math.log(assignment_probs[chosen.class_id] / z)
-                self.assignments[j] = chosen.class_id
-                self.assignment_counts[chosen.class_id] += 1
+                log_likelihood += log_probs[c] - log_sum_exp(log_probs)
+                if c >= len(self.classes):
+                    # Only now build the selected auxillary as a full class
+                    self.classes.append(auxillaries.get(c - len(self.classes), class_id=len(self.classes)))
+                    self.assignment_counts.append(0)
+                    c = len(self.classes) - 1
+                self.assignments[j] = c
+                self.assignment_counts[c] += 1
             # Remove all classes with zero MDPs, doing some bookkeeping to adjust class IDs.
             updated_classes = []
             updated_assignments = [None for _ in self.assignments]
             updated_counts = []
             next_id = 0
             for j in range(len(self.classes)):
-                if self.assignment_counts[j] > 0:
+                if self.assignment_counts[j] == 0:
+                    self.posterior_cache.invalidate_class(self.classes[j])
+                else:
                     for k,a in enumerate(self.assignments):
                         if a == j:
                             updated_assignments[k] = next_id
@@ -399,9 +828,9 @@ class MultiTaskBayesianAgent(Agent):
             self.classes = updated_classes
             self.assignments = updated_assignments
             self.assignment_counts = updated_counts
-            # Sample weights
+            # Sample weights, reusing the posteriors from the assignment step
             class_priors = [self.classes[a] for j,a in enumerate(self.assignments)]
-            class_posteriors = [self.classes[a].posterior(states[j], rewards[j]) for j,a in enumerate(self.assignments)]
+            class_posteriors = [posterior(self.classes[a], j) for j,a in enumerate(self.assignments)]
             self.weights = [c.sample() for c in class_posteriors]
             # Multiply in the probability of selecting those weights
             #log_likelihood += sum([math.log(c.likelihood(w)) for c,w in zip(class_posteriors, self.weights)])
@@ -417,7 +846,8 @@ class MultiTaskBayesianAgent(Agent):
                 cluster_posterior = self.auxillary_distribution.posterior(w)
                 # Sample a cluster
                 (mu,sigma) = cluster_posterior.sample()
-                # Create the class from the sampled cluster parameters
+                # Create the class from the sampled cluster parameters; the old posteriors are stale
+                self.posterior_cache.invalidate_class(self.classes[c])
                 self.classes[c] = MdpClass(c, mu, sigma)
                 # Multiply in the probability of selecting those cluster parameters
                 log_likelihood += cluster_posterior.log_likelihood(mu,sigma)
@@ -454,35 +884,207 @@ class MultiTaskBayesianAgent(Agent):
         print 'MAP Assignments: {0}'.format(self.assignments)
         print 'Class Weight Means: {0}'.format([[round(w, 2) for w in c.weights_mean] for c in self.classes])
         print 'Class Weight Cov: {0}'.format([[round(w, 2) for w in c.weights_cov.diagonal()] for c in self.classes])
-        self.model = LinearGaussianRewardModel(self.colors, self.reward_stdev, self.classes, self.assignment_counts, self.auxillary_distribution.posterior(self.weights), alpha=self.alpha, m=self.num_auxillaries)
+        print 'Posterior cache hit rate: {0:.2f}'.format(self.posterior_cache.hit_rate())
+        self.posterior_cache.clear()
 
     def update_policy(self):
         """
         Algorithm 1, Line 5 from Wilson et al.
+
+        In anytime mode, sampling and planning stop when the policy budget is spent
+        and the best MAP sample and plan found so far are used.
         """
-        self.model.update_beliefs()
+        self.policy_updates += 1
+        sampling_deadline = None
+        planning_deadline = None
+        if self.policy_budget is not None:
+            start = time.time()
+            sampling_deadline = start + self.policy_budget * self.budget_split
+            planning_deadline = start + self.policy_budget
+        budget_hit = self.model.update_beliefs(deadline=sampling_deadline)
         weights = self.model.weights
         if weights is None:
             return
-        # Calculate the mean value of every cell, given the model weights
-        cell_values = np.zeros((self.width, self.height))
-        for x in range(self.width):
-            for y in range(self.height):
-                cell_values[x,y] = min(0, np.dot(weights, self.domains[self.cur_mdp].cell_states[x,y]))
-        # TODO: Handle unknown goal locations by enabling passing a belief distribution over goal locations
-        self.policy = value_iteration_to_policy(self.width, self.height, self.domains[self.cur_mdp].goal, cell_values)
+        domain = self.domains[self.cur_mdp]
+        if self.planning == 'map':
+            # Calculate the mean value of every cell, given the model weights
+            self.cell_rewards = np.minimum(0, domain.project(weights))
+        elif self.planning in ['thompson', 'mean_q']:
+            # Project all the weight samples onto the cells at once: a (cells x d) x (d x K)
+            # product, or a lookup of the color grid in a compact world
+            samples = self.model.sample_weight_batch(self.planning_samples)
+            self.cell_rewards = np.rollaxis(np.minimum(0, domain.project(samples.T)), 2)
+        else:
+            raise Exception('Unsupported planning mode: ' + self.planning)
+        self.plan(planning_deadline)
+        if planning_deadline is not None and time.time() >= planning_deadline:
+            budget_hit = True
+        if budget_hit:
+            self.budget_hits += 1
+
+    def plan(self, deadline=None):
+        """
+        Plans the policy on the current cell rewards: for the goal of the domain if it
+        is known, and for a mixture over the goal belief otherwise.
+        """
+        self.goal_belief_changed = False
+        if self.goal_known:
+            (goals, goal_weights) = ([self.domains[self.cur_mdp].goal], np.ones(1))
+        else:
+            (goals, goal_weights) = self.goal_belief(self.cur_mdp)
+        if self.planning == 'map':
+            domain = self.domains[self.cur_mdp]
+            if self.goal_known and not domain.deterministic:
+                import sparse_solver
+                self.policy = sparse_solver.value_iteration_to_policy(self.width, self.height, goals[0], self.cell_rewards, slip=domain.slip, deadline=deadline)
+            elif self.goal_known:
+                self.policy = value_iteration_to_policy(self.width, self.height, goals[0], self.cell_rewards, deadline=deadline)
+            else:
+                self.policy = mixture_policy(self.width, self.height, goals, goal_weights, self.cell_rewards, deadline=deadline)
+            return
+        # Solve every (goal, weight sample) pair in one batch
+        k = len(self.cell_rewards)
+        batch_goals = np.repeat(np.array(goals, dtype=int).reshape(-1, 2), k, axis=0)
+        batch_rewards = np.tile(self.cell_rewards, (len(goal_weights), 1, 1))
+        cell_values = batch_value_iteration(self.width, self.height, batch_goals, batch_rewards, deadline=deadline)
+        q = (batch_rewards + cell_values).reshape(len(goal_weights), k, self.width, self.height)
+        q = np.tensordot(goal_weights, q, axes=1)
+        if self.planning == 'thompson':
+            self.sample_policies = [neighbour_policy(x) for x in q]
+            self.policy = random.choice(self.sample_policies)
+        else:
+            self.policy = neighbour_policy(q.mean(axis=0))
+
+    def goal_belief(self, idx):
+        """
+        Returns the candidate goals of MDP idx and their normalized belief weights.
+        """
+        if self.goals[idx] is not None:
+            return ([self.goals[idx]], np.ones(1))
+        weights = (self.goal_counts + self.goal_prior / float(self.width * self.height)) * ~self.visited[idx]
+        if weights.sum() == 0:
+            # Every cell was visited without reaching a goal; fall back to the prior
+            weights = self.goal_counts + self.goal_prior / float(self.width * self.height)
+        order = np.argsort(weights, axis=None)[::-1][:self.goal_candidates]
+        order = order[weights.ravel()[order] > 0]
+        goals = np.column_stack(np.unravel_index(order, weights.shape))
+        goal_weights = weights.ravel()[order]
+        return (goals, goal_weights / goal_weights.sum())
 
     def sample_auxillary(self, class_id):
-        (mean, cov) = self.auxillary_distribution.posterior(self.weights).sample()
-        return MdpClass(class_id, mean, cov)
+        return AuxillaryPool(self.auxillary_distribution.posterior(self.weights), 1, class_id).get(0)
+
+    def schedule_update(self, idx, beliefs=False):
+        """
+        Starts a policy update (and, when switching domains, a belief update) in the
+        background worker. The agent keeps acting on its current policy until
+        poll_update swaps in the result.
+        """
+        if self.pending is not None:
+            # Only one update may be in flight; wait for it before starting the next.
+            self.poll_update(block=True)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(1)
+        snapshot = self.snapshot(idx)
+        if beliefs:
+            # The new domain's observations start from scratch, as in the synchronous path.
+            self.cur_mdp = idx
+        self.pending = self.pool.apply_async(background_update, (snapshot, idx, beliefs))
+        self.pending_steps = 0
+
+    def poll_update(self, block=False):
+        """
+        Swaps in the result of the background update if it is ready. Blocks if asked to,
+        or if the agent has already acted max_staleness steps on the stale policy.
+        """
+        if self.pending is None:
+            return False
+        if not block and not self.pending.ready():
+            if self.max_staleness is None or self.pending_steps < self.max_staleness:
+                return False
+        (beliefs, policy, model, counters) = self.pending.get()
+        self.pending = None
+        # The counters of the update were incremented in the worker's snapshot
+        self.policy_updates += counters[0]
+        self.budget_hits += counters[1]
+        if beliefs is not None:
+            (self.classes, self.assignments, self.assignment_counts, self.weights) = beliefs
+            # Replay the observations made while the update was running.
+            for state,reward in zip(self.states[self.cur_mdp], self.rewards[self.cur_mdp]):
+                model.add_observation(state, reward)
+            self.model = model
+        else:
+            self.model.map_class = model.map_class
+            self.model.weights = model.weights
+        self.policy = policy
+        return True
+
+    def snapshot(self, idx):
+        """
+        Returns a picklable copy of the agent holding only what an update needs.
+        The pool pickles tasks in a background thread, so the observation lists that
+        keep growing in this process are copied rather than shared.
+        """
+        snapshot = copy.copy(self)
+        snapshot.pool = None
+        snapshot.pending = None
+        snapshot.policy_updates = 0
+        snapshot.budget_hits = 0
+        snapshot.states = [list(x) for x in self.states]
+        snapshot.rewards = [list(x) for x in self.rewards]
+        snapshot.statistics = [copy.deepcopy(x) for x in self.statistics]
+        snapshot.model = copy.copy(self.model)
+        if hasattr(self.model, 'states'):
+            snapshot.model.states = list(self.model.states)
+            snapshot.model.rewards = list(self.model.rewards)
+        snapshot.domains = [None] * len(self.domains)
+        domain = copy.copy(self.domains[idx])
+        domain.agent = None
+        domain.recorder = None
+        snapshot.domains[idx] = domain
+        return snapshot
 
     def clear_memory(self, idx):
         super(MultiTaskBayesianAgent, self).clear_memory(idx)
+        if self.pending is not None:
+            self.poll_update(block=True)
         if self.cur_mdp is idx:
             self.cur_mdp -= 1
             self.policy = None
+            self.cell_rewards = None
+            self.sample_policies = None
         self.states[idx] = []
         self.rewards[idx] = []
+        self.statistics[idx] = RewardStatistics(self.state_size)
+        self.posterior_cache.invalidate_data(idx)
+        if self.goals[idx] is not None:
+            self.goal_counts[self.goals[idx]] -= 1
+            self.goals[idx] = None
+        self.visited[idx][:] = False
+
+    def close(self):
+        """
+        Waits for the update in flight and shuts down the background worker.
+        """
+        if self.pending is not None:
+            self.poll_update(block=True)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def background_update(agent, idx, beliefs):
+    """
+    Runs the updates of a MultiTaskBayesianAgent snapshot in a worker process.
+    """
+    if beliefs:
+        agent.update_beliefs()
+        agent.cur_mdp = idx
+        agent.update_policy()
+        return ((agent.classes, agent.assignments, agent.assignment_counts, agent.weights), agent.policy, agent.model,
+                (agent.policy_updates, agent.budget_hits))
+    agent.update_policy()
+    return (None, agent.policy, agent.model, (agent.policy_updates, agent.budget_hits))
 
 if __name__ == "__main__":
     TRUE_CLASS = 0
@@ -0,0 +1,152 @@
+"""
+An on-disk cache of the optimal values and policy of grid world domains, used to
+measure the regret of agents.
+
+Domains are keyed by a hash of their content (size, colour grid, weights and goal),
+so the same domain maps to the same entry in every run, sweep point and process that
+builds it, whether it is a GridWorld or a DomainView. Each entry is one .npz file
+holding the values and policy of value iteration on the true cell means, clamped to
+non-positive rewards as the agents' planners do; returns and regret are measured on
+the same clamped rewards, so the oracle policy has zero regret. Missing entries are solved in
+parallel by fill(), after which every agent and run reuses them; the points of a
+sweep that build the same domains share their entries through the directory.
+"""
+import hashlib
+import os
+import numpy as np
+from multiprocessing import Pool, current_process
+from mdp_solver import value_iteration, neighbour_policy
+from evaluation import expected_return
+
+# Bump to invalidate the cached entries when the solver changes
+ORACLE_VERSION = 2
+
+def domain_key(world):
+    """
+    Returns the content hash of a domain.
+    """
+    h = hashlib.sha1()
+    h.update('oracle-{0}:{1}x{2}:{3}:{4},{5}:'.format(ORACLE_VERSION, world.width, world.height, world.num_colors, world.goal[0], world.goal[1]))
+    h.update(np.ascontiguousarray(world.cell_colors, dtype='<i4').tostring())
+    h.update(np.ascontiguousarray(world.color_location_weights, dtype='<f8').tostring())
+    if world.slip > 0:
+        h.update('slip:{0!r}'.format(float(world.slip)))
+    return h.hexdigest()
+
+def oracle_means(world):
+    """
+    Returns the rewards the oracle solves and evaluates a domain on.
+    """
+    return np.minimum(0, world.cell_means)
+
+def solve_domain(task):
+    """
+    Solves one domain, given as (key, width, height, goal, cell_means, slip). Top-level
+    so that it can be sent to a process pool. Stochastic domains are solved by policy
+    iteration on their sparse transition matrices.
+    """
+    (key, width, height, goal, cell_rewards, slip) = task
+    if slip > 0:
+        from sparse_solver import policy_iteration
+        (values, policy) = policy_iteration(width, height, goal, cell_rewards, slip=slip)
+    else:
+        values = value_iteration(width, height, goal, cell_rewards)
+        # Rewards are received on entering a cell, so move to the neighbour with the best reward plus value
+        policy = neighbour_policy(cell_rewards + values)
+    return (key, values, policy)
+
+def solve_task(world):
+    return (domain_key(world), world.width, world.height, tuple(world.goal), oracle_means(world), world.slip)
+
+class OracleCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.entries = {}
+        self.returns = {}
+        self.solved = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def store(self, key, values, policy):
+        # Write to a temporary file first, so concurrent runs never read half an entry
+        tmp = '{0}.{1}.tmp.npz'.format(self.path(key)[:-4], os.getpid())
+        np.savez(tmp, values=values, policy=policy)
+        os.rename(tmp, self.path(key))
+        self.entries[key] = (values, policy)
+
+    def load(self, key):
+        if key not in self.entries:
+            if not os.path.exists(self.path(key)):
+                return None
+            data = np.load(self.path(key))
+            self.entries[key] = (data['values'], data['policy'])
+            data.close()
+        return self.entries[key]
+
+    def fill(self, worlds, processes=None):
+        """
+        Solves every domain that is not in the cache yet, in a pool of processes (all
+        CPUs by default). Returns the number of domains solved. Inside a daemonic
+        process (e.g. a sweep worker), which cannot start a pool, they are solved in turn.
+        """
+        tasks = {}
+        for world in worlds:
+            key = domain_key(world)
+            if key not in tasks and self.load(key) is None:
+                tasks[key] = solve_task(world)
+        tasks = tasks.values()
+        if len(tasks) > 1 and processes != 1 and not current_process().daemon:
+            pool = Pool(processes)
+            solutions = pool.map(solve_domain, tasks)
+            pool.close()
+            pool.join()
+        else:
+            solutions = [solve_domain(t) for t in tasks]
+        for (key, values, policy) in solutions:
+            self.store(key, values, policy)
+        self.solved += len(solutions)
+        return len(solutions)
+
+    def get(self, world):
+        """
+        Returns the (values, policy) of the domain, solving it if it is not cached.
+        """
+        key = domain_key(world)
+        entry = self.load(key)
+        if entry is None:
+            (key, values, policy) = solve_domain(solve_task(world))
+            self.store(key, values, policy)
+            self.solved += 1
+            entry = (values, policy)
+        return entry
+
+    def optimal_return(self, world, max_moves=None):
+        """
+        Returns the exact expected episode return of the optimal policy of the domain.
+        Raises an exception if the cached policy does not achieve the cached value of
+        the start location; no reward is positive, so ending an episode at max_moves
+        can only raise its return.
+        """
+        if max_moves is None:
+            max_moves = world.max_moves
+        key = (domain_key(world), max_moves)
+        if key not in self.returns:
+            (values, policy) = self.get(world)
+            optimal = expected_return(world, policy, max_moves, oracle_means(world))
+            value = values[tuple(world.start_location)]
+            if optimal < value - 1e-6 * max(1., abs(value)):
+                raise Exception('The oracle policy of domain {0} returns {1}, below its value {2}'.format(key[0], optimal, value))
+            self.returns[key] = optimal
+        return self.returns[key]
+
+    def regret(self, world, policy, max_moves=None):
+        """
+        Returns the expected episode return lost by following the policy (None for
+        random moves) instead of the optimal policy.
+        """
+        if max_moves is None:
+            max_moves = world.max_moves
+        return self.optimal_return(world, max_moves) - expected_return(world, policy, max_moves, oracle_means(world))
@@ -0,0 +1,182 @@
+"""
+A sequential Monte Carlo alternative to the in-episode MCMC of LinearGaussianRewardModel
+in multitask.py.
+
+Each particle holds a class (one of the known classes, or a new class drawn from the
+auxillary distribution) and the exact Gaussian posterior over the weights given that
+class and every observation so far. New observations reweight the particles by their
+predictive likelihood and update each posterior with a rank-1 (Kalman) step,
+written in the symmetric form P - c c'/s so round-off cannot make the covariances
+asymmetric; sampling symmetrises them and adds jitter before factorising, in case
+round-off costs them their positive definiteness. Only running sufficient statistics of the observations are kept, so
+the cost and memory per step are O(particles x d^2) regardless of how many steps
+came before.
+Resampling and a Metropolis-Hastings rejuvenation of the classes only happen when
+the effective sample size drops.
+"""
+import math
+import numpy as np
+from gridworld import NUM_RELATIVE_CELLS, dense_states
+from multitask import MdpClass, RewardStatistics
+
+class ParticleFilterRewardModel(object):
+    """
+    A drop-in replacement for LinearGaussianRewardModel: it takes the same constructor
+    arguments and exposes the same add_observation / update_beliefs / map_class /
+    weights interface. The m auxillary classes of the MCMC model are not needed here;
+    each particle that picks a new class draws its own, so m is only accepted for
+    interface compatibility and ignored.
+    """
+    def __init__(self, num_colors, reward_stdev, classes, assignments, auxillary_distribution, alpha=0.5, m=2, num_particles=100, ess_threshold=0.5):
+        self.weights_size = num_colors * NUM_RELATIVE_CELLS
+        self.reward_stdev = reward_stdev
+        self.classes = classes
+        self.assignments = assignments
+        self.auxillary_distribution = auxillary_distribution
+        self.alpha = alpha
+        self.num_particles = num_particles
+        self.ess_threshold = ess_threshold
+        assert(len(classes) == len(assignments))
+        self.statistics = RewardStatistics(self.weights_size)
+        self.next_class_id = len(classes)
+        self.resamples = 0
+        (self.class_ids, self.prior_means, self.prior_covs) = self.sample_classes(num_particles)
+        self.means = np.copy(self.prior_means)
+        self.covs = np.copy(self.prior_covs)
+        self.log_weights = np.zeros(num_particles)
+        self.log_marginals = np.zeros(num_particles)
+        self.update_beliefs()
+
+    def sample_classes(self, n):
+        """
+        Draws n classes from the Chinese restaurant process prior: a known class with
+        probability proportional to its MDP count, or a new class drawn from the
+        auxillary distribution with probability proportional to alpha.
+        Returns the class IDs and the prior means and covariances of the weights.
+        """
+        proportions = np.array(list(self.assignments) + [self.alpha], dtype=float)
+        chosen = np.random.choice(len(proportions), size=n, p=proportions / proportions.sum())
+        class_ids = np.copy(chosen)
+        means = np.zeros((n, self.weights_size))
+        covs = np.zeros((n, self.weights_size, self.weights_size))
+        for i,c in enumerate(self.classes):
+            means[chosen == i] = c.weights_mean
+            covs[chosen == i] = c.weights_cov
+        new = np.flatnonzero(chosen == len(self.classes))
+        if len(new) > 0:
+            aux = self.auxillary_distribution
+            k = len(new)
+            (means[new], covs[new], _, _) = aux.sample_batch(k)
+            class_ids[new] = self.next_class_id + np.arange(k)
+            self.next_class_id += k
+        return (class_ids, means, covs)
+
+    def add_observations(self, states, rewards):
+        # Every observation can trigger a resampling step, so they are filtered in order
+        for (state, reward) in zip(states, rewards):
+            self.add_observation(state, reward)
+
+    def add_observation(self, state, reward):
+        state = dense_states(state, self.weights_size / NUM_RELATIVE_CELLS)
+        self.statistics.add(state, reward)
+        # Predictive distribution of the reward under every particle
+        cov_state = np.einsum('nab,b->na', self.covs, state)
+        pred_mean = np.dot(self.means, state)
+        pred_var = self.reward_stdev ** 2 + np.dot(cov_state, state)
+        log_likelihood = -0.5 * (np.log(2. * math.pi * pred_var) + (reward - pred_mean) ** 2 / pred_var)
+        # The arrays are replaced rather than updated in place, as an asynchronous
+        # agent may be pickling a shallow copy of the model in another thread
+        self.log_weights = self.log_weights + log_likelihood
+        self.log_marginals = self.log_marginals + log_likelihood
+        # Rank-1 Kalman update of every particle's weight posterior, with c = P h and
+        # s = h'P h + r: the standard update P - k c' written symmetrically as P - c c'/s
+        gain = cov_state / pred_var[:,None]
+        self.means = self.means + gain * (reward - pred_mean)[:,None]
+        self.covs = self.covs - np.einsum('na,nb,n->nab', cov_state, cov_state, 1. / pred_var)
+        if self.effective_sample_size() < self.ess_threshold * self.num_particles:
+            self.resample()
+
+    def normalized_weights(self):
+        w = np.exp(self.log_weights - self.log_weights.max())
+        return w / w.sum()
+
+    def effective_sample_size(self):
+        return 1. / np.sum(self.normalized_weights() ** 2)
+
+    def resample(self):
+        """
+        Systematic resampling followed by one Metropolis-Hastings move per particle
+        that proposes a new class from the prior and accepts it by the ratio of the
+        marginal likelihoods of all observations so far.
+        """
+        self.resamples += 1
+        n = self.num_particles
+        positions = (np.random.random() + np.arange(n)) / n
+        idx = np.minimum(np.searchsorted(np.cumsum(self.normalized_weights()), positions), n - 1)
+        self.class_ids = self.class_ids[idx]
+        self.prior_means = self.prior_means[idx]
+        self.prior_covs = self.prior_covs[idx]
+        self.means = self.means[idx]
+        self.covs = self.covs[idx]
+        self.log_marginals = self.log_marginals[idx]
+        self.log_weights = np.zeros(n)
+        # Rejuvenate the classes
+        (class_ids, prior_means, prior_covs) = self.sample_classes(n)
+        (means, covs, log_marginals) = self.posteriors(prior_means, prior_covs)
+        accept = np.log(np.random.random(n)) < log_marginals - self.log_marginals
+        self.class_ids[accept] = class_ids[accept]
+        self.prior_means[accept] = prior_means[accept]
+        self.prior_covs[accept] = prior_covs[accept]
+        self.means[accept] = means[accept]
+        self.covs[accept] = covs[accept]
+        self.log_marginals[accept] = log_marginals[accept]
+
+    def posteriors(self, prior_means, prior_covs):
+        """
+        Returns the posterior means, covariances and log marginal likelihoods of all
+        observations under a batch of Gaussian weight priors, using the running
+        sufficient statistics.
+        """
+        s = self.statistics
+        noise = self.reward_stdev ** 2
+        prior_precisions = np.linalg.inv(prior_covs)
+        precisions = prior_precisions + s.xtx[None,:,:] / noise
+        linear = np.einsum('nab,nb->na', prior_precisions, prior_means) + s.xty[None,:] / noise
+        covs = np.linalg.inv(precisions)
+        means = np.einsum('nab,nb->na', covs, linear)
+        log_marginals = -0.5 * s.count * math.log(2. * math.pi * noise) - 0.5 * s.yty / noise \
+                - 0.5 * np.einsum('na,na->n', prior_means, linear - s.xty[None,:] / noise) \
+                + 0.5 * np.einsum('na,na->n', means, linear) \
+                + 0.5 * np.linalg.slogdet(prior_precisions)[1] - 0.5 * np.linalg.slogdet(precisions)[1]
+        return (means, covs, log_marginals)
+
+    def sample_weight_batch(self, k):
+        """
+        Returns k (k x d) samples of the weights from the particle mixture: a particle
+        is drawn by its weight, then a sample from its Gaussian posterior.
+        """
+        chosen = np.random.choice(self.num_particles, size=k, p=self.normalized_weights())
+        # Symmetrise and add jitter against round-off before factorising
+        covs = 0.5 * (self.covs[chosen] + np.swapaxes(self.covs[chosen], 1, 2)) + 1e-10 * np.identity(self.weights_size)
+        cholesky = np.linalg.cholesky(covs)
+        return self.means[chosen] + np.einsum('kab,kb->ka', cholesky, np.random.randn(k, self.weights_size))
+
+    def update_beliefs(self, deadline=None):
+        """
+        Summarises the particle population: the MAP class is the class with the most
+        particle weight, and the weights are the posterior mean of its best particle.
+        The work was already done as observations arrived, so this never hits a deadline.
+        """
+        w = self.normalized_weights()
+        (ids, inverse) = np.unique(self.class_ids, return_inverse=True)
+        class_weights = np.bincount(inverse, weights=w)
+        best_class = np.argmax(class_weights)
+        members = np.flatnonzero(inverse == best_class)
+        best = members[np.argmax(w[members])]
+        class_id = ids[best_class]
+        if class_id < len(self.classes):
+            self.map_class = self.classes[class_id]
+        else:
+            self.map_class = MdpClass(class_id, self.prior_means[best], self.prior_covs[best])
+        self.weights = self.means[best]
+        return False
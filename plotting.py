@@ -0,0 +1,77 @@
+"""
+Renders the PDFs of the experiments from results stored by results.save_results.
+This is the only module that imports matplotlib. Plots are only ever written to
+files, so the non-interactive Agg backend is used and no display is needed.
+"""
+import os
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+AGENT_COLORS = ['red','blue', 'green', 'brown', 'purple', 'yellow', 'orange'] # max 7 agents
+
+def plot_training_window(manifest, filename):
+    ylabel = 'Expected Episode Return' if manifest['args'].get('evaluation') == 'exact' else 'Cumulative Reward'
+    plot_curves(manifest, filename, ylabel)
+
+def plot_regret(manifest, filename):
+    plot_curves(manifest, filename, 'Regret (Expected Episode Return)')
+
+def plot_curves(manifest, filename, ylabel):
+    args = manifest['args']
+    ax = plt.subplot(111)
+    num_steps = args['teststeps'] / args['stepsize']
+    plt.xlim((0,num_steps))
+    for i,s in enumerate(manifest['series']):
+        avg = np.array(s['columns']['Avg'])
+        stderr = np.array(s['columns']['Stderr'])
+        xvals = np.arange(len(avg))
+        # Plot each series
+        plt.plot(xvals + 1, avg, label=s['name'], color=AGENT_COLORS[i])
+        plt.fill_between(xvals + 1, avg + stderr, avg - stderr, facecolor=AGENT_COLORS[i], alpha=0.2)
+    plt.xlabel('Number of Steps x {0}'.format(args['stepsize']))
+    plt.ylabel(ylabel)
+    plt.title('{0}x{1} Map, Fixed Goal Location'.format(args['gridwidth'], args['gridheight']))
+    save_figure(ax, filename)
+
+def plot_goal_locations(manifest, filename):
+    args = manifest['args']
+    ax = plt.subplot(111)
+    plt.xlim((0,args['domains']))
+    for i,s in enumerate(manifest['series']):
+        rewards = s['columns']['Reward']
+        # Plot each series
+        plt.plot(np.arange(len(rewards)), rewards, label=s['name'], color=AGENT_COLORS[i])
+    plt.xlabel('# Experienced Environments')
+    plt.ylabel('Total Reward Episode 1')
+    plt.title('{0}x{1} Map, {2} Colors'.format(args['gridwidth'], args['gridheight'], args['colors']))
+    save_figure(ax, filename)
+
+def save_figure(ax, filename):
+    # Shink current axis by 25%
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.75, box.height])
+    # Put a legend to the right of the current axis
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+    plt.savefig(filename)
+    plt.clf()
+
+PLOTS = {
+    'training_window': (plot_training_window, 'test.pdf'),
+    'goal_locations': (plot_goal_locations, 'test_locations.pdf'),
+    'regret': (plot_regret, 'regret.pdf')
+}
+
+def plot_results(manifest, filename=None):
+    """
+    Plots a loaded results manifest with the plot of its experiment. By default the
+    PDF is written next to the results. Returns the name of the PDF.
+    """
+    if manifest['experiment'] not in PLOTS:
+        raise Exception('Unsupported experiment: ' + manifest['experiment'])
+    (plot, default_filename) = PLOTS[manifest['experiment']]
+    if filename is None:
+        filename = os.path.join(manifest['directory'], default_filename)
+    plot(manifest, filename)
+    return filename
@@ -0,0 +1,62 @@
+"""
+Storage of experiment results, so that running an experiment and plotting it are
+separate stages. An experiment writes one CSV file per series (e.g. per agent) and
+a JSON manifest naming the experiment, its arguments and the series files.
+
+Only the standard library is used here, so writing results costs nothing at start-up.
+"""
+import csv
+import json
+import os
+
+MANIFEST = 'results.json'
+
+def save_results(output, experiment, args, series):
+    """
+    Writes the results of an experiment to the output directory.
+    series is a list of (name, header, rows) tuples, one per series, and args is the
+    parsed argparse namespace of the run. Returns the path of the manifest.
+    """
+    if not os.path.exists(output):
+        os.makedirs(output)
+    manifest = {'experiment': experiment, 'args': vars(args), 'series': []}
+    for i,(name, header, rows) in enumerate(series):
+        filename = 'agent_{0}.csv'.format(i+1)
+        f = open(os.path.join(output, filename), 'wb')
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+        f.flush()
+        f.close()
+        manifest['series'].append({'name': name, 'file': filename})
+    path = os.path.join(output, MANIFEST)
+    f = open(path, 'wb')
+    json.dump(manifest, f, indent=2, sort_keys=True)
+    f.close()
+    return path
+
+def load_results(path):
+    """
+    Reads the results written by save_results, given the manifest or its directory.
+    Returns the manifest, with each series holding its CSV columns as lists of floats.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST)
+    f = open(path, 'rb')
+    manifest = json.load(f)
+    f.close()
+    directory = os.path.dirname(path)
+    manifest['directory'] = directory
+    for s in manifest['series']:
+        f = open(os.path.join(directory, s['file']), 'rb')
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = [[] for _ in header]
+        for row in reader:
+            for i,x in enumerate(row):
+                columns[i].append(float(x))
+        f.close()
+        s['columns'] = dict(zip(header, columns))
+        s['header'] = header
+    return manifest
@@ -0,0 +1,16 @@
+from setuptools import setup
+
+setup(
+    name='hbayes-rl',
+    version='0.1.0',
+    description='Hierarchical Bayesian multi-task reinforcement learning experiments (Wilson et al., ICML\'07).',
+    py_modules=['aggregation', 'blocked_gibbs', 'cli', 'collapsed_gibbs', 'distributed', 'domain_store',
+                'evaluation', 'gridworld', 'mdp_solver', 'multitask', 'oracle', 'particle_filter',
+                'plotting', 'qlearning', 'results', 'singletask', 'sparse_solver', 'sweep',
+                'task_suite', 'test_goal_locations', 'test_training_window', 'trajectory', 'variational'],
+    install_requires=['numpy', 'scipy'],
+    extras_require={'plot': ['matplotlib']},
+    entry_points={
+        'console_scripts': ['hbayes-rl = cli:main']
+    }
+)
@@ -1,135 +1,145 @@
 """
-NOTE: This file is currently FUBAR. Do not look at this for anything meaningful!
+A single-class baseline for the Wilson et al. experiments: a Bayesian RL agent that
+views all the domains as drawn from one Normal-Inverse-Wishart distribution over
+the reward weights.
 """
+import random
 import numpy as np
 from gridworld import *
-from mdp_solver import *
-from sample_utils import sample_niw
-
-class Observation(object):
-    def __init__(self, episode, state, reward, reward_stdev, goal = False):
-        self.episode = episode
-        self.state = state
-        self.reward = reward
-        self.reward_stdev = reward_stdev
-        self.goal = goal
+from mdp_solver import value_iteration_to_policy
+from multitask import NormalInverseWishartDistribution, RewardStatistics
 
 class LinearGaussianRewardModel(object):
-    def __init__(self, num_colors, posterior_samples=3000, burn_in=500, thin=10, proposal_variance=0.1):
-        self.observations = []
-        self.posterior_samples = posterior_samples
+    """
+    A hierarchical linear Gaussian reward model with a single class. Every domain has
+    its own weights w ~ N(phi, Sigma), and (phi, Sigma) ~ NIW. Each domain's
+    observations are kept as running sufficient statistics, and the posterior is
+    sampled with conjugate Gibbs updates of the weights and the class parameters.
+    """
+    def __init__(self, num_colors, num_domains, reward_stdev, gibbs_samples=100, burn_in=20, thin=1):
+        self.weights_size = num_colors * NUM_RELATIVE_CELLS
+        self.reward_stdev = reward_stdev
+        self.gibbs_samples = gibbs_samples
         self.burn_in = burn_in
         self.thin = thin
-        self.proposal_variance = proposal_variance
-        self.weights_mean_size = num_colors * NUM_RELATIVE_CELLS
-        self.weights_cov_size = (self.weights_mean_size, self.weights_mean_size)
-        self.weights_size = self.weights_mean_size
-        # The parameters of the Normal-Inverse-Wishart prior (mu, lambda, nu, psi)
-        # I am trying to use very vague parameters here, to get close to an uninformed prior.
-        self.hyper_parameters = (np.zeros(self.weights_size), 1., self.weights_size, np.identity(self.weights_size) * 3.)
-        self.episodes = 0
-        self.bayes_estimates = (np.zeros(self.weights_size), np.identity(self.weights_size) * 3, np.zeros(self.weights_size))
+        # A vague Normal-Inverse-Wishart prior over the class parameters (mu, lambda, nu, psi)
+        self.prior = NormalInverseWishartDistribution(np.zeros(self.weights_size), 0.1, self.weights_size+2, np.identity(self.weights_size))
+        self.statistics = [RewardStatistics(self.weights_size) for _ in range(num_domains)]
+        # Bayes estimates of the class parameters and the weights of every domain
+        self.weights_mean = np.copy(self.prior.mu)
+        self.weights_cov = self.prior.psi / float(self.prior.nu - self.weights_size - 1)
+        self.weights = [np.copy(self.weights_mean) for _ in range(num_domains)]
 
-    def add_reward_observation(self, observation, update=True):
-        self.observations.append(observation)
-        if update:
-            self.update_beliefs()
+    def add_observation(self, idx, state, reward):
+        self.statistics[idx].add(state, reward)
 
     def update_beliefs(self):
-        self.samples = self.calculate_posterior()
-        self.bayes_estimates = (np.mean(s, axis=0) for s in self.samples)
-
-    def calculate_posterior(self):
+        """
+        Runs a Gibbs sampler over the weights of every observed domain and the class
+        parameters, and stores the posterior means as the new Bayes estimates.
+        """
+        observed = [i for i,s in enumerate(self.statistics) if s.count > 0]
+        if len(observed) == 0:
+            return
+        (mean, cov) = self.prior.sample()
         mean_samples = []
         cov_samples = []
         weight_samples = []
-        mean = np.zeros(self.weights_mean_size)
-        cov = np.identity(self.weights_mean_size)
-        weights = np.random.multivariate_normal(mean, cov)
-        for i in range(self.posterior_samples):
-            print i
-            mean,cov = self.gibbs_weights_mean_cov(weights)
-            weights = self.mcmc_weights(weights, mean, cov)
+        for i in range(self.gibbs_samples):
+            precision = np.linalg.inv(cov)
+            weights = [self.statistics[j].sample_posterior(mean, precision, self.reward_stdev) for j in observed]
+            (mean, cov) = self.prior.sample_posterior(weights)
             if i >= self.burn_in and i % self.thin == 0:
                 mean_samples.append(mean)
                 cov_samples.append(cov)
                 weight_samples.append(weights)
-                print 'Iteration {0}'.format(i)
-                print 'Phi: {0}'.format(mean)
-                print 'Sigma: {0}'.format(cov_samples)
-                print 'Weights: {0}'.format(weights)
-                print ''
-
-        return (mean_samples, cov_samples, weight_samples)
-
-    def gibbs_weights_mean_cov(self, weights):
-        avg_weights = weights #np.mean(weights, axis=0)
-        post_mean = (self.hyper_parameters[1] * self.hyper_parameters[0] + self.episodes * avg_weights) / (self.hyper_parameters[1] + self.episodes)
-        post_lambda = self.hyper_parameters[1] + self.episodes
-        post_nu = self.hyper_parameters[2] + self.episodes
-        deviation = avg_weights - self.hyper_parameters[0]
-        #post_psi = self.hyper_parameters[3] + np.sum([np.dot(w - avg_weights, np.transpose(w - avg_weights)) for w in weights]) \
-        post_psi = self.hyper_parameters[3] \
-                        + self.hyper_parameters[1] * self.episodes / (self.hyper_parameters[1] + self.episodes) \
-                        * np.dot(deviation, np.transpose(deviation))
-        (sample_mean, sample_cov) = sample_niw(post_mean, post_lambda, post_nu, np.linalg.inv(post_psi))
-        return (sample_mean, sample_cov)
+        self.weights_mean = np.mean(mean_samples, axis=0)
+        self.weights_cov = np.mean(cov_samples, axis=0)
+        for j,w in zip(observed, np.mean(weight_samples, axis=0)):
+            self.weights[j] = w
 
-    def mcmc_weights(self, prev_weights, mean, cov):
-        cur_weights = np.copy(prev_weights)
-        cur_likelihood = self.weights_likelihood(cur_weights, mean, cov)
-        for i in range(self.burn_in):
-            proposed = self.weights_proposal(cur_weights)
-            proposal_likelihood = self.weights_likelihood(proposed, mean, cov)
-            u = random.random()
-            if math.log(u) < (proposal_likelihood - cur_likelihood):
-                cur_weights = proposed
-                cur_likelihood = proposal_likelihood
-        return cur_weights
+    def predict_weights(self, idx):
+        """
+        Returns the posterior mean of a domain's weights given the current estimates of
+        the class parameters. This is closed form, so it is cheap enough to run often.
+        """
+        precision = np.linalg.inv(self.weights_cov)
+        return self.statistics[idx].posterior(self.weights_mean, precision, self.reward_stdev)[0]
 
-    def weights_proposal(self, prev_weights):
-        return np.random.multivariate_normal(prev_weights, np.identity(self.weights_size) * self.proposal_variance)
-
-    def weights_likelihood(self, weights, mean, cov):
-        sum_rewards = sum([(x.reward - np.dot(np.transpose(weights), x.state)) ** 2 / (x.reward_stdev ** 2) for x in self.observations])
-        prior_term = np.dot(np.dot(np.transpose(weights - mean), np.linalg.inv(cov)), weights - mean)
-        return -0.5 * (sum_rewards + prior_term) # log prob
-
-    def predict_value(self, state):
-        return np.dot(self.bayes_estimates[0], state)            
+    def clear(self, idx):
+        self.statistics[idx] = RewardStatistics(self.weights_size)
+        self.weights[idx] = np.copy(self.weights_mean)
 
 
 class SingleTaskBayesianAgent(Agent):
     """
     A Bayesian RL agent that views all the domains as drawn from the same distribution.
     """
-    def __init__(self, width, height, num_colors, num_domains, name=None, steps_per_policy=1):
+    def __init__(self, width, height, num_colors, num_domains, reward_stdev, name=None, steps_per_policy=10, gibbs_samples=100, burn_in=20, thin=1):
         super(SingleTaskBayesianAgent, self).__init__(width, height, num_colors, num_domains, name)
-        self.model = LinearGaussianRewardModel(num_colors)
-        self.value_function = np.array((num_domains, width, height))
-        self.state_vector = np.array((num_domains, width, height, num_colors * NUM_RELATIVE_CELLS))
+        self.model = LinearGaussianRewardModel(num_colors, num_domains, reward_stdev, gibbs_samples=gibbs_samples, burn_in=burn_in, thin=thin)
         self.steps_per_policy = steps_per_policy
         self.steps_since_update = 0
-
-    def episode_starting(self, idx, state):
-        super(SingleTaskBayesianAgent, self).episode_starting(idx, state)
-        self.steps_since_update = 0
-        mdp = self.sample_mdp()
-
-
-    def episode_over(self, idx):
-        super(SingleTaskBayesianAgent, self).episode_over(idx)
+        self.cur_mdp = 0
+        self.prev_reward = None
+        self.policy = None
+
+    def episode_starting(self, idx, location, state):
+        super(SingleTaskBayesianAgent, self).episode_starting(idx, location, state)
+        if idx is not self.cur_mdp:
+            self.model.update_beliefs()
+            self.cur_mdp = idx
+            self.update_policy()
+            self.steps_since_update = 0
+        self.prev_reward = None
 
     def get_action(self, idx):
-        pass
-
-    def set_state(self, idx, state):
-        super(SingleTaskBayesianAgent, self).set_state(idx, state)
+        assert(idx == self.cur_mdp)
+        if self.steps_since_update >= self.steps_per_policy:
+            self.update_policy()
+            self.steps_since_update = 0
+        self.steps_since_update += 1
+        if self.policy is None:
+            return random.choice([UP, DOWN, LEFT, RIGHT])
+        return self.policy[self.location[idx]]
+
+    def get_plan(self, idx, max_steps):
+        assert(idx == self.cur_mdp)
+        if self.steps_since_update >= self.steps_per_policy:
+            self.update_policy()
+            self.steps_since_update = 0
+        if self.policy is None:
+            return None
+        return (self.policy, self.steps_per_policy - self.steps_since_update)
+
+    def ingest_chunk(self, idx, locations, states, rewards):
+        super(SingleTaskBayesianAgent, self).ingest_chunk(idx, locations, states, rewards)
+        self.steps_since_update += len(rewards)
+
+    def set_state(self, idx, location, state):
+        assert(idx == self.cur_mdp)
+        super(SingleTaskBayesianAgent, self).set_state(idx, location, state)
+        if self.prev_reward is not None:
+            self.model.add_observation(idx, state, self.prev_reward)
 
     def observe_reward(self, idx, r):
+        assert(idx == self.cur_mdp)
         super(SingleTaskBayesianAgent, self).observe_reward(idx, r)
-        self.model.add_reward_observation(Observation(idx, ))
-
-    def sample_mdp(self):
-        # TODO: sample a MAP MDP
-        return np.zeros(self.num_colors * NUM_RELATIVE_CELLS)
+        self.prev_reward = r
+
+    def update_policy(self):
+        weights = self.model.predict_weights(self.cur_mdp)
+        domain = self.domains[self.cur_mdp]
+        cell_values = np.minimum(0, domain.project(weights))
+        if domain.deterministic:
+            self.policy = value_iteration_to_policy(self.width, self.height, domain.goal, cell_values)
+        else:
+            import sparse_solver
+            self.policy = sparse_solver.value_iteration_to_policy(self.width, self.height, domain.goal, cell_values, slip=domain.slip)
+
+    def clear_memory(self, idx):
+        super(SingleTaskBayesianAgent, self).clear_memory(idx)
+        if self.cur_mdp is idx:
+            self.cur_mdp -= 1
+            self.policy = None
+        self.model.clear(idx)
@@ -0,0 +1,140 @@
+"""
+Solvers for grid world MDPs with stochastic transitions, built on sparse matrices.
+
+The dynamics of a (width x height) grid world are one scipy.sparse (cells x cells)
+transition matrix per action, with cells numbered x * height + y as in
+GridWorld.successors. With slip probability p the intended move is made with
+probability 1 - p, and otherwise a uniformly random move is made (which may be the
+intended one). The goal is terminal: its rows are empty, so no value flows out of it.
+
+Rewards are received on entering a cell, as in GridWorld.step. Value iteration is
+vectorized over all cells and actions, and policy iteration evaluates each policy
+with one sparse linear solve. With slip=0 the values match mdp_solver.value_iteration.
+"""
+import time
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
+from gridworld import UP, DOWN, LEFT, RIGHT
+
+ACTIONS = [UP, DOWN, LEFT, RIGHT]
+
+def successor_cells(width, height, action):
+    """
+    Returns the flat index of the cell every cell moves to with the given action.
+    """
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+    if action == LEFT:
+        xs = np.maximum(0, xs - 1)
+    elif action == RIGHT:
+        xs = np.minimum(width - 1, xs + 1)
+    elif action == UP:
+        ys = np.maximum(0, ys - 1)
+    elif action == DOWN:
+        ys = np.minimum(height - 1, ys + 1)
+    return (xs * height + ys).ravel()
+
+def transition_matrices(width, height, goal, slip=0.):
+    """
+    Returns a dict of the sparse (cells x cells) transition matrix of every action.
+    """
+    cells = width * height
+    rows = np.arange(cells)
+    # Episodes end at the goal, so its row is left empty
+    alive = sparse.diags((rows != goal[0] * height + goal[1]).astype(float))
+    moves = dict((a, sparse.csr_matrix((np.ones(cells), (rows, successor_cells(width, height, a))), shape=(cells, cells))) for a in ACTIONS)
+    random_move = sum(moves.values()) / float(len(ACTIONS))
+    return dict((a, (alive * ((1. - slip) * moves[a] + slip * random_move)).tocsr()) for a in ACTIONS)
+
+def policy_matrix(matrices, policy):
+    """
+    Returns the transition matrix of the chain a (width x height) policy of actions
+    induces. A policy of None moves uniformly at random.
+    """
+    if policy is None:
+        return sum(matrices.values()) / float(len(matrices))
+    actions = np.asarray(policy).astype(int).ravel()
+    return sum(sparse.diags((actions == a).astype(float)) * matrices[a] for a in ACTIONS).tocsr()
+
+def q_values(matrices, cell_rewards, cell_values, discount=1.0):
+    """
+    Returns the (actions x cells) Q-values of every action, in the order of ACTIONS.
+    """
+    backup = np.ravel(cell_rewards) + discount * np.ravel(cell_values)
+    return np.array([matrices[a].dot(backup) for a in ACTIONS])
+
+def greedy_policy(matrices, cell_rewards, cell_values, discount=1.0):
+    (width, height) = np.shape(cell_rewards)
+    q = q_values(matrices, cell_rewards, cell_values, discount)
+    return np.array(ACTIONS, dtype=float)[np.argmax(q, axis=0)].reshape(width, height)
+
+def value_iteration(width, height, goal, cell_rewards, slip=0., discount=1.0, convergence=0.01, deadline=None, matrices=None):
+    """
+    Vectorized value iteration. Returns the (width x height) values. Uses the same
+    initialization, monotone updates and wall-clock deadline as mdp_solver.value_iteration.
+    """
+    if matrices is None:
+        matrices = transition_matrices(width, height, goal, slip)
+    goal_index = goal[0] * height + goal[1]
+    cell_values = np.zeros(width * height) - 1000000
+    cell_values[goal_index] = 0
+    delta = 10000
+    while delta > convergence:
+        new_values = np.maximum(cell_values, q_values(matrices, cell_rewards, cell_values, discount).max(axis=0))
+        new_values[goal_index] = 0
+        delta = np.abs(new_values - cell_values).max()
+        cell_values = new_values
+        if deadline is not None and time.time() >= deadline:
+            break
+    return cell_values.reshape(width, height)
+
+def value_iteration_to_policy(width, height, goal, cell_rewards, slip=0., discount=1.0, convergence=0.01, deadline=None):
+    matrices = transition_matrices(width, height, goal, slip)
+    cell_values = value_iteration(width, height, goal, cell_rewards, discount=discount, convergence=convergence, deadline=deadline, matrices=matrices)
+    return greedy_policy(matrices, cell_rewards, cell_values, discount)
+
+def evaluate_policy(matrices, policy, cell_rewards, discount=1.0):
+    """
+    Returns the (width x height) values of a policy, from one sparse linear solve of
+    V = P_pi (r + discount V). Undiscounted, the policy must reach the goal from every cell.
+    """
+    (width, height) = np.shape(cell_rewards)
+    transitions = policy_matrix(matrices, policy)
+    system = (sparse.identity(width * height) - discount * transitions).tocsc()
+    cell_values = spsolve(system, transitions.dot(np.ravel(cell_rewards)))
+    if not np.all(np.isfinite(cell_values)):
+        raise Exception('Unsupported policy: it does not reach the goal from every cell. Use a discount below 1.')
+    return cell_values.reshape(width, height)
+
+def goal_seeking_policy(width, height, goal):
+    """
+    Returns the policy that walks straight towards the goal, which reaches it from
+    every cell with any slip probability below 1. Used to start policy iteration.
+    """
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+    policy = np.where(ys < goal[1], DOWN, UP)
+    policy = np.where(xs < goal[0], RIGHT, np.where(xs > goal[0], LEFT, policy))
+    return policy.astype(float)
+
+def policy_iteration(width, height, goal, cell_rewards, slip=0., discount=1.0, policy=None, max_iterations=100, tolerance=1e-9):
+    """
+    Policy iteration with sparse policy evaluation. Returns (values, policy). Starts
+    from the goal-seeking policy unless a policy is given, and only switches the action
+    of a cell when another action is better by more than the tolerance.
+    """
+    matrices = transition_matrices(width, height, goal, slip)
+    if policy is None:
+        policy = goal_seeking_policy(width, height, goal)
+    policy = np.array(policy, dtype=float)
+    actions = np.array(ACTIONS, dtype=float)
+    for i in range(max_iterations):
+        cell_values = evaluate_policy(matrices, policy, cell_rewards, discount)
+        q = q_values(matrices, cell_rewards, cell_values, discount)
+        current = q[np.searchsorted(actions, policy.ravel()), np.arange(width * height)]
+        improve = q.max(axis=0) > current + tolerance
+        if not improve.any():
+            break
+        policy = policy.ravel()
+        policy[improve] = actions[np.argmax(q[:, improve], axis=0)]
+        policy = policy.reshape(width, height)
+    return (cell_values, policy)
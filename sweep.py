@@ -0,0 +1,231 @@
+"""
+Runs hyperparameter sweeps of the experiments across a local process pool.
+
+A sweep spec is a JSON file such as:
+
+    {
+        "experiment": "training-window",
+        "output": "sweeps/colors",
+        "args": {"agents": ["multibayes", "qlearning"], "testsize": 10, "teststeps": 500},
+        "grid": {"trainsize": [[0], [4], [8]], "colors": [2, 4], "rstdev": [0.1, 0.3]},
+        "seeds": 3
+    }
+
+Every combination of the grid values, merged over the fixed args, is run once per seed
+("seeds" is a count or a list of seeds). Keys are the experiment's command line flags
+without the dashes; 'agents' is the positional argument, lists become repeated values
+and booleans become bare flags.
+
+Each run's results go to <output>/<key>/, where the key is a hash of the experiment,
+its configuration and the seed, so re-running a sweep (or a sweep that overlaps
+an earlier one) skips every run that already has results. Runs are handed to the
+pool longest first by the experiment's estimate_cost, and the progress and ETA are
+measured in estimated cost rather than in runs.
+
+Pool workers are daemonic and cannot start their own processes, so --async agents
+are not supported inside a sweep.
+"""
+import argparse
+import datetime
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import traceback
+from cli import EXPERIMENTS
+from results import MANIFEST
+
+def load_spec(path):
+    f = open(path, 'rb')
+    spec = json.load(f)
+    f.close()
+    return spec
+
+def config_to_argv(config):
+    """
+    Converts a configuration dictionary to the command line of an experiment.
+    """
+    argv = [str(x) for x in config.get('agents', [])]
+    for key in sorted(config.keys()):
+        value = config[key]
+        if key == 'agents' or value is None or value is False:
+            continue
+        if value is True:
+            argv.append('--' + key)
+        elif isinstance(value, list):
+            argv += ['--' + key] + [str(x) for x in value]
+        else:
+            argv += ['--' + key, str(value)]
+    return argv
+
+def run_key(experiment, config, seed):
+    """
+    The content hash that identifies a run.
+    """
+    content = json.dumps({'experiment': experiment, 'config': config, 'seed': seed}, sort_keys=True)
+    return hashlib.sha1(content).hexdigest()[:16]
+
+def expand_sweep(spec):
+    """
+    Expands a sweep spec into the list of its runs. Each run is a dictionary with the
+    experiment, the configuration, the seed, the key and the results directory.
+    """
+    experiment = spec['experiment']
+    if experiment not in EXPERIMENTS:
+        raise Exception('Unsupported experiment: ' + experiment)
+    grid = spec.get('grid', {})
+    names = sorted(grid.keys())
+    seeds = spec.get('seeds', 1)
+    if not isinstance(seeds, list):
+        seeds = range(seeds)
+    points = []
+    for values in itertools.product(*[grid[n] for n in names]):
+        config = dict(spec.get('args', {}))
+        config.update(zip(names, values))
+        for seed in seeds:
+            key = run_key(experiment, config, seed)
+            points.append({
+                'experiment': experiment,
+                'config': config,
+                'seed': seed,
+                'key': key,
+                'directory': os.path.join(spec.get('output', 'sweep'), key)
+            })
+    return points
+
+def is_finished(point):
+    return os.path.exists(os.path.join(point['directory'], MANIFEST))
+
+def estimate_costs(points):
+    """
+    Sets the estimated cost of every run, from the experiment's estimate_cost.
+    """
+    for point in points:
+        experiment = importlib.import_module(EXPERIMENTS[point['experiment']])
+        args = experiment.build_parser().parse_args(config_to_argv(point['config']))
+        point['cost'] = float(experiment.estimate_cost(args))
+
+def run_point(point):
+    """
+    Runs one point of a sweep in a worker process, with its output going to a log
+    file next to its results. Returns (key, seconds, error), where error is the
+    traceback if the run failed and None otherwise.
+    """
+    import numpy as np
+    directory = point['directory']
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    f = open(os.path.join(directory, 'config.json'), 'wb')
+    json.dump({'experiment': point['experiment'], 'config': point['config'], 'seed': point['seed']}, f, indent=2, sort_keys=True)
+    f.close()
+    start = time.time()
+    log = open(os.path.join(directory, 'log.txt'), 'wb')
+    stdout = sys.stdout
+    sys.stdout = log
+    try:
+        experiment = importlib.import_module(EXPERIMENTS[point['experiment']])
+        args = experiment.build_parser().parse_args(config_to_argv(point['config']) + ['--output', directory])
+        random.seed(point['seed'])
+        np.random.seed(point['seed'])
+        # The manifest is written last, so a run that dies part way is re-run next time
+        experiment.run(args)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        print error
+    finally:
+        sys.stdout = stdout
+        log.close()
+    return (point['key'], time.time() - start, error)
+
+class Progress(object):
+    """
+    Tracks the progress of a sweep in estimated cost and extrapolates the ETA from
+    the cost completed so far.
+    """
+    def __init__(self, points):
+        self.total_runs = len(points)
+        self.total_cost = sum(p['cost'] for p in points)
+        self.runs = 0
+        self.cost = 0.
+        self.start = time.time()
+
+    def update(self, cost):
+        self.runs += 1
+        self.cost += cost
+
+    def fraction(self):
+        if self.total_cost == 0:
+            return 1.
+        return self.cost / self.total_cost
+
+    def eta(self):
+        if self.cost == 0:
+            return None
+        return (time.time() - self.start) * (self.total_cost - self.cost) / self.cost
+
+    def __str__(self):
+        elapsed = datetime.timedelta(seconds=int(time.time() - self.start))
+        eta = self.eta()
+        eta = '?' if eta is None else str(datetime.timedelta(seconds=int(eta)))
+        return '[{0}/{1}] {2:.0%} done, elapsed {3}, ETA {4}'.format(self.runs, self.total_runs, self.fraction(), elapsed, eta)
+
+def describe(point, names):
+    return ', '.join(['{0}={1}'.format(n, point['config'].get(n)) for n in names] + ['seed={0}'.format(point['seed'])])
+
+def run_sweep(spec, processes=None, dry_run=False):
+    """
+    Runs every unfinished point of a sweep, longest first. Returns the list of points,
+    with failed runs marked by an 'error' entry.
+    """
+    points = expand_sweep(spec)
+    estimate_costs(points)
+    names = sorted(spec.get('grid', {}).keys())
+    pending = sorted([p for p in points if not is_finished(p)], key=lambda p: p['cost'], reverse=True)
+    print 'Sweep: {0} runs, {1} already finished, {2} to run'.format(len(points), len(points) - len(pending), len(pending))
+    if dry_run:
+        total = sum(p['cost'] for p in pending)
+        for p in pending:
+            print '  {0} {1:6.1%} of the cost ({2})'.format(p['key'], p['cost'] / total, describe(p, names))
+        return points
+    if len(pending) == 0:
+        return points
+    by_key = dict((p['key'], p) for p in pending)
+    progress = Progress(pending)
+    # One run per worker process, so memory does not build up across runs
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        for (key, seconds, error) in pool.imap_unordered(run_point, pending, chunksize=1):
+            point = by_key[key]
+            progress.update(point['cost'])
+            status = 'FAILED' if error is not None else '{0:.1f}s'.format(seconds)
+            print '{0} {1} {2} ({3})'.format(progress, key, status, describe(point, names))
+            sys.stdout.flush()
+            if error is not None:
+                point['error'] = error
+    finally:
+        pool.close()
+        pool.join()
+    failed = [p for p in pending if 'error' in p]
+    if len(failed) > 0:
+        print '{0} runs failed. See the log.txt of each run:'.format(len(failed))
+        for p in failed:
+            print '  ' + p['directory']
+    return points
+
+def build_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Runs a sweep of experiments across a local process pool.')
+    parser.add_argument('spec', help='The JSON sweep spec.')
+    parser.add_argument('--processes', type=int, default=None, help='The number of worker processes. Defaults to the number of CPUs.')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='List the runs that would be run, without running them.')
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    run_sweep(load_spec(args.spec), processes=args.processes, dry_run=args.dry_run)
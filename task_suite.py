@@ -0,0 +1,249 @@
+"""
+Persistent task suites: sets of grid world domains stored in one memory-mapped file,
+so that every run, agent and process can use exactly the same domains without
+sampling them again.
+
+The file holds an 8 byte magic string, a little-endian uint32 header length, a JSON
+header and the raw little-endian arrays, each aligned to 64 bytes: the int8 color
+grids, weights, goals, start locations and true class labels of all domains. The
+header gives the grid size, the number of colors, the reward noise, the slip, the
+maximum number of moves, named splits of the domains (e.g. 'train' and 'test'), any
+metadata on how the domains were generated (e.g. the number of classes and the seed)
+and the dtype, shape and offset of every array.
+
+Opening a suite only reads the header; the arrays are memory-mapped read-only, so
+the operating system shares their pages between processes. Domains are built on
+access, with their cell means computed from the color grid and weights. A domain
+of a suite pickles as (path, index), so worker processes reopen it by path.
+
+generate_arrays samples the arrays of many domains at once: the weights of all the
+domains of a class through one factor of its covariance, all color grids as one
+random integer tensor and all goals by vectorized truncation, so that a suite of
+10,000 domains is generated in seconds.
+"""
+import json
+import os
+import struct
+import numpy as np
+from gridworld import GridWorld, cell_features
+
+MAGIC = 'HBSUITE1'
+ALIGNMENT = 64
+
+SUITE_FIELDS = [('cell_colors', 'i1'), ('weights', '<f8'), ('goals', '<i4'), ('starts', '<i4'), ('classes', '<i4')]
+
+def covariance_factor(cov):
+    """
+    Returns a factor L with L L^T = cov, to sample N(mean, cov) as mean + z L^T. The
+    Cholesky factor when cov is positive definite; otherwise the factor of its singular
+    value decomposition, which np.random.multivariate_normal also uses.
+    """
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        (u, s, v) = np.linalg.svd(cov)
+        return v.T * np.sqrt(s)
+
+def sample_gaussian(mean, factor, n):
+    """
+    Returns n samples of the Gaussian with the given mean and covariance factor.
+    """
+    return np.asarray(mean) + np.dot(np.random.standard_normal((n, len(mean))), factor.T)
+
+def sample_goals(mean, cov, n, width, height):
+    """
+    Returns n goals drawn from the Gaussian, rounded to cells and truncated to the
+    grid. Like a rejection loop per goal, but every round redraws only the goals that
+    fell outside the grid, all at once.
+    """
+    factor = covariance_factor(cov)
+    goals = np.zeros((n, 2), dtype=int)
+    missing = np.arange(n)
+    while len(missing) > 0:
+        draws = np.round(sample_gaussian(mean, factor, len(missing))).astype(int)
+        inside = (draws[:,0] >= 0) & (draws[:,1] >= 0) & (draws[:,0] < width) & (draws[:,1] < height)
+        goals[missing[inside]] = draws[inside]
+        missing = missing[~inside]
+    return goals
+
+def generate_arrays(classes, labels, width, height, num_colors, start=(0,0)):
+    """
+    Samples the suite arrays of one domain per class label. classes is a list of
+    objects with weights_mean and weights_cov, and optionally goal_mean and goal_cov
+    for goals that vary between domains; otherwise the goal is the bottom-right cell.
+    """
+    labels = np.asarray(labels, dtype=int)
+    n = len(labels)
+    weights = np.zeros((n, len(classes[0].weights_mean)))
+    goals = np.tile([width-1, height-1], (n, 1))
+    for c,clazz in enumerate(classes):
+        members = np.flatnonzero(labels == c)
+        if len(members) == 0:
+            continue
+        weights[members] = sample_gaussian(clazz.weights_mean, covariance_factor(clazz.weights_cov), len(members))
+        if hasattr(clazz, 'goal_mean'):
+            goals[members] = sample_goals(clazz.goal_mean, clazz.goal_cov, len(members), width, height)
+    return {
+        'cell_colors': np.random.randint(num_colors, size=(n, width, height)).astype(np.int8),
+        'weights': weights,
+        'goals': goals,
+        'starts': np.tile(start, (n, 1)),
+        'classes': labels
+    }
+
+def make_domain(cls, task_id, cell_colors, weights, start, goal, num_colors, reward_stdev, max_moves=100, slip=0., compact=False, agent=None):
+    """
+    Creates a world of class cls (GridWorld or a subclass) from the arrays of one
+    domain, building its dense features unless it is compact.
+    """
+    cell_states = None if compact else cell_features(np.asarray(cell_colors, dtype=int), num_colors)
+    world = cls.from_arrays(task_id, weights, cell_colors, cell_states, None, reward_stdev=reward_stdev, agent=agent, max_moves=max_moves,
+                            start=tuple(int(x) for x in start), goal=tuple(int(x) for x in goal), slip=slip)
+    world.cell_means = world.project(weights)
+    return world
+
+def write_suite(path, arrays, num_colors, reward_stdev, max_moves=100, slip=0., splits=None, metadata=None):
+    """
+    Writes a suite from its arrays: a dict with the (n x width x height) cell_colors,
+    (n x d) weights, (n x 2) goals and starts, and the n class labels. splits maps
+    names to [start, end) ranges of domains, and metadata is a dict of JSON values
+    stored with them. The file is replaced atomically.
+    """
+    arrays = dict((name, np.ascontiguousarray(arrays[name], dtype=dtype)) for name,dtype in SUITE_FIELDS)
+    (n, width, height) = arrays['cell_colors'].shape
+    for name,a in arrays.items():
+        assert(len(a) == n)
+    assert(num_colors <= 127)
+    if splits is None:
+        splits = {'all': [0, n]}
+    header = {
+        'num_domains': n,
+        'width': width,
+        'height': height,
+        'num_colors': num_colors,
+        'reward_stdev': reward_stdev,
+        'max_moves': max_moves,
+        'slip': slip,
+        'splits': splits,
+        'metadata': metadata if metadata is not None else {},
+        'arrays': []
+    }
+    # The offsets depend on the header length and the header length on the offsets,
+    # so lay the arrays out again until the padded header size stops changing
+    prefix = len(MAGIC) + 4
+    start = 0
+    while True:
+        layout = []
+        offset = start
+        for name,dtype in SUITE_FIELDS:
+            layout.append([name, arrays[name].dtype.str, list(arrays[name].shape), offset])
+            offset += -(-arrays[name].nbytes // ALIGNMENT) * ALIGNMENT
+        header['arrays'] = layout
+        text = json.dumps(header, sort_keys=True, separators=(',', ':'))
+        needed = -(-(prefix + len(text)) // ALIGNMENT) * ALIGNMENT
+        if needed <= start:
+            break
+        start = needed
+    assert(len(text) <= start - prefix)
+    text += ' ' * (start - prefix - len(text))
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    f = open(tmp, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<I', len(text)))
+    f.write(text)
+    for (name, dtype, shape, offset) in layout:
+        f.seek(offset)
+        f.write(arrays[name].tostring())
+    f.close()
+    # Check the header reads back before the suite replaces an existing one
+    f = open(tmp, 'rb')
+    f.seek(len(MAGIC))
+    (length,) = struct.unpack('<I', f.read(4))
+    assert(json.loads(f.read(length)) == json.loads(text))
+    f.close()
+    os.rename(tmp, path)
+    return path
+
+def save_suite(path, domains, classes, splits=None):
+    """
+    Writes a list of GridWorlds (of the same size and number of colors) and their
+    class labels as a suite.
+    """
+    first = domains[0]
+    arrays = {
+        'cell_colors': np.array([d.cell_colors for d in domains]),
+        'weights': np.array([d.color_location_weights for d in domains]),
+        'goals': np.array([d.goal for d in domains]),
+        'starts': np.array([d.start_location for d in domains]),
+        'classes': np.array(classes)
+    }
+    return write_suite(path, arrays, first.num_colors, first.reward_stdev, first.max_moves, first.slip, splits)
+
+# Suites opened by this process, by (path, compact)
+_suites = {}
+
+def open_suite(path, compact=False):
+    """
+    Returns the suite at path, opening it only once per process.
+    """
+    key = (os.path.abspath(path), compact)
+    if key not in _suites:
+        _suites[key] = TaskSuite(path, compact)
+    return _suites[key]
+
+def load_suite_domain(path, compact, index):
+    return open_suite(path, compact).domain(index)
+
+class TaskSuite(object):
+    """
+    A suite opened for reading. Domains are compact worlds if compact is set, and
+    otherwise have their dense features built when they are opened.
+    """
+    def __init__(self, path, compact=False):
+        self.path = os.path.abspath(path)
+        self.compact = compact
+        f = open(path, 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            f.close()
+            raise Exception('Unsupported task suite file: ' + path)
+        (length,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length))
+        f.close()
+        for key in ['num_domains', 'width', 'height', 'num_colors', 'reward_stdev', 'max_moves', 'slip', 'splits']:
+            setattr(self, key, header[key])
+        self.metadata = header.get('metadata', {})
+        for (name, dtype, shape, offset) in header['arrays']:
+            setattr(self, str(name), np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=tuple(shape)))
+
+    def __len__(self):
+        return self.num_domains
+
+    def domain(self, i, task_id=None, agent=None):
+        """
+        Opens domain i. Its task ID defaults to its index in the suite.
+        """
+        world = make_domain(SuiteDomain, i if task_id is None else task_id, self.cell_colors[i], self.weights[i], self.starts[i], self.goals[i],
+                            self.num_colors, self.reward_stdev, self.max_moves, self.slip, self.compact, agent)
+        world.suite_path = self.path
+        world.suite_compact = self.compact
+        world.index = i
+        return world
+
+    def split(self, name):
+        """
+        Returns the indices of the domains in a named split.
+        """
+        if name not in self.splits:
+            raise Exception('Unsupported split {0}: the suite has {1}'.format(name, sorted(self.splits.keys())))
+        (start, end) = self.splits[name]
+        return range(start, end)
+
+class SuiteDomain(GridWorld):
+    """
+    A GridWorld opened from a TaskSuite.
+    """
+    ARRAYS = ['color_location_weights', 'cell_colors', 'cell_states', 'cell_means']
+
+    def __reduce__(self):
+        state = dict((k, v) for k,v in self.__dict__.items() if k not in SuiteDomain.ARRAYS and k not in ['suite_path', 'suite_compact', 'index'])
+        return (load_suite_domain, (self.suite_path, self.suite_compact, self.index), state)
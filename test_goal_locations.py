@@ -4,8 +4,10 @@ A script to replicate experiments 2 and 3 from the Wilson et. al. (ICML'07) pape
 import argparse
 from gridworld import *
 from qlearning import QAgent
+from multitask import MultiTaskBayesianAgent
+from results import save_results, load_results
+from task_suite import generate_arrays, make_domain
 import random
-import matplotlib.pyplot as plt
 import numpy as np
 
 class MdpClass(object):
@@ -22,27 +24,38 @@ def get_agents(args):
         if agent == 'qlearning':
             agents.append(QAgent(args.gridwidth, args.gridheight, args.colors, args.domains, 'Q-Learning',\
                             args.epsilon, args.alpha, args.gamma))
+        elif agent == 'multibayes':
+            # The goals differ between domains and are not known in advance
+            agents.append(MultiTaskBayesianAgent(args.gridwidth, args.gridheight, args.colors, args.domains, args.rstdev, name='MTRL',
+                                                 goal_known=False, goal_candidates=args.goalcandidates))
         else:
             raise Exception('Unsupported agent type: ' + agent)
     return agents
 
-def create_domain(task_id, args, classes):
-    clazz = random.choice(classes)
-    w = np.random.multivariate_normal(clazz.weights_mean, clazz.weights_cov)
-    goal = np.random.multivariate_normal(clazz.goal_mean, clazz.goal_cov)
-    goal = (int(round(goal[0])), int(round(goal[1])))
-    while goal[0] < 0 or goal[1] < 0 or goal[0] >= args.gridwidth or goal[1] >= args.gridheight:
-        goal = np.random.multivariate_normal(clazz.goal_mean, clazz.goal_cov)
-        goal = (int(round(goal[0])), int(round(goal[1])))
-    world = GridWorld(task_id, w, args.rstdev, None, args.gridwidth, args.gridheight, args.maxmoves, (0,0), goal)
-    return world
+def create_domains(args, classes):
+    """
+    Creates args.domains domains of uniformly chosen classes, with their weights, grids
+    and goals (truncated to the grid) sampled at once.
+    """
+    labels = np.random.randint(len(classes), size=args.domains)
+    arrays = generate_arrays(classes, labels, args.gridwidth, args.gridheight, args.colors)
+    return [make_domain(GridWorld, d, arrays['cell_colors'][d], arrays['weights'][d], arrays['starts'][d], arrays['goals'][d],
+                        args.colors, args.rstdev, args.maxmoves) for d in range(args.domains)]
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Tests an agent on a multi-task RL gridworld domain.')
+def estimate_cost(args):
+    """
+    Returns a rough relative cost of running the experiment with the given arguments.
+    """
+    return len(args.agents) * args.domains * args.maxmoves * args.gridwidth * args.gridheight
+
+def build_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Tests an agent on a multi-task RL gridworld domain.')
     parser.add_argument('agents', nargs='+', choices=['qlearning', 'singlebayes', 'multibayes'])
     # General experiment arguments
     parser.add_argument('--domains', type=int, default=100, help='The number of MDP domains the agent will experience.')
     parser.add_argument('--classes', type=int, default=4, help='The number of classes that partition the set of MDPs.')
+    parser.add_argument('--output', default='.', help='The directory the results are written to.')
     # Grid World arguments
     parser.add_argument('--colors', type=int, default=8, help='The number of colors in the MDP. Each cell is one color.')
     #parser.add_argument('--goals', type=int, default=4, help='The number of goal locations.')
@@ -51,17 +64,24 @@ if __name__ == "__main__":
     parser.add_argument('--rstdev', type=float, default=0.1, help='The (known) standard deviation of the reward function.')
     parser.add_argument('--gstdev', type=int, default=1, help='The (known) standard deviation of the goal locations.')
     parser.add_argument('--maxmoves', type=int, default=100, help='The maximum number of moves per episode.')
+    # Bayesian agent arguments
+    parser.add_argument('--goalcandidates', type=int, default=25, help='The number of most likely goals the multi-task Bayesian agent plans for.')
     # Q-Learning arguments
     parser.add_argument('--epsilon', type=float, default=0.1, help='The exploration rate for the Q-Learning agent. range: [0,1]')
     parser.add_argument('--alpha', type=float, default=0.1, help='The learning rate for the Q-Learning agent. range: [0,1]')
     parser.add_argument('--gamma', type=float, default=0.1, help='The discount factor for the Q-Learning agent. range: [0,1]')
-    args = parser.parse_args()
+    return parser
 
+def run(args):
+    """
+    Runs the experiment and writes the first-episode rewards of every agent to
+    args.output. Returns the path of the results manifest.
+    """
     agents = get_agents(args)
     classes = [MdpClass(i, args) for i in range(args.classes)]
-    domains = [create_domain(d, args, classes) for d in range(args.domains)]
+    domains = create_domains(args, classes)
     
-    agent_rewards = []
+    series = []
     for agent in agents:
         print 'Agent: {0}'.format(agent.name)
         first_episode_rewards = np.zeros((args.domains))
@@ -71,25 +91,12 @@ if __name__ == "__main__":
             steps = 0
             reward = domain.play_episode()
             first_episode_rewards[domain_idx] = reward
-        agent_rewards.append(first_episode_rewards)
-        
-    agent_colors = ['red','blue','yellow', 'green', 'orange', 'purple', 'brown'] # max 7 agents
-    ax = plt.subplot(111)
-    plt.xlim((0,args.domains))
-    xvals = np.arange(args.domains)
-    for i,rewards in enumerate(agent_rewards):
-        # Plot each series
-        plt.plot(xvals, rewards, label=agents[i].name, color=agent_colors[i])
-    plt.xlabel('# Experienced Environments')
-    plt.ylabel('Total Reward Episode 1')
-    #plt.ylim([0,1])
-    plt.title('{0}x{1} Map, {2} Locations, {3} Colors'.format(args.gridwidth, args.gridheight, args.goals, args.colors))
-    # Shink current axis by 25%
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.75, box.height])
-    # Put a legend to the right of the current axis
-    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-    plt.savefig('{0}.pdf'.format('test_locations'))
-    plt.clf()
-
+        agent.close()
+        series.append((agent.name, ['Domain', 'Reward'], [[i, r] for i,r in enumerate(first_episode_rewards)]))
+    return save_results(args.output, 'goal_locations', args, series)
 
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    manifest = run(args)
+    from plotting import plot_results
+    plot_results(load_results(manifest))
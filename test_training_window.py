@@ -5,11 +5,18 @@ import argparse
 from gridworld import *
 from qlearning import QAgent
 from multitask import MultiTaskBayesianAgent, MdpClass, NormalInverseWishartDistribution
+from singletask import SingleTaskBayesianAgent
+from results import save_results, load_results
+from domain_store import DomainStore
+from aggregation import CurveAggregator
+from trajectory import TrajectoryRecorder
+from evaluation import expected_return, policy_snapshot
+from oracle import OracleCache
+from task_suite import open_suite, write_suite, generate_arrays, make_domain
 import random
-import matplotlib.pyplot as plt
 import numpy as np
-import csv
-import math
+import os
+import time
 
 def get_agents(args):
     agents = []
@@ -18,19 +25,80 @@ def get_agents(args):
             if atype == 'qlearning':
                 agents.append((QAgent(args.gridwidth, args.gridheight, args.colors, mdps+1, 'Q-Learning', args.epsilon, args.alpha, args.gamma),0))
                 break # No use adding more than one q-learning agent.
+            elif atype == 'singlebayes':
+                agents.append((SingleTaskBayesianAgent(args.gridwidth, args.gridheight, args.colors, mdps+1, args.rstdev, name='STRL ({0} MDPs)'.format(mdps)),mdps))
             elif atype == 'multibayes':
-                agents.append((MultiTaskBayesianAgent(args.gridwidth, args.gridheight, args.colors, mdps+1, args.rstdev, name='MTRL ({0} MDPs)'.format(mdps)),mdps))
+                agents.append((MultiTaskBayesianAgent(args.gridwidth, args.gridheight, args.colors, mdps+1, args.rstdev, name='MTRL ({0} MDPs)'.format(mdps),
+                                                      async_updates=args.async_updates, max_staleness=args.maxstaleness,
+                                                      policy_budget=args.policybudget, inference=args.inference,
+                                                      reward_model=args.rewardmodel, planning=args.planning,
+                                                      planning_samples=args.planningsamples),mdps))
             else:
                 raise Exception('Unsupported agent type: ' + atype)
     return agents
 
-def create_domain(task_id, args, clazz):
-    w = np.random.multivariate_normal(clazz.weights_mean, clazz.weights_cov)
-    world = GridWorld(task_id, w, args.rstdev, None, args.gridwidth, args.gridheight, args.maxmoves, (0,0), None)
-    return world
+def test_agent(agent, training, domain, args, oracle=None):
+    """
+    Runs the agent on a test domain for args.teststeps steps and returns the reward
+    it collected in each measurement step of args.stepsize actions. Given an
+    OracleCache, returns (curve, regret) with the regret of the agent's policy at
+    every measurement step.
+    """
+    curve = np.zeros(args.teststeps / args.stepsize)
+    regret = np.zeros(args.teststeps / args.stepsize)
+    domain.task_id = training
+    agent.clear_memory(domain.task_id)
+    agent.recent_rewards = [] # clear the reward history
+    agent.domains[domain.task_id] = domain
+    domain.agent = agent
+    steps = 0
+    domain.start()
+    while steps < args.teststeps:
+        # Keep restarting the episodes until we've gone the number of steps
+        if not domain.episode_running:
+            domain.start()
+        # Step forward in the domain, without running past the next measurement
+        steps += domain.advance(min(args.teststeps - steps, args.stepsize - steps % args.stepsize))
+        # If we've taken a step's worth of actions, measure the cumulative rewards
+        if steps % args.stepsize == 0:
+            step_idx = steps / args.stepsize - 1
+            if args.evaluation == 'exact':
+                # Score the agent's current policy on the true cell means instead
+                curve[step_idx] = expected_return(domain, policy_snapshot(agent, domain.task_id), args.maxmoves)
+            else:
+                curve[step_idx] += sum(agent.recent_rewards)
+            if oracle is not None:
+                regret[step_idx] = oracle.regret(domain, policy_snapshot(agent, domain.task_id), args.maxmoves)
+    # Track the leftover steps in case stepsize is not a perfect divisor of teststeps.
+    if args.evaluation == 'sampled' and args.teststeps % args.stepsize > 0:
+        curve[-1] += sum(agent.recent_rewards)
+    if oracle is not None:
+        return (curve, regret)
+    return curve
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Tests an agent on a multi-task RL gridworld domain.')
+# The number of seconds between updates of the live results of a run
+LIVE_INTERVAL = 5.
+
+# The rough relative cost of a step of each agent type, used to schedule sweeps
+AGENT_COSTS = {'qlearning': 1., 'singlebayes': 20., 'multibayes': 100.}
+
+def estimate_cost(args):
+    """
+    Returns a rough relative cost of running the experiment with the given arguments.
+    Policy updates sweep the grid, and the Bayesian agents' feature size grows with
+    the number of colors.
+    """
+    cost = 0.
+    for atype in args.agents:
+        # Q-Learning does not train, and is only run once
+        trainsizes = [0] if atype == 'qlearning' else args.trainsize
+        for mdps in trainsizes:
+            cost += AGENT_COSTS[atype] * (mdps + args.testsize) * args.teststeps
+    return cost * args.gridwidth * args.gridheight * args.colors
+
+def build_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Tests an agent on a multi-task RL gridworld domain.')
     parser.add_argument('agents', nargs='+', choices=['qlearning', 'singlebayes', 'multibayes'])
     # General experiment arguments
     parser.add_argument('--classes', type=int, default=4, help='The number of classes that partition the set of MDPs.')
@@ -38,22 +106,51 @@ if __name__ == "__main__":
     parser.add_argument('--testsize', type=int, default=50, help='The number of test MDP domains to average over.')
     parser.add_argument('--teststeps', type=int, default=2500, help='The number of steps to measure in each test MDP.')
     parser.add_argument('--stepsize', type=int, default=10, help='The number of actions per measurement step in testing.')
+    parser.add_argument('--output', default='.', help='The directory the results are written to.')
+    parser.add_argument('--seed', type=int, default=None, help='The random seed of the true classes and the domains.')
+    parser.add_argument('--evaluation', default='sampled', choices=['sampled', 'exact'], help='Measure the rewards the agent collects, or the exact expected episode return of its policy on the true cell means.')
+    parser.add_argument('--oracle', default=None, help='The directory of the oracle cache. If given, the per-step regret of every agent is written to the regret directory of the output.')
+    parser.add_argument('--oracleprocesses', type=int, default=None, help='The number of processes that solve the domains missing from the oracle cache.')
+    parser.add_argument('--suite', default=None, help='The task suite file the domains are opened from. It is generated and written first if it does not exist.')
+    parser.add_argument('--record', action='store_true', help='Record the trajectory of every agent to trajectory_agent_N.bin in the output directory.')
     # Grid World arguments
     parser.add_argument('--colors', type=int, default=8, help='The number of colors in the MDP. Each cell is one color.')
     parser.add_argument('--gridwidth', type=int, default=15, help='The width of the grid world.')
     parser.add_argument('--gridheight', type=int, default=15, help='The height of the grid world.')
     parser.add_argument('--rstdev', type=float, default=0.1, help='The (known) standard deviation of the reward function.')
     parser.add_argument('--maxmoves', type=int, default=2500, help='The maximum number of moves per episode.')
+    parser.add_argument('--compact', action='store_true', help='Keep only the color grid and cell means of every domain, and produce the state features on demand.')
+    parser.add_argument('--slip', type=float, default=0., help='The probability that a move is replaced by a uniformly random one.')
+    # Bayesian agent arguments
+    parser.add_argument('--async', dest='async_updates', action='store_true', help='Run belief and policy updates of the Bayesian agents in a background process.')
+    parser.add_argument('--maxstaleness', type=int, default=None, help='The maximum number of steps an asynchronous agent may act on a stale policy.')
+    parser.add_argument('--policybudget', type=float, default=None, help='The wall-clock budget (in seconds) of each policy update of the Bayesian agents.')
+    parser.add_argument('--inference', default='gibbs', choices=['gibbs', 'collapsed', 'blocked', 'variational'], help='The engine the multi-task Bayesian agents use to infer classes between MDPs.')
+    parser.add_argument('--rewardmodel', default='mcmc', choices=['mcmc', 'smc'], help='The in-episode reward model of the multi-task Bayesian agents.')
+    parser.add_argument('--planning', default='map', choices=['map', 'thompson', 'mean_q'], help='Plan on the MAP weights, or on posterior weight samples by Thompson sampling or their mean Q-values.')
+    parser.add_argument('--planningsamples', type=int, default=10, help='The number of posterior weight samples of the thompson and mean_q planners.')
     # Q-Learning arguments
     parser.add_argument('--epsilon', type=float, default=0.1, help='The exploration rate for the Q-Learning agent. range: [0,1]')
     parser.add_argument('--alpha', type=float, default=0.1, help='The learning rate for the Q-Learning agent. range: [0,1]')
     parser.add_argument('--gamma', type=float, default=0.1, help='The discount factor for the Q-Learning agent. range: [0,1]')
-    args = parser.parse_args()
+    return parser
 
+def build_domains(args):
+    """
+    Samples the true classes and creates the training and test domains. With
+    args.seed set, every process builds exactly the same domains. With args.suite,
+    the domains are opened from that task suite, which is written first if it does
+    not exist. Returns (chosen_train, train_domains, test_domains, store), where store
+    is the DomainStore holding the domains (None for a suite); release it once the
+    domains are no longer needed.
+    """
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+    if args.suite is not None and os.path.exists(args.suite):
+        return suite_domains(args) + (None,)
     SIZE = args.colors * NUM_RELATIVE_CELLS
 
-    agents = get_agents(args)
-
     niw_true = NormalInverseWishartDistribution(np.zeros(SIZE) - 3., 1., SIZE+2, np.identity(SIZE))
     true_params = [niw_true.sample() for i in range(args.classes)]
 
@@ -67,87 +164,141 @@ if __name__ == "__main__":
     classes = [MdpClass(i, mean, cov) for i,(mean,cov) in enumerate(true_params)]
     chosen_train = [i % len(classes) for i in range(max(args.trainsize))]
     chosen_test = [i % len(classes) for i in range(args.testsize)]
-    train_domains = [create_domain(d, args, classes[chosen_train[d]]) for d in range(max(args.trainsize))]
-    test_domains = [create_domain(d, args, classes[chosen_test[d]]) for d in range(args.testsize)]
-    avg = []
-    stdev = []
-    stderr = []
+    # Sample all the domains at once, one covariance factorization per class
+    arrays = generate_arrays(classes, chosen_train + chosen_test, args.gridwidth, args.gridheight, args.colors)
+    if args.suite is not None:
+        write_suite(args.suite, arrays, args.colors, args.rstdev, args.maxmoves, args.slip,
+                    {'train': [0, len(chosen_train)], 'test': [len(chosen_train), len(chosen_train) + len(chosen_test)]},
+                    {'classes': args.classes, 'seed': args.seed})
+        return suite_domains(args) + (None,)
+    task_ids = range(len(chosen_train)) + range(len(chosen_test))
+    domains = [make_domain(GridWorld, task_ids[i], arrays['cell_colors'][i], arrays['weights'][i], arrays['starts'][i], arrays['goals'][i],
+                           args.colors, args.rstdev, args.maxmoves, args.slip, args.compact) for i in range(len(task_ids))]
+    train_domains = domains[:len(chosen_train)]
+    test_domains = domains[len(chosen_train):]
+    # Move the domains to shared memory, so worker processes (e.g. of --async agents) share them
+    store = DomainStore(train_domains + test_domains)
+    train_domains = [store.domain(d) for d in range(len(train_domains))]
+    test_domains = [store.domain(len(train_domains) + d) for d in range(len(test_domains))]
+    return (chosen_train, train_domains, test_domains, store)
+
+def suite_domains(args):
+    """
+    Opens the training and test domains of the task suite at args.suite. The suite
+    is memory-mapped, so it is not copied to a DomainStore.
+    """
+    suite = open_suite(args.suite, args.compact)
+    for (name, value) in [('width', args.gridwidth), ('height', args.gridheight), ('num_colors', args.colors), ('slip', args.slip),
+                          ('reward_stdev', args.rstdev), ('max_moves', args.maxmoves)]:
+        if getattr(suite, name) != value:
+            raise Exception('Unsupported task suite {0}: its {1} is {2}, not {3}'.format(args.suite, name, getattr(suite, name), value))
+    # The classes behind the domains and their labels
+    for (name, value) in [('classes', args.classes), ('seed', args.seed)]:
+        if suite.metadata.get(name) != value:
+            raise Exception('Unsupported task suite {0}: it was generated with {1} {2}, not {3}'.format(args.suite, name, suite.metadata.get(name), value))
+    train = suite.split('train')[:max(args.trainsize)]
+    test = suite.split('test')[:args.testsize]
+    if len(train) < max(args.trainsize) or len(test) < args.testsize:
+        raise Exception('Unsupported task suite {0}: it has {1} training and {2} test domains'.format(args.suite, len(suite.split('train')), len(suite.split('test'))))
+    chosen_train = [int(suite.classes[i]) for i in train]
+    train_domains = [suite.domain(i, task_id=d) for d,i in enumerate(train)]
+    test_domains = [suite.domain(i, task_id=d) for d,i in enumerate(test)]
+    return (chosen_train, train_domains, test_domains)
+
+def agent_configs(args):
+    """
+    Returns the (agent type, training MDPs) pair of every agent get_agents creates.
+    """
+    configs = []
+    for atype in args.agents:
+        for mdps in args.trainsize:
+            configs.append((atype, mdps))
+            if atype == 'qlearning':
+                break # As in get_agents
+    return configs
+
+def train_agent(agent, training, train_domains, args):
+    for didx in range(training):
+        domain = train_domains[didx]
+        agent.domains[domain.task_id] = domain
+        domain.agent = agent
+        steps = 0
+        domain.start()
+        while steps < args.teststeps:
+            # Keep restarting the episodes until we've gone the number of steps
+            if not domain.episode_running:
+                domain.start()
+            # Step forward in the domain
+            steps += domain.advance(args.teststeps - steps)
+
+def run(args):
+    """
+    Runs the experiment and writes the per-agent results to args.output.
+    Returns the path of the results manifest.
+    """
+    agents = get_agents(args)
+    (chosen_train, train_domains, test_domains, store) = build_domains(args)
+    series = []
+    header = ['StepTimes{0}'.format(args.stepsize), 'Avg', 'Stdev', 'Stderr']
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    oracle = None
+    regret_series = []
+    if args.oracle is not None:
+        oracle = OracleCache(args.oracle)
+        print 'Solved {0} domains missing from the oracle cache'.format(oracle.fill(train_domains + test_domains, args.oracleprocesses))
 
     print 'Chosen training distribution: {0}'.format(chosen_train)
     for agent,training in agents:
         print 'Agent: {0}'.format(agent.name)
+        if args.record:
+            recorder = TrajectoryRecorder()
+            for domain in train_domains + test_domains:
+                recorder.attach(domain)
         print 'Training...'
-        for didx in range(training):
-            domain = train_domains[didx]
-            agent.domains[domain.task_id] = domain
-            domain.agent = agent
-            steps = 0
-            domain.start()
-            while steps < args.teststeps:
-                # Keep restarting the episodes until we've gone the number of steps
-                if not domain.episode_running:
-                    domain.start()
-                # Step forward in the domain
-                domain.step()
-                steps += 1
+        train_agent(agent, training, train_domains, args)
         print 'Testing...'
         # TODO: Freeze the memory of the agent and restart it for every testing domain
         # so that it does not learn from previous test domains. Not a problem for Q-Learning.
-        avg_rewards = np.zeros((args.teststeps / args.stepsize, len(test_domains)))
+        aggregate = CurveAggregator(args.teststeps / args.stepsize)
+        regret = CurveAggregator(args.teststeps / args.stepsize)
+        live = os.path.join(args.output, 'live_agent_{0}.csv'.format(len(series)+1))
+        last_write = time.time()
         for i,domain in enumerate(test_domains):
             print 'Test #{0}'.format(i)
-            domain.task_id = training
-            agent.clear_memory(domain.task_id)
-            agent.recent_rewards = [] # clear the reward history
-            agent.domains[domain.task_id] = domain
-            domain.agent = agent
-            steps = 0
-            domain.start()
-            while steps < args.teststeps:
-                # Keep restarting the episodes until we've gone the number of steps
-                if not domain.episode_running:
-                    domain.start()
-                # Step forward in the domain
-                domain.step()
-                steps += 1
-                # If we've taken a step's worth of actions, measure the cumulative rewards
-                if steps % args.stepsize == 0:
-                    step_idx = steps / args.stepsize - 1
-                    avg_rewards[step_idx][i] += sum(agent.recent_rewards)
-            # Track the leftover steps in case stepsize is not a perfect divisor of teststeps.
-            if args.teststeps % args.stepsize > 0:
-                avg_rewards[-1][i] += sum(agent.recent_rewards)
-        avg.append(avg_rewards.mean(axis=1))
-        stdev.append(avg_rewards.std(axis=1))
-        stderr.append(stdev[-1] / math.sqrt(len(test_domains)))
-        #agent_rewards.append(avg_rewards)
-        f = open('agent_{0}.csv'.format(len(avg)), 'wb')
-        writer = csv.writer(f)
-        writer.writerow(['StepTimes{0}'.format(args.stepsize), 'Avg', 'Stdev', 'Stderr'])
-        for i in range(len(avg[-1])):
-            writer.writerow([i, avg[-1][i], stdev[-1][i], stderr[-1][i]])
-        f.flush()
-        f.close()
-    
-    agent_colors = ['red','blue', 'green', 'brown', 'purple', 'yellow', 'orange'] # max 7 agents
-    ax = plt.subplot(111)
-    num_steps = args.teststeps / args.stepsize
-    plt.xlim((0,num_steps))
-    for i in range(len(avg)):
-        xvals = np.arange(len(avg[i]))
-        # Plot each series
-        plt.plot(xvals + 1, avg[i], label=agents[i][0].name, color=agent_colors[i])
-        plt.fill_between(xvals + 1, avg[i] + stderr[i], avg[i] - stderr[i], facecolor=agent_colors[i], alpha=0.2)
-    plt.xlabel('Number of Steps x {0}'.format(args.stepsize))
-    plt.ylabel('Cumulative Reward')
-    #plt.ylim([0,1])
-    plt.title('{0}x{1} Map, Fixed Goal Location'.format(args.gridwidth, args.gridheight))
-    # Shink current axis by 25%
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.75, box.height])
-    # Put a legend to the right of the current axis
-    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-    plt.savefig('{0}.pdf'.format('test'))
-    plt.clf()
-
+            if oracle is not None:
+                (curve, domain_regret) = test_agent(agent, training, domain, args, oracle)
+                regret.add(domain_regret)
+            else:
+                curve = test_agent(agent, training, domain, args)
+            aggregate.add(curve)
+            # Keep a live copy of the curve, so the confidence bands can be read during a run
+            if time.time() - last_write >= LIVE_INTERVAL:
+                aggregate.write_csv(live, header)
+                last_write = time.time()
+        if os.path.exists(live):
+            os.remove(live)
+        agent.close()
+        if hasattr(agent, 'stale_steps'):
+            print 'Steps taken on a stale policy: {0}'.format(agent.stale_steps)
+        if hasattr(agent, 'budget_hits'):
+            print 'Policy updates that hit the budget: {0} / {1}'.format(agent.budget_hits, agent.policy_updates)
+        if hasattr(agent, 'posterior_cache'):
+            print 'Posterior cache hit rate: {0:.2f} (beliefs) {1:.2f} (in-episode)'.format(agent.posterior_cache.hit_rate(),
+                    agent.model.posterior_cache.hit_rate() if hasattr(agent.model, 'posterior_cache') else 0.)
+        if args.record:
+            recorder.save(os.path.join(args.output, 'trajectory_agent_{0}.bin'.format(len(series)+1)))
+        series.append((agent.name, header, aggregate.rows()))
+        regret_series.append((agent.name, header, regret.rows()))
+    if oracle is not None:
+        save_results(os.path.join(args.output, 'regret'), 'regret', args, regret_series)
+    if store is not None:
+        store.release()
+    return save_results(args.output, 'training_window', args, series)
 
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    manifest = run(args)
+    from plotting import plot_results
+    plot_results(load_results(manifest))
@@ -0,0 +1,261 @@
+"""
+Recording of agent trajectories in grid worlds and offline replay into the models.
+
+A TrajectoryRecorder attached to GridWorlds (world.recorder = recorder) logs every
+episode start and step as typed arrays: the domain, task ID, location, action,
+reward and episode flags. It also logs the colour grid, goal and true weights of
+every domain it sees. That is all that is needed to rebuild the (state, reward)
+stream, so the models can be replayed and benchmarked without the simulator.
+
+The file format is deterministic: an 8 byte magic string, a little-endian uint32
+header length, a JSON header (sorted keys) describing the arrays, then the raw
+little-endian array data. The same trajectory always produces the same bytes.
+"""
+import argparse
+import hashlib
+import json
+import random
+import struct
+import time
+import numpy as np
+from gridworld import *
+
+MAGIC = 'HBTRAJ01'
+
+# Record flags
+EPISODE_START = 1
+GOAL_REACHED = 2
+
+RECORD_FIELDS = [('domain', '<i4'), ('task', '<i4'), ('x', '<i2'), ('y', '<i2'), ('action', 'i1'), ('flags', 'u1'), ('reward', '<f8')]
+
+class TrajectoryRecorder(object):
+    def __init__(self, capacity=4096):
+        self.size = 0
+        self.records = dict((name, np.zeros(capacity, dtype=dtype)) for name,dtype in RECORD_FIELDS)
+        self.domains = []
+        self.domain_index = {}
+
+    def attach(self, world):
+        world.recorder = self
+
+    def register(self, world):
+        """
+        Returns the index of a domain, logging its grid the first time it is seen.
+        """
+        key = id(world)
+        if key not in self.domain_index:
+            if len(self.domains) > 0:
+                assert(world.cell_colors.shape == self.domains[0].cell_colors.shape)
+                assert(world.num_colors == self.domains[0].num_colors)
+            assert(world.num_colors <= 256)
+            self.domain_index[key] = len(self.domains)
+            # Keeping the world also stops its id from being reused
+            self.domains.append(world)
+        return self.domain_index[key]
+
+    def append(self, world, action, location, reward, flags):
+        if self.size == len(self.records['reward']):
+            for name in self.records:
+                self.records[name] = np.resize(self.records[name], 2 * self.size)
+        i = self.size
+        self.records['domain'][i] = self.register(world)
+        self.records['task'][i] = world.task_id
+        self.records['x'][i] = location[0]
+        self.records['y'][i] = location[1]
+        self.records['action'][i] = action
+        self.records['flags'][i] = flags
+        self.records['reward'][i] = reward
+        self.size += 1
+
+    def record_start(self, world, location):
+        self.append(world, CURRENT, location, 0., EPISODE_START)
+
+    def record_step(self, world, action, location, reward, goal_reached):
+        self.append(world, action, location, reward, GOAL_REACHED if goal_reached else 0)
+
+    def __len__(self):
+        return self.size
+
+    def arrays(self):
+        """
+        Returns the recorded arrays, trimmed to the recorded size, with the domain tables.
+        """
+        arrays = [(name, self.records[name][:self.size].astype(dtype)) for name,dtype in RECORD_FIELDS]
+        arrays.append(('cell_colors', np.array([w.cell_colors for w in self.domains], dtype='u1')))
+        arrays.append(('goals', np.array([w.goal for w in self.domains], dtype='<i2')))
+        arrays.append(('weights', np.array([w.color_location_weights for w in self.domains], dtype='<f8')))
+        return arrays
+
+    def save(self, path):
+        assert(len(self.domains) > 0)
+        arrays = self.arrays()
+        header = {
+            'num_colors': self.domains[0].num_colors,
+            'reward_stdev': self.domains[0].reward_stdev,
+            'max_moves': self.domains[0].max_moves,
+            'slip': self.domains[0].slip,
+            'arrays': [[name, a.dtype.str, list(a.shape)] for name,a in arrays]
+        }
+        header = json.dumps(header, sort_keys=True, separators=(',', ':'))
+        f = open(path, 'wb')
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name,a in arrays:
+            f.write(np.ascontiguousarray(a).tostring())
+        f.close()
+
+class Trajectory(object):
+    """
+    A recorded trajectory, loaded with load_trajectory.
+    """
+    def __init__(self, header, arrays):
+        self.num_colors = header['num_colors']
+        self.reward_stdev = header['reward_stdev']
+        # Files recorded before these were stored hold deterministic 100-move worlds
+        self.max_moves = header.get('max_moves', 100)
+        self.slip = header.get('slip', 0.)
+        for name,a in arrays.items():
+            setattr(self, name, a)
+        (num_domains, self.width, self.height) = self.cell_colors.shape
+        self.features = np.array([cell_features(c.astype(int), self.num_colors) for c in self.cell_colors])
+
+    def __len__(self):
+        return len(self.reward)
+
+    def states(self):
+        """
+        Returns the (records x features) states the agent observed at every record.
+        """
+        return self.features[self.domain, self.x, self.y]
+
+    def world(self, i):
+        """
+        Returns a GridWorld over the arrays of recorded domain i, for agents that plan.
+        It is never stepped, so it needs no agent.
+        """
+        features = self.features[i]
+        return GridWorld.from_arrays(None, self.weights[i], self.cell_colors[i].astype(int), features, np.dot(features, self.weights[i]),
+                                     reward_stdev=self.reward_stdev, max_moves=self.max_moves, goal=tuple(int(x) for x in self.goals[i]), slip=self.slip)
+
+def load_trajectory(path):
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    if data[:len(MAGIC)] != MAGIC:
+        raise Exception('Unsupported trajectory file: ' + path)
+    offset = len(MAGIC)
+    (length,) = struct.unpack('<I', data[offset:offset+4])
+    offset += 4
+    header = json.loads(data[offset:offset+length])
+    offset += length
+    arrays = {}
+    for name,dtype,shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[str(name)] = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return Trajectory(header, arrays)
+
+def replay_model(trajectory, build_model, update_every=10, seed=0):
+    """
+    Streams the recorded (state, reward) pairs into reward models, starting a fresh
+    model from build_model() at every new domain and calling update_beliefs every
+    update_every steps, as an agent does every steps_per_policy steps.
+    Returns a list of (record, MAP class ID, weights) after every update.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    states = trajectory.states()
+    model = None
+    domain = None
+    steps = 0
+    updates = []
+    for i in range(len(trajectory)):
+        if trajectory.domain[i] != domain:
+            domain = trajectory.domain[i]
+            model = build_model()
+            steps = 0
+        if trajectory.flags[i] & EPISODE_START:
+            continue
+        model.add_observation(states[i], trajectory.reward[i])
+        steps += 1
+        if steps % update_every == 0:
+            model.update_beliefs()
+            updates.append((i, model.map_class.class_id, np.copy(model.weights)))
+    return updates
+
+def replay_agent(trajectory, agent, seed=0):
+    """
+    Replays the recorded episodes through an agent's callbacks in the order the
+    simulator made them, with the recorded actions and rewards in place of the
+    simulator. The agent still runs all of its belief and policy updates; the actions
+    it picks are ignored. When a new domain reuses a task ID (as the test domains
+    of the experiments do), the agent's memory of the task is cleared first.
+    Returns the agent's policy after every step.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    states = trajectory.states()
+    worlds = {}
+    task_domains = {}
+    policies = []
+    for i in range(len(trajectory)):
+        (d, task) = (trajectory.domain[i], trajectory.task[i])
+        location = (int(trajectory.x[i]), int(trajectory.y[i]))
+        if task_domains.get(task) != d:
+            if task in task_domains:
+                agent.clear_memory(task)
+            task_domains[task] = d
+            if d not in worlds:
+                worlds[d] = trajectory.world(d)
+            worlds[d].task_id = task
+            agent.domains[task] = worlds[d]
+        if trajectory.flags[i] & EPISODE_START:
+            agent.episode_starting(task, location, states[i])
+            continue
+        agent.get_action(task)
+        agent.observe_reward(task, trajectory.reward[i])
+        agent.set_state(task, location, states[i])
+        if trajectory.flags[i] & GOAL_REACHED:
+            agent.episode_over(task)
+        policies.append(getattr(agent, 'policy', None))
+    return policies
+
+def digest(values):
+    """
+    Returns a hash of replay outputs, to check that replays are identical.
+    """
+    h = hashlib.sha1()
+    for v in values:
+        h.update(np.asarray(v).tostring() if v is not None else 'None')
+    return h.hexdigest()
+
+def build_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Replays a recorded trajectory into a model or agent, without the simulator.')
+    parser.add_argument('trajectory', help='The trajectory file.')
+    parser.add_argument('--target', default='model', choices=['model', 'agent'], help='Replay into the in-episode reward model or the whole multi-task agent.')
+    parser.add_argument('--updateevery', type=int, default=10, help='The number of steps between belief updates of the model.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed of the replay.')
+    parser.add_argument('--inference', default='gibbs', choices=['gibbs', 'collapsed', 'blocked', 'variational'], help='The inference engine of the agent.')
+    parser.add_argument('--rewardmodel', default='mcmc', choices=['mcmc', 'smc'], help='The in-episode reward model.')
+    return parser
+
+def replay(args):
+    from multitask import MultiTaskBayesianAgent
+    trajectory = load_trajectory(args.trajectory)
+    num_tasks = int(trajectory.task.max()) + 1
+    agent = MultiTaskBayesianAgent(trajectory.width, trajectory.height, trajectory.num_colors, num_tasks, trajectory.reward_stdev,
+                                   name='Replay', inference=args.inference, reward_model=args.rewardmodel)
+    start = time.time()
+    if args.target == 'model':
+        updates = replay_model(trajectory, lambda: agent.build_model([], [], agent.auxillary_distribution), args.updateevery, args.seed)
+        result = digest([w for (i, c, w) in updates] + [c for (i, c, w) in updates])
+    else:
+        result = digest(replay_agent(trajectory, agent, args.seed))
+    print 'Replayed {0} records in {1:.2f}s. Digest: {2}'.format(len(trajectory), time.time() - start, result)
+    return result
+
+if __name__ == "__main__":
+    replay(build_parser().parse_args())
@@ -0,0 +1,239 @@
+"""
+Mean-field variational inference for the Dirichlet process mixture of MDP classes
+from Wilson et al. (ICML'07).
+
+The DP is truncated at a fixed number of classes with a stick-breaking prior. The
+factorised posterior is
+    q(v_k) = Beta(gamma1_k, gamma2_k)         stick-breaking proportions
+    q(mu_k, Lambda_k) = Normal-Wishart        class parameters (NIW on the covariance)
+    q(z_j) = Categorical(r_j)                 class assignment of MDP j
+    q(w_j) = N(m_j, S_j)                      reward weights of MDP j
+and every coordinate-ascent update is vectorized over MDPs and classes. Iterations
+stop when the evidence lower bound (ELBO) stops improving. Coordinate ascent only
+finds a local optimum, so a few restarts are run and the highest ELBO is kept.
+"""
+import math
+import numpy as np
+from scipy.special import digamma, gammaln, multigammaln
+from multitask import MdpClass
+
+class VariationalDPMixture(object):
+    """
+    A deterministic alternative to the Gibbs samplers in MultiTaskBayesianAgent that
+    produces the same (classes, assignments, counts, weights) summary.
+    """
+    def __init__(self, prior, alpha, reward_stdev, truncation=10, max_iterations=200, tolerance=1e-6, restarts=5):
+        self.prior = prior
+        self.alpha = alpha
+        self.reward_stdev = reward_stdev
+        self.truncation = truncation
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.restarts = restarts
+        self.iterations = 0
+        self.elbo = None
+
+    def fit(self, statistics):
+        """
+        Runs coordinate ascent over the reward statistics of every MDP and returns
+        the hard MAP summary as (classes, assignments, assignment_counts, weights).
+        """
+        if len(statistics) == 0:
+            # No MDPs yet (e.g. an agent without training MDPs): only the prior is known
+            return ([], [], [], [])
+        noise = self.reward_stdev ** 2
+        # Data terms of every MDP, scaled by the reward precision
+        self.data_xtx = np.array([s.xtx for s in statistics]) / noise
+        self.data_xty = np.array([s.xty for s in statistics]) / noise
+        self.data_yty = np.array([s.yty for s in statistics]) / noise
+        self.data_count = np.array([s.count for s in statistics], dtype=float)
+        # Prior in Normal-Wishart form over the precision
+        self.inv_w0 = self.prior.psi
+        self.w0 = np.linalg.inv(self.prior.psi)
+        best = None
+        for restart in range(self.restarts):
+            self.optimize()
+            if best is None or self.elbo > best[0]:
+                best = (self.elbo, self.iterations, self.summary())
+        (self.elbo, self.iterations, summary) = best
+        print 'Variational MAP Distribution: {0} (ELBO: {1}, iterations: {2})'.format(summary[2], self.elbo, self.iterations)
+        return summary
+
+    def optimize(self):
+        """
+        Runs coordinate ascent from a fresh initialisation until the ELBO converges.
+        """
+        K = self.truncation
+        # Start from k-means++ style hard assignments and the prior over the class parameters
+        self.resp = self.initial_assignments()
+        self.beta = np.ones(K) * self.prior.lmbda
+        self.nu = np.ones(K) * self.prior.nu
+        self.means = np.tile(self.prior.mu, (K, 1))
+        self.scales = np.tile(self.w0, (K, 1, 1))
+        prev_elbo = None
+        for iteration in range(self.max_iterations):
+            self.update_weights()
+            self.update_classes()
+            self.update_sticks()
+            self.update_assignments()
+            self.elbo = self.compute_elbo()
+            self.iterations = iteration + 1
+            if prev_elbo is not None and abs(self.elbo - prev_elbo) <= self.tolerance * abs(prev_elbo):
+                break
+            prev_elbo = self.elbo
+
+    def initial_assignments(self):
+        """
+        Seeds the classes with D^2 sampling over the ridge estimates of each MDP's
+        weights and assigns every MDP to its nearest seed. Random hard assignments
+        tend to leave coordinate ascent in a local optimum that mixes classes.
+        """
+        (J, d) = self.data_xty.shape
+        K = min(self.truncation, J)
+        estimates = np.linalg.solve(self.data_xtx + np.identity(d)[None,:,:], self.data_xty[:,:,None])[:,:,0]
+        seeds = [estimates[np.random.randint(J)]]
+        for _ in range(1, K):
+            distances = np.min([np.sum((estimates - s) ** 2, axis=1) for s in seeds], axis=0)
+            if distances.sum() <= 0.:
+                break
+            seeds.append(estimates[np.searchsorted(np.cumsum(distances), np.random.random() * distances.sum())])
+        nearest = np.argmin([np.sum((estimates - s) ** 2, axis=1) for s in seeds], axis=0)
+        resp = np.zeros((J, self.truncation))
+        resp[np.arange(J), nearest] = 1.
+        return resp
+
+    def update_weights(self):
+        """
+        q(w_j): the Gaussian posterior of each MDP's weights under the expected
+        precision and precision-weighted mean of its classes.
+        """
+        expected_precision = self.nu[:,None,None] * self.scales
+        precision = np.einsum('jk,kab->jab', self.resp, expected_precision) + self.data_xtx
+        linear = np.einsum('jk,kab,kb->ja', self.resp, expected_precision, self.means) + self.data_xty
+        self.weights_cov = np.linalg.inv(precision)
+        self.weights_mean = np.einsum('jab,jb->ja', self.weights_cov, linear)
+
+    def update_classes(self):
+        """
+        q(mu_k, Lambda_k): the Normal-Wishart posterior given the soft assignments.
+        """
+        mu0 = self.prior.mu
+        beta0 = self.prior.lmbda
+        self.counts = self.resp.sum(axis=0)
+        safe_counts = np.maximum(self.counts, 1e-10)
+        mean_weights = np.dot(self.resp.T, self.weights_mean) / safe_counts[:,None]
+        second_moments = np.einsum('jk,jab->kab', self.resp, self.weights_cov + np.einsum('ja,jb->jab', self.weights_mean, self.weights_mean))
+        scatter = second_moments - self.counts[:,None,None] * np.einsum('ka,kb->kab', mean_weights, mean_weights)
+        deviation = mean_weights - mu0
+        self.beta = beta0 + self.counts
+        self.nu = self.prior.nu + self.counts
+        self.means = (beta0 * mu0 + self.counts[:,None] * mean_weights) / self.beta[:,None]
+        inv_scales = self.inv_w0 + scatter + (beta0 * self.counts / self.beta)[:,None,None] * np.einsum('ka,kb->kab', deviation, deviation)
+        self.scales = np.linalg.inv(inv_scales)
+
+    def update_sticks(self):
+        """
+        q(v_k): the Beta posterior of each stick-breaking proportion.
+        """
+        tail_counts = np.cumsum(self.counts[::-1])[::-1] - self.counts
+        self.gamma1 = 1. + self.counts[:-1]
+        self.gamma2 = self.alpha + tail_counts[:-1]
+
+    def update_assignments(self):
+        """
+        q(z_j): the class responsibilities of each MDP.
+        """
+        d = self.prior.mu.shape[0]
+        self.expected_log_pi = self.stick_expectations()
+        self.expected_log_det = self.log_det_expectations()
+        quad = self.quadratic_expectations()
+        log_rho = self.expected_log_pi + 0.5 * self.expected_log_det - 0.5 * d * math.log(2. * math.pi) - 0.5 * quad
+        log_rho -= log_rho.max(axis=1)[:,None]
+        self.resp = np.exp(log_rho)
+        self.resp /= self.resp.sum(axis=1)[:,None]
+
+    def stick_expectations(self):
+        """
+        Returns E[log pi_k] under the truncated stick-breaking posterior.
+        """
+        total = digamma(self.gamma1 + self.gamma2)
+        log_v = np.append(digamma(self.gamma1) - total, 0.)
+        log_one_minus_v = np.append(0., np.cumsum(digamma(self.gamma2) - total))
+        return log_v + log_one_minus_v
+
+    def log_det_expectations(self):
+        """
+        Returns E[log |Lambda_k|] under each class's Wishart posterior.
+        """
+        d = self.prior.mu.shape[0]
+        dims = np.arange(1, d + 1)
+        return digamma(0.5 * (self.nu[:,None] + 1 - dims)).sum(axis=1) + d * math.log(2.) + np.linalg.slogdet(self.scales)[1]
+
+    def quadratic_expectations(self):
+        """
+        Returns the (MDP, class) matrix of E[(w_j - mu_k)' Lambda_k (w_j - mu_k)].
+        """
+        d = self.prior.mu.shape[0]
+        diff = self.weights_mean[:,None,:] - self.means[None,:,:]
+        mahalanobis = np.einsum('jka,kab,jkb->jk', diff, self.scales, diff)
+        trace = np.einsum('kab,jba->jk', self.scales, self.weights_cov)
+        return d / self.beta[None,:] + self.nu[None,:] * (mahalanobis + trace)
+
+    def compute_elbo(self):
+        """
+        Returns the evidence lower bound of the current variational posterior.
+        """
+        d = self.prior.mu.shape[0]
+        K = self.truncation
+        mu0 = self.prior.mu
+        beta0 = self.prior.lmbda
+        nu0 = self.prior.nu
+        log_2pi = math.log(2. * math.pi)
+        quad = self.quadratic_expectations()
+        # E[log p(rewards | w)]
+        second_moments = self.weights_cov + np.einsum('ja,jb->jab', self.weights_mean, self.weights_mean)
+        elbo = np.sum(-0.5 * self.data_count * math.log(self.reward_stdev ** 2) - 0.5 * self.data_count * log_2pi
+                      - 0.5 * (self.data_yty - 2. * np.einsum('ja,ja->j', self.weights_mean, self.data_xty)
+                               + np.einsum('jab,jba->j', self.data_xtx, second_moments)))
+        # E[log p(w | z, mu, Lambda)] + E[log p(z | v)]
+        elbo += np.sum(self.resp * (0.5 * self.expected_log_det - 0.5 * d * log_2pi - 0.5 * quad + self.expected_log_pi))
+        # E[log p(v)]
+        total = digamma(self.gamma1 + self.gamma2)
+        elbo += np.sum(math.log(self.alpha) + (self.alpha - 1.) * (digamma(self.gamma2) - total))
+        # E[log p(mu, Lambda)]
+        deviation = self.means - mu0
+        elbo += np.sum(0.5 * d * math.log(beta0 / (2. * math.pi)) + 0.5 * self.expected_log_det - 0.5 * d * beta0 / self.beta
+                       - 0.5 * beta0 * self.nu * np.einsum('ka,kab,kb->k', deviation, self.scales, deviation))
+        elbo += K * self.log_wishart_norm(self.w0, nu0) + 0.5 * (nu0 - d - 1) * np.sum(self.expected_log_det) \
+                - 0.5 * np.sum(self.nu * np.einsum('ab,kba->k', self.inv_w0, self.scales))
+        # Entropies: - E[log q(w)] - E[log q(z)] - E[log q(v)] - E[log q(mu, Lambda)]
+        elbo += np.sum(0.5 * d * (1. + log_2pi) + 0.5 * np.linalg.slogdet(self.weights_cov)[1])
+        elbo -= np.sum(self.resp * np.log(np.maximum(self.resp, 1e-300)))
+        elbo -= np.sum((self.gamma1 - 1.) * (digamma(self.gamma1) - total) + (self.gamma2 - 1.) * (digamma(self.gamma2) - total)
+                       - (gammaln(self.gamma1) + gammaln(self.gamma2) - gammaln(self.gamma1 + self.gamma2)))
+        for k in range(K):
+            wishart_entropy = -self.log_wishart_norm(self.scales[k], self.nu[k]) - 0.5 * (self.nu[k] - d - 1) * self.expected_log_det[k] + 0.5 * self.nu[k] * d
+            elbo -= 0.5 * self.expected_log_det[k] + 0.5 * d * math.log(self.beta[k] / (2. * math.pi)) - 0.5 * d - wishart_entropy
+        return elbo
+
+    def log_wishart_norm(self, scale, nu):
+        """
+        Returns the log of the Wishart normalising constant B(W, nu).
+        """
+        d = scale.shape[0]
+        return -0.5 * nu * np.linalg.slogdet(scale)[1] - 0.5 * nu * d * math.log(2.) - multigammaln(0.5 * nu, d)
+
+    def summary(self):
+        """
+        Returns the hard assignments, relabelled so the occupied classes are 0..n-1,
+        together with the expected class parameters and the weight means.
+        """
+        d = self.prior.mu.shape[0]
+        hard = np.argmax(self.resp, axis=1)
+        occupied = [k for k in range(self.truncation) if np.any(hard == k)]
+        relabel = dict((k, i) for i,k in enumerate(occupied))
+        assignments = [relabel[k] for k in hard]
+        classes = [MdpClass(i, self.means[k], np.linalg.inv(self.scales[k]) / (self.nu[k] - d - 1)) for i,k in enumerate(occupied)]
+        counts = [int(np.sum(hard == k)) for k in occupied]
+        weights = [w for w in self.weights_mean]
+        return (classes, assignments, counts, weights)